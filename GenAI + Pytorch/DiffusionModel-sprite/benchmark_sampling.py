@@ -0,0 +1,178 @@
+"""
+CPU benchmark of diffusion sampling with the ContextUnet.
+
+For every (n_feat, height) configuration reports
+    - forward latency per block type (UnetDown, UnetUp, ResidualConvBlock, EmbedFC) and per named block
+    - ms per denoising step (one U-Net forward + the sampler update)
+    - images per second for DDPM (all timesteps) and DDIM (n steps)
+    - peak resident memory of the process running the configuration
+and writes everything to a JSON file for regression tracking.
+
+usage:
+    python benchmark_sampling.py --n-feat 32 64 --height 16 28 --batch-size 32 --out bench.json
+"""
+import argparse
+import json
+import multiprocessing as mp
+import platform
+import resource
+import sys
+import time
+from collections import defaultdict
+
+import numpy as np
+import torch
+
+from diffusion_utilities import ContextUnet, EmbedFC, ResidualConvBlock, UnetDown, UnetUp
+from sampling_utilities import NoiseSchedule, sample_ddim_context, sample_ddpm_context
+
+BLOCKS = (UnetDown, UnetUp, ResidualConvBlock, EmbedFC)
+
+
+class BlockTimer:
+    '''
+    Forward-hook timer for the U-Net building blocks. Times are inclusive: a UnetDown
+    contains the time of its ResidualConvBlocks.
+    '''
+    def __init__(self, model):
+        self.times = defaultdict(list)
+        self.handles = []
+        self._start = {}
+        for name, module in model.named_modules():
+            if isinstance(module, BLOCKS):
+                self.handles.append(module.register_forward_pre_hook(self._pre(name)))
+                self.handles.append(module.register_forward_hook(self._post(name, type(module).__name__)))
+
+    def _pre(self, name):
+        def hook(module, inputs):
+            self._start[name] = time.perf_counter()
+        return hook
+
+    def _post(self, name, kind):
+        def hook(module, inputs, output):
+            self.times[(kind, name)].append(time.perf_counter() - self._start[name])
+        return hook
+
+    def summary(self, n_forward):
+        # mean ms per forward of the whole network, by block type and by named block
+        by_kind, by_name = defaultdict(float), {}
+        for (kind, name), t in self.times.items():
+            ms = 1000 * sum(t) / n_forward
+            by_kind[kind] += ms
+            by_name[name] = ms
+        return dict(by_kind), by_name
+
+    def remove(self):
+        for handle in self.handles:
+            handle.remove()
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on linux and bytes on macos
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 2**20 if sys.platform == "darwin" else rss / 2**10
+
+
+@torch.no_grad()
+def benchmark(n_feat, height, batch_size, n_cfeat, timesteps, ddim_n, n_forward, seed):
+    torch.manual_seed(seed)
+    model = ContextUnet(in_channels=3, n_feat=n_feat, n_cfeat=n_cfeat, height=height).eval()
+    x = torch.randn(batch_size, 3, height, height)
+    t = torch.rand(1, 1, 1, 1)
+    c = torch.nn.functional.one_hot(torch.randint(0, n_cfeat, (batch_size,)), n_cfeat).float()
+    w = torch.zeros(batch_size)
+
+    # warm up, then per-block latency
+    for _ in range(2):
+        model(x, t, c=c)
+    timer = BlockTimer(model)
+    start = time.perf_counter()
+    for _ in range(n_forward):
+        model(x, t, c=c)
+    forward_ms = 1000 * (time.perf_counter() - start) / n_forward
+    by_kind, by_name = timer.summary(n_forward)
+    timer.remove()
+
+    schedule = NoiseSchedule(timesteps)
+    start = time.perf_counter()
+    sample_ddpm_context(model, schedule, c, w, height)
+    ddpm_s = time.perf_counter() - start
+    start = time.perf_counter()
+    sample_ddim_context(model, schedule, c, w, height, n=ddim_n)
+    ddim_s = time.perf_counter() - start
+    ddim_steps = len(range(timesteps, 0, -(timesteps // ddim_n)))
+
+    return {
+        "n_feat": n_feat,
+        "height": height,
+        "batch_size": batch_size,
+        "n_params": sum(p.numel() for p in model.parameters()),
+        "forward_ms": forward_ms,
+        "block_ms": by_kind,
+        "named_block_ms": by_name,
+        "ddpm": {
+            "steps": timesteps,
+            "ms_per_step": 1000 * ddpm_s / timesteps,
+            "images_per_s": batch_size / ddpm_s,
+        },
+        "ddim": {
+            "steps": ddim_steps,
+            "ms_per_step": 1000 * ddim_s / ddim_steps,
+            "images_per_s": batch_size / ddim_s,
+        },
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+def _run(queue, kwargs):
+    torch.set_num_threads(kwargs.pop("num_threads"))
+    queue.put(benchmark(**kwargs))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--n-feat", type=int, nargs="+", default=[32, 64])
+    parser.add_argument("--height", type=int, nargs="+", default=[16])
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--n-cfeat", type=int, default=5)
+    parser.add_argument("--timesteps", type=int, default=500)
+    parser.add_argument("--ddim-n", type=int, default=20)
+    parser.add_argument("--n-forward", type=int, default=10, help="forwards used for the per-block latency")
+    parser.add_argument("--num-threads", type=int, default=torch.get_num_threads())
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default="bench_sampling.json")
+    args = parser.parse_args(argv)
+
+    results = []
+    # one fresh process per configuration so that peak memory is not carried over
+    ctx = mp.get_context("spawn")
+    for n_feat in args.n_feat:
+        for height in args.height:
+            kwargs = dict(n_feat=n_feat, height=height, batch_size=args.batch_size, n_cfeat=args.n_cfeat,
+                          timesteps=args.timesteps, ddim_n=args.ddim_n, n_forward=args.n_forward,
+                          seed=args.seed, num_threads=args.num_threads)
+            queue = ctx.Queue()
+            proc = ctx.Process(target=_run, args=(queue, kwargs))
+            proc.start()
+            r = queue.get()
+            proc.join()
+            blocks = ", ".join(f"{k} {v:.1f}" for k, v in r["block_ms"].items())
+            print(f"n_feat={n_feat:4d} h={height:3d}: {r['forward_ms']:.1f} ms/forward ({blocks}), "
+                  f"ddpm {r['ddpm']['images_per_s']:.2f} img/s, ddim {r['ddim']['images_per_s']:.2f} img/s, "
+                  f"peak {r['peak_rss_mb']:.0f} MB")
+            results.append(r)
+
+    report = {
+        "torch": torch.__version__,
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "num_threads": args.num_threads,
+        "results": results,
+    }
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"saved results at {args.out}")
+
+
+if __name__ == "__main__":
+    main()
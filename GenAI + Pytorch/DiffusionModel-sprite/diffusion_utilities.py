@@ -140,19 +140,96 @@ class EmbedFC(nn.Module):
         # apply the model layers to the flattened tensor
         return self.model(x)
     
+class ContextUnet(nn.Module):
+    def __init__(self, in_channels, n_feat=256, n_cfeat=10, height=28):  # cfeat - context features
+        super(ContextUnet, self).__init__()
+
+        # number of input channels, number of intermediate feature maps and number of classes
+        self.in_channels = in_channels
+        self.n_feat = n_feat
+        self.n_cfeat = n_cfeat
+        self.h = height  #assume h == w. must be divisible by 4, so 28,24,20,16...
+
+        # Initialize the initial convolutional layer
+        self.init_conv = ResidualConvBlock(in_channels, n_feat, is_res=True)
+
+        # Initialize the down-sampling path of the U-Net with two levels
+        self.down1 = UnetDown(n_feat, n_feat)        # down1 #[10, 256, 8, 8]
+        self.down2 = UnetDown(n_feat, 2 * n_feat)    # down2 #[10, 256, 4,  4]
+
+         # original: self.to_vec = nn.Sequential(nn.AvgPool2d(7), nn.GELU())
+        self.to_vec = nn.Sequential(nn.AvgPool2d((4)), nn.GELU())
+
+        # Embed the timestep and context labels with a one-layer fully connected neural network
+        self.timeembed1 = EmbedFC(1, 2*n_feat)
+        self.timeembed2 = EmbedFC(1, 1*n_feat)
+        self.contextembed1 = EmbedFC(n_cfeat, 2*n_feat)
+        self.contextembed2 = EmbedFC(n_cfeat, 1*n_feat)
+
+        # Initialize the up-sampling path of the U-Net with three levels
+        self.up0 = nn.Sequential(
+            nn.ConvTranspose2d(2 * n_feat, 2 * n_feat, self.h//4, self.h//4), # up-sample
+            nn.GroupNorm(8, 2 * n_feat), # normalize
+            nn.ReLU(),
+        )
+        self.up1 = UnetUp(4 * n_feat, n_feat)
+        self.up2 = UnetUp(2 * n_feat, n_feat)
+
+        # Initialize the final convolutional layers to map to the same number of channels as the input image
+        self.out = nn.Sequential(
+            nn.Conv2d(2 * n_feat, n_feat, 3, 1, 1), # reduce number of feature maps   #in_channels, out_channels, kernel_size, stride=1, padding=0
+            nn.GroupNorm(8, n_feat), # normalize
+            nn.ReLU(),
+            nn.Conv2d(n_feat, self.in_channels, 3, 1, 1), # map to same number of channels as input
+        )
+
+    def forward(self, x, t, c=None):
+        """
+        x : (batch, n_feat, h, w) : input image
+        t : (batch, n_cfeat)      : time step
+        c : (batch, n_classes)    : context label
+        """
+        # x is the input image, c is the context label, t is the timestep, context_mask says which samples to block the context on
+
+        # pass the input image through the initial convolutional layer
+        x = self.init_conv(x)
+        # pass the result through the down-sampling path
+        down1 = self.down1(x)       #[10, 256, 8, 8]
+        down2 = self.down2(down1)   #[10, 256, 4, 4]
+
+        # convert the feature maps to a vector and apply an activation
+        hiddenvec = self.to_vec(down2)
+
+        # mask out context if context_mask == 1
+        if c is None:
+            c = torch.zeros(x.shape[0], self.n_cfeat).to(x)
+
+        # embed context and timestep
+        cemb1 = self.contextembed1(c).view(-1, self.n_feat * 2, 1, 1)     # (batch, 2*n_feat, 1,1)
+        temb1 = self.timeembed1(t).view(-1, self.n_feat * 2, 1, 1)
+        cemb2 = self.contextembed2(c).view(-1, self.n_feat, 1, 1)
+        temb2 = self.timeembed2(t).view(-1, self.n_feat, 1, 1)
+        #print(f"uunet forward: cemb1 {cemb1.shape}. temb1 {temb1.shape}, cemb2 {cemb2.shape}. temb2 {temb2.shape}")
+
+
+        up1 = self.up0(hiddenvec)
+        up2 = self.up1(cemb1*up1 + temb1, down2)  # add and multiply embeddings
+        up3 = self.up2(cemb2*up2 + temb2, down1)
+        out = self.out(torch.cat((up3, x), 1))
+        return out
+
 def unorm(x):
     # unity norm. results in range of [0,1]
-    # assume x (h,w,3)
-    xmax = x.max((0,1))
-    xmin = x.min((0,1))
+    # assume x (..., h,w,3); min/max are taken per image and per channel
+    xmax = x.max((-3,-2), keepdims=True)
+    xmin = x.min((-3,-2), keepdims=True)
     return(x - xmin)/(xmax - xmin)
 
 def norm_all(store, n_t, n_s):
     # runs unity norm on all timesteps of all samples
+    # store is (t, n, h, w, 3); a single vectorized pass instead of a loop over (t, n)
     nstore = np.zeros_like(store)
-    for t in range(n_t):
-        for s in range(n_s):
-            nstore[t,s] = unorm(store[t,s])
+    nstore[:n_t,:n_s] = unorm(store[:n_t,:n_s])
     return nstore
 
 def norm_torch(x_all):
@@ -166,18 +243,14 @@ def norm_torch(x_all):
     nstore = (x - xmin)/(xmax - xmin)
     return torch.from_numpy(nstore)
 
-def gen_tst_context(n_cfeat):
+def gen_tst_context(n_cfeat, n_repeat=6):
     """
     Generate test context vectors
+    each of the n_cfeat one-hot contexts followed by the null context, repeated n_repeat times
+    for n_cfeat=5: human, non-human, food, spell, side-facing, null (36x5)
     """
-    vec = torch.tensor([
-    [1,0,0,0,0], [0,1,0,0,0], [0,0,1,0,0], [0,0,0,1,0], [0,0,0,0,1],  [0,0,0,0,0],      # human, non-human, food, spell, side-facing
-    [1,0,0,0,0], [0,1,0,0,0], [0,0,1,0,0], [0,0,0,1,0], [0,0,0,0,1],  [0,0,0,0,0],      # human, non-human, food, spell, side-facing
-    [1,0,0,0,0], [0,1,0,0,0], [0,0,1,0,0], [0,0,0,1,0], [0,0,0,0,1],  [0,0,0,0,0],      # human, non-human, food, spell, side-facing
-    [1,0,0,0,0], [0,1,0,0,0], [0,0,1,0,0], [0,0,0,1,0], [0,0,0,0,1],  [0,0,0,0,0],      # human, non-human, food, spell, side-facing
-    [1,0,0,0,0], [0,1,0,0,0], [0,0,1,0,0], [0,0,0,1,0], [0,0,0,0,1],  [0,0,0,0,0],      # human, non-human, food, spell, side-facing
-    [1,0,0,0,0], [0,1,0,0,0], [0,0,1,0,0], [0,0,0,1,0], [0,0,0,0,1],  [0,0,0,0,0]]      # human, non-human, food, spell, side-facing
-    )
+    block = torch.cat([torch.eye(n_cfeat, dtype=torch.int64), torch.zeros(1, n_cfeat, dtype=torch.int64)])
+    vec = block.repeat(n_repeat, 1)
     return len(vec), vec
 
 def plot_grid(x,n_sample,n_rows,save_dir,w):
@@ -188,28 +261,53 @@ def plot_grid(x,n_sample,n_rows,save_dir,w):
     print('saved image at ' + save_dir + f"run_image_w{w}.png")
     return grid
 
+def tile_frames(store, nrows, padding=2, scale=1):
+    # store:(t, n_sample, h, w, 3) in [0,1], tiled into (t, H, W, 3) uint8 frames
+    # numpy equivalent of make_grid applied to every timestep at once
+    n_t, n_sample, h, w, c = store.shape
+    ncols = n_sample//nrows
+    x = store[:, :nrows*ncols].reshape(n_t, nrows, ncols, h, w, c)
+    if scale > 1:
+        x = x.repeat(scale, axis=3).repeat(scale, axis=4)
+        h, w = h*scale, w*scale
+    x = np.pad(x, ((0,0), (0,0), (0,0), (padding,0), (padding,0), (0,0)))
+    x = x.transpose(0, 1, 3, 2, 4, 5).reshape(n_t, nrows*(h+padding), ncols*(w+padding), c)
+    x = np.pad(x, ((0,0), (0,padding), (0,padding), (0,0)))
+    return (np.clip(x, 0, 1)*255).round().astype(np.uint8)
+
+def save_gif(x_gen_store, n_sample, nrows, save_dir, fn, w, fps=5, scale=4):
+    # writes the sampling trajectory straight to a gif with PIL, no matplotlib redraws
+    # x_gen_store:(t, n_sample, 3, h, w)
+    sx_gen_store = np.moveaxis(x_gen_store[:, :n_sample],2,4)                 # change to Numpy image format (h,w,channels) vs (channels,h,w)
+    frames = tile_frames(unorm(sx_gen_store), nrows, scale=scale)
+    images = [Image.fromarray(frame) for frame in frames]
+    images[0].save(save_dir + f"{fn}_w{w}.gif", save_all=True, append_images=images[1:],
+                   duration=1000//fps, loop=0)
+    print('saved gif at ' + save_dir + f"{fn}_w{w}.gif")
+
 def plot_sample(x_gen_store,n_sample,nrows,save_dir, fn,  w, save=False):
     ncols = n_sample//nrows
     sx_gen_store = np.moveaxis(x_gen_store,2,4)                               # change to Numpy image format (h,w,channels) vs (channels,h,w)
     nsx_gen_store = norm_all(sx_gen_store, sx_gen_store.shape[0], n_sample)   # unity norm to put in range [0,1] for np.imshow
     
     # create gif of images evolving over time, based on x_gen_store
-    fig, axs = plt.subplots(nrows=nrows, ncols=ncols, sharex=True, sharey=True,figsize=(ncols,nrows))
+    fig, axs = plt.subplots(nrows=nrows, ncols=ncols, sharex=True, sharey=True,figsize=(ncols,nrows), squeeze=False)
+    # create the imshow artists once and only swap their data on every frame
+    plots = []
+    for row in range(nrows):
+        for col in range(ncols):
+            axs[row, col].set_xticks([])
+            axs[row, col].set_yticks([])
+            plots.append(axs[row, col].imshow(nsx_gen_store[0,(row*ncols)+col]))
     def animate_diff(i, store):
         print(f'gif animating frame {i} of {store.shape[0]}', end='\r')
-        plots = []
-        for row in range(nrows):
-            for col in range(ncols):
-                axs[row, col].clear()
-                axs[row, col].set_xticks([])
-                axs[row, col].set_yticks([])
-                plots.append(axs[row, col].imshow(store[i,(row*ncols)+col]))
+        for j, plot in enumerate(plots):
+            plot.set_data(store[i,j])
         return plots
     ani = FuncAnimation(fig, animate_diff, fargs=[nsx_gen_store],  interval=200, blit=False, repeat=True, frames=nsx_gen_store.shape[0]) 
     plt.close()
     if save:
-        ani.save(save_dir + f"{fn}_w{w}.gif", dpi=100, writer=PillowWriter(fps=5))
-        print('saved gif at ' + save_dir + f"{fn}_w{w}.gif")
+        save_gif(x_gen_store, n_sample, nrows, save_dir, fn, w)
     return ani
 
 
@@ -0,0 +1,98 @@
+import copy
+
+import torch
+import torch.nn as nn
+
+
+@torch.no_grad()
+def fuse_conv_bn(conv: nn.Conv2d, bn: nn.BatchNorm2d) -> nn.Conv2d:
+    '''
+    Folds an eval-mode BatchNorm2d into the Conv2d that precedes it.
+
+    bn(conv(x)) = gamma * (W*x + b - mean) / sqrt(var + eps) + beta, which is again a
+    convolution with weights W * scale and bias (b - mean) * scale + beta.
+    '''
+    fused = copy.deepcopy(conv)
+    scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+    fused.weight.copy_(conv.weight * scale.reshape(-1, 1, 1, 1))
+    bias = conv.bias if conv.bias is not None else torch.zeros_like(bn.running_mean)
+    fused.bias = nn.Parameter((bias - bn.running_mean) * scale + bn.bias)
+    return fused
+
+def fold_batchnorm(model: nn.Module) -> nn.Module:
+    '''
+    Folds every Conv2d -> BatchNorm2d pair inside an nn.Sequential (the conv1/conv2 stacks of
+    ResidualConvBlock) into a single convolution. The BatchNorm is replaced by nn.Identity so
+    module indices, and therefore get_out_channels(), keep working. Only valid after training:
+    the model must be in eval mode so the running statistics are what batchnorm would use.
+    '''
+    assert not model.training, "call model.eval() before folding batchnorm"
+    for module in model.modules():
+        if not isinstance(module, nn.Sequential):
+            continue
+        for i in range(len(module) - 1):
+            conv, bn = module[i], module[i + 1]
+            if isinstance(conv, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d) and bn.track_running_stats:
+                module[i] = fuse_conv_bn(conv, bn)
+                module[i + 1] = nn.Identity()
+    return model
+
+
+class InferenceUnet(nn.Module):
+    '''
+    Inference wrapper around a trained (Context)Unet.
+
+    Holds a copy of the model with batchnorm folded into the convolutions and the weights in
+    channels_last memory format; forward() feeds channels_last inputs and, on cpu, runs the
+    network under bf16 autocast. The output is returned as contiguous fp32 NCHW, so the
+    wrapper is a drop-in replacement for the model inside the sampling loops:
+
+        nn_model.eval()
+        fast_model = InferenceUnet(nn_model)
+        check_inference(nn_model, fast_model, samples, t, c=ctx)
+        eps = fast_model(samples, t, c=ctx)
+    '''
+    def __init__(self, model: nn.Module, channels_last=True, fold_bn=True, bf16=True):
+        super().__init__()
+        model = copy.deepcopy(model).eval()
+        if fold_bn:
+            model = fold_batchnorm(model)
+        self.channels_last = channels_last
+        if channels_last:
+            model = model.to(memory_format=torch.channels_last)
+        self.bf16 = bf16
+        self.model = model.requires_grad_(False)
+
+    @torch.no_grad()
+    def forward(self, x, t, c=None):
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+        with torch.autocast(device_type=x.device.type, dtype=torch.bfloat16, enabled=self.bf16):
+            out = self.model(x, t, c=c)
+        return out.float().contiguous()
+
+
+@torch.no_grad()
+def check_inference(reference, optimized, x, t, c=None, rtol=None, seed=0):
+    '''
+    Compares the optimized model against the fp32 reference on the same inputs.
+
+    Returns the relative L2 error ||ref - opt|| / ||ref|| and the max absolute error, and raises
+    an AssertionError if the relative error exceeds rtol (default 5e-2 with bf16, 1e-4 without).
+    The random generator is re-seeded before each forward because ResidualConvBlock builds its
+    1x1 shortcut convolution inside forward().
+    '''
+    if rtol is None:
+        rtol = 5e-2 if getattr(optimized, "bf16", False) else 1e-4
+    was_training = reference.training
+    reference.eval()
+    torch.manual_seed(seed)
+    ref = reference(x, t, c=c).float()
+    torch.manual_seed(seed)
+    out = optimized(x, t, c=c).float()
+    reference.train(was_training)
+    rel_err = ((ref - out).norm() / ref.norm()).item()
+    max_err = (ref - out).abs().max().item()
+    print(f"inference check: relative error {rel_err:.2e}, max abs error {max_err:.2e}")
+    assert rel_err <= rtol, f"optimized model deviates from the fp32 reference: {rel_err:.2e} > {rtol:.0e}"
+    return rel_err, max_err
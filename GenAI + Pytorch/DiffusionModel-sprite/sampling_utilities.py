@@ -0,0 +1,193 @@
+import functools
+import os
+
+import numpy as np
+import torch
+from torchvision.utils import save_image
+
+
+class NoiseSchedule:
+    '''
+    DDPM noise schedule (b_t, a_t, ab_t) together with the per-step coefficients of the
+    DDPM and DDIM updates, computed once and kept on the sampling device. Use
+    get_schedule() to share one instance between calls instead of rebuilding it.
+    '''
+    def __init__(self, timesteps=500, beta1=1e-4, beta2=0.02, device="cpu"):
+        self.timesteps = timesteps
+        self.device = torch.device(device)
+        # construct DDPM noise schedule
+        self.b_t = (beta2 - beta1) * torch.linspace(0, 1, timesteps + 1, device=device) + beta1
+        self.a_t = 1 - self.b_t
+        self.ab_t = torch.cumsum(self.a_t.log(), dim=0).exp()
+        self.ab_t[0] = 1
+        # coefficients of denoise_add_noise, indexed by timestep
+        self.noise_scale = self.b_t.sqrt()
+        self.eps_scale = (1 - self.a_t) / (1 - self.ab_t).sqrt()
+        self.inv_sqrt_a = 1 / self.a_t.sqrt()
+        # time inputs of the network, (timesteps + 1, 1, 1, 1, 1) so t[i] broadcasts over the batch
+        self.t = (torch.arange(timesteps + 1, device=device) / timesteps)[:, None, None, None, None]
+
+    def denoise_add_noise(self, x, t, pred_noise, z=None):
+        # removes the predicted noise (but adds some noise back in to avoid collapse)
+        if z is None:
+            z = torch.randn_like(x)
+        mean = (x - pred_noise * self.eps_scale[t]) * self.inv_sqrt_a[t]
+        return mean + self.noise_scale[t] * z
+
+    def denoise_ddim(self, x, t, t_prev, pred_noise):
+        # removes the noise using ddim
+        ab = self.ab_t[t]
+        ab_prev = self.ab_t[t_prev]
+        x0_pred = ab_prev.sqrt() / ab.sqrt() * (x - (1 - ab).sqrt() * pred_noise)
+        dir_xt = (1 - ab_prev).sqrt() * pred_noise
+        return x0_pred + dir_xt
+
+@functools.lru_cache(maxsize=None)
+def get_schedule(timesteps=500, beta1=1e-4, beta2=0.02, device="cpu"):
+    return NoiseSchedule(timesteps, beta1, beta2, device)
+
+
+def predict_noise(model, x, t, c, w):
+    '''
+    Classifier-free guidance: eps = (1 + w) * eps(x, t, c) - w * eps(x, t, 0).
+    Conditional and unconditional predictions share one forward pass over a doubled batch.
+    w is a (batch,) tensor of guidance weights; with all weights 0 only c is evaluated.
+    '''
+    if not (w != 0).any():
+        return model(x, t, c=c)
+    eps = model(torch.cat([x, x]), t, c=torch.cat([c, torch.zeros_like(c)]))
+    eps_c, eps_u = eps.chunk(2)
+    w = w[:, None, None, None]
+    return (1 + w) * eps_c - w * eps_u
+
+@torch.no_grad()
+def sample_ddpm_context(model, schedule, context, guidance, height, generator=None):
+    # x_T ~ N(0, 1), sample initial noise
+    n_sample = context.shape[0]
+    samples = torch.randn(n_sample, 3, height, height, device=schedule.device, generator=generator)
+    z = torch.empty_like(samples)
+    for i in range(schedule.timesteps, 0, -1):
+        eps = predict_noise(model, samples, schedule.t[i], context, guidance)
+        # sample some random noise to inject back in. For i = 1, don't add back in noise
+        if i > 1:
+            z.normal_(generator=generator)
+        else:
+            z.zero_()
+        samples = schedule.denoise_add_noise(samples, i, eps, z)
+    return samples
+
+@torch.no_grad()
+def sample_ddim_context(model, schedule, context, guidance, height, n=20, generator=None):
+    # x_T ~ N(0, 1), sample initial noise
+    n_sample = context.shape[0]
+    samples = torch.randn(n_sample, 3, height, height, device=schedule.device, generator=generator)
+    step_size = schedule.timesteps // n
+    for i in range(schedule.timesteps, 0, -step_size):
+        eps = predict_noise(model, samples, schedule.t[i], context, guidance)
+        samples = schedule.denoise_ddim(samples, i, max(i - step_size, 0), eps)
+    return samples
+
+
+class Generator:
+    '''
+    Batched conditional generation with a trained ContextUnet.
+
+    generate() takes any number of context vectors and guidance weights, forms every
+    (context, weight) pair, and runs them through the sampler in fixed-size batches so
+    memory stays bounded regardless of the request size. The noise schedule is built once
+    and reused by every call. With save_dir set, finished batches are streamed to disk
+    (one png per image and/or one npz per batch) instead of being accumulated.
+
+    usage:
+        gen = Generator(nn_model, height=16, batch_size=64, sampler="ddim", device=device)
+        images = gen.generate(gen_tst_context(n_cfeat)[1], guidance=[0., 2.])
+        gen.generate(contexts, guidance=2., save_dir="./samples/", fmt=("png", "npz"))
+    '''
+    def __init__(self, model, height=16, batch_size=64, sampler="ddim", n=20,
+                 timesteps=500, beta1=1e-4, beta2=0.02, device="cpu"):
+        assert sampler in ("ddpm", "ddim"), f"unknown sampler {sampler}"
+        self.model = model
+        self.height = height
+        self.batch_size = batch_size
+        self.sampler = sampler
+        self.n = n
+        self.device = torch.device(device)
+        self.schedule = get_schedule(timesteps, beta1, beta2, str(self.device))
+
+    def requests(self, contexts, guidance):
+        # every context paired with every guidance weight, context-major
+        contexts = torch.as_tensor(contexts, dtype=torch.float32)
+        if contexts.dim() == 1:
+            contexts = contexts[None]
+        guidance = torch.as_tensor(guidance, dtype=torch.float32).reshape(-1)
+        c = contexts.repeat_interleave(len(guidance), dim=0)
+        w = guidance.repeat(len(contexts))
+        return c, w
+
+    def sample(self, c, w, generator=None):
+        c, w = c.to(self.device), w.to(self.device)
+        if self.sampler == "ddpm":
+            return sample_ddpm_context(self.model, self.schedule, c, w, self.height, generator)
+        return sample_ddim_context(self.model, self.schedule, c, w, self.height, self.n, generator)
+
+    def generate(self, contexts, guidance=0.0, seed=None, save_dir=None, fmt="png", prefix="sample"):
+        '''
+        Returns (n_contexts * n_weights, 3, h, w) images in [-1, 1] on the cpu, or, when
+        save_dir is given, the list of files written.
+
+        The model is switched to eval mode for the call and put back in its previous mode
+        afterwards. With a seed the images are reproducible: the sampling noise comes from a
+        generator seeded with it, and the global random state (from which ResidualConvBlock
+        builds its shortcut convolution inside forward) is seeded too, inside a fork so the
+        caller's random state is left untouched.
+        '''
+        c, w = self.requests(contexts, guidance)
+        fmt = (fmt,) if isinstance(fmt, str) else tuple(fmt)
+        if save_dir is not None:
+            os.makedirs(save_dir, exist_ok=True)
+        was_training = self.model.training
+        self.model.eval()
+        devices = [self.device] if self.device.type == "cuda" else []
+        try:
+            with torch.random.fork_rng(devices=devices, enabled=seed is not None):
+                generator = None
+                if seed is not None:
+                    torch.manual_seed(seed)
+                    generator = torch.Generator(device=self.device).manual_seed(seed)
+                return self._generate(c, w, generator, save_dir, fmt, prefix)
+        finally:
+            self.model.train(was_training)
+
+    def _generate(self, c, w, generator, save_dir, fmt, prefix):
+        images, files = [], []
+        n_batches = (len(c) + self.batch_size - 1) // self.batch_size
+        for b, start in enumerate(range(0, len(c), self.batch_size)):
+            print(f'generating batch {b + 1} of {n_batches}', end='\r')
+            cb, wb = c[start:start + self.batch_size], w[start:start + self.batch_size]
+            x = self.sample(cb, wb, generator).cpu()
+            if save_dir is None:
+                images.append(x)
+            else:
+                files.extend(self.save(x, cb, wb, start, save_dir, fmt, prefix))
+        print()
+        if save_dir is None:
+            return torch.cat(images)
+        return files
+
+    @staticmethod
+    def save(x, c, w, start, save_dir, fmt, prefix):
+        files = []
+        if "png" in fmt:
+            # undo the [-1, 1] normalization of the training transform
+            imgs = (x.clamp(-1, 1) + 1) / 2
+            for j, (img, wj) in enumerate(zip(imgs, w)):
+                fn = os.path.join(save_dir, f"{prefix}_{start + j:06d}_w{wj.item():g}.png")
+                save_image(img, fn)
+                files.append(fn)
+        if "npz" in fmt:
+            fn = os.path.join(save_dir, f"{prefix}_{start:06d}.npz")
+            np.savez(fn, images=x.numpy(), context=c.numpy(), guidance=w.numpy(),
+                     index=np.arange(start, start + len(x)))
+            files.append(fn)
+        return files
+
@@ -0,0 +1,21 @@
+import torch
+
+from benchmark_sampling import benchmark
+from diffusion_utilities import ContextUnet
+
+
+def test_context_unet_shapes():
+    torch.manual_seed(0)
+    model = ContextUnet(3, n_feat=8, n_cfeat=5, height=16)
+    x = torch.randn(4, 3, 16, 16)
+    out = model(x, torch.rand(4, 1, 1, 1), c=torch.eye(5)[:4])
+    assert out.shape == x.shape
+    # no context is the unconditional model
+    assert model(x, torch.rand(4, 1, 1, 1)).shape == x.shape
+
+
+def test_benchmark_report():
+    result = benchmark(n_feat=8, height=16, batch_size=2, n_cfeat=5, timesteps=10, ddim_n=5, n_forward=2, seed=0)
+    assert set(result["block_ms"]) == {"UnetDown", "UnetUp", "ResidualConvBlock", "EmbedFC"}
+    assert result["ddpm"]["steps"] == 10 and result["ddim"]["steps"] == 5
+    assert result["forward_ms"] > 0 and result["n_params"] > 0
@@ -0,0 +1,32 @@
+import numpy as np
+import torch
+from torchvision.utils import make_grid
+
+from diffusion_utilities import norm_all, tile_frames, unorm
+
+
+def _unorm_loop(x):
+    # the per-image implementation the vectorized one replaced
+    xmax = x.max((0,1))
+    xmin = x.min((0,1))
+    return (x - xmin)/(xmax - xmin)
+
+
+def test_norm_all_matches_per_image_loop():
+    store = np.random.default_rng(0).normal(size=(4, 6, 8, 8, 3))
+    expected = np.zeros_like(store)
+    for t in range(3):
+        for s in range(5):
+            expected[t, s] = _unorm_loop(store[t, s])
+    assert np.allclose(norm_all(store, 3, 5), expected)
+    assert np.allclose(unorm(store[1, 2]), _unorm_loop(store[1, 2]))
+
+
+def test_tile_frames_matches_make_grid():
+    store = np.random.default_rng(1).uniform(size=(2, 6, 5, 7, 3))
+    frames = tile_frames(store, nrows=2)
+    for t in range(2):
+        grid = make_grid(torch.from_numpy(store[t]).permute(0, 3, 1, 2), nrow=3, padding=2)
+        expected = (grid.permute(1, 2, 0).numpy()*255).round().astype(np.uint8)
+        assert np.array_equal(frames[t], expected)
+    assert tile_frames(store, nrows=2, scale=2).shape == (2, 2*(10+2)+2, 3*(14+2)+2, 3)
@@ -0,0 +1,47 @@
+import copy
+
+import pytest
+import torch
+import torch.nn as nn
+
+from diffusion_utilities import ContextUnet
+from inference_utilities import InferenceUnet, check_inference, fold_batchnorm
+
+
+def _trained_unet():
+    torch.manual_seed(0)
+    model = ContextUnet(3, n_feat=8, n_cfeat=5, height=16)
+    # a few training-mode passes so the batchnorm running statistics are not the defaults
+    with torch.no_grad():
+        for _ in range(3):
+            model(2 * torch.randn(8, 3, 16, 16) + 1, torch.rand(8, 1, 1, 1), c=torch.eye(5)[torch.randint(0, 5, (8,))])
+    return model.eval()
+
+
+def _inputs():
+    torch.manual_seed(1)
+    return torch.randn(4, 3, 16, 16), torch.rand(4, 1, 1, 1), torch.eye(5)[:4]
+
+
+def test_fold_batchnorm_is_exact():
+    model = _trained_unet()
+    x, t, c = _inputs()
+    folded = fold_batchnorm(copy.deepcopy(model))
+    assert not any(isinstance(m, nn.BatchNorm2d) for m in folded.init_conv.modules())
+    assert folded.init_conv.get_out_channels() == 8
+    check_inference(model, folded, x, t, c=c, rtol=1e-5)
+    with pytest.raises(AssertionError):
+        fold_batchnorm(copy.deepcopy(model).train())
+
+
+@pytest.mark.parametrize("bf16", [False, True])
+def test_inference_unet(bf16):
+    model = _trained_unet()
+    x, t, c = _inputs()
+    fast = InferenceUnet(model, bf16=bf16)
+    rel_err, _ = check_inference(model, fast, x, t, c=c)
+    assert rel_err <= (5e-2 if bf16 else 1e-4)
+    out = fast(x, t, c=c)
+    assert out.dtype == torch.float32 and out.is_contiguous()
+    # the wrapped copy leaves the caller's model alone
+    assert any(isinstance(m, nn.BatchNorm2d) for m in model.modules())
@@ -0,0 +1,35 @@
+import torch
+
+from diffusion_utilities import ContextUnet
+from sampling_utilities import Generator
+
+
+def _generator(sampler="ddim"):
+    torch.manual_seed(0)
+    model = ContextUnet(3, n_feat=8, n_cfeat=5, height=16)
+    return Generator(model, height=16, batch_size=4, sampler=sampler, n=5, timesteps=20)
+
+
+def test_generate_seed_is_reproducible():
+    gen = _generator()
+    contexts = torch.eye(5)[:3]
+    first = gen.generate(contexts, guidance=[0., 2.], seed=0)
+    torch.manual_seed(123)
+    second = gen.generate(contexts, guidance=[0., 2.], seed=0)
+    assert first.shape == (6, 3, 16, 16)
+    assert torch.equal(first, second)
+    assert not torch.equal(first, gen.generate(contexts, guidance=[0., 2.], seed=1))
+
+
+def test_generate_leaves_caller_state_alone():
+    gen = _generator("ddpm")
+    assert gen.model.training
+    torch.manual_seed(5)
+    expected = torch.rand(3)
+    torch.manual_seed(5)
+    gen.generate(torch.eye(5)[:1], seed=0)
+    assert gen.model.training
+    assert torch.equal(torch.rand(3), expected)
+    gen.model.eval()
+    gen.generate(torch.eye(5)[:1])
+    assert not gen.model.training
@@ -0,0 +1,67 @@
+import pytest
+import torch
+import torch.nn as nn
+
+from training_utilities import EMA, Checkpointer
+
+
+def _model():
+    return nn.Sequential(nn.Linear(4, 8), nn.BatchNorm1d(8), nn.Linear(8, 1))
+
+
+def _step(model, optim):
+    x = torch.randn(16, 4)
+    loss = model(x).pow(2).mean()
+    optim.zero_grad()
+    loss.backward()
+    optim.step()
+
+
+@pytest.mark.parametrize("fused", [True, False])
+def test_ema_update(monkeypatch, fused):
+    if not fused:
+        monkeypatch.delattr(torch, "_foreach_lerp_")
+    torch.manual_seed(0)
+    model = _model()
+    ema = EMA(model, decay=0.9, warmup=1)
+    expected = [p.detach().clone() for p in model.parameters()]
+    optim = torch.optim.SGD(model.parameters(), lr=0.1)
+    for i in range(3):
+        _step(model, optim)
+        ema.update(model)
+        decay = 0.0 if i == 0 else 0.9
+        expected = [decay * e + (1 - decay) * p.detach() for e, p in zip(expected, model.parameters())]
+    for e, p in zip(expected, ema.model.parameters()):
+        assert torch.allclose(e, p)
+    for b, e in zip(model.buffers(), ema.model.buffers()):
+        assert torch.equal(b, e)
+
+
+def test_checkpoint_resume_is_exact(tmp_path):
+    torch.manual_seed(0)
+    model = _model()
+    optim = torch.optim.Adam(model.parameters(), lr=1e-2)
+    ema = EMA(model)
+    ckpt = Checkpointer(str(tmp_path), every=2, keep=1)
+    assert ckpt.extra == {} and ckpt.resumed_from is None
+    for step in range(1, 7):
+        _step(model, optim)
+        ema.update(model)
+        ckpt.maybe_save(step, model, optim, ema, epoch=step // 2)
+    ckpt.wait()
+    assert ckpt.checkpoints() == [ckpt.path(6)]
+    # the interrupted run goes on from the random state of the last checkpoint
+    _step(model, optim)
+
+    resumed = _model()
+    resumed_optim = torch.optim.Adam(resumed.parameters(), lr=1e-2)
+    resumed_ema = EMA(resumed)
+    assert ckpt.resume(resumed, resumed_optim, resumed_ema) == 6
+    assert ckpt.resumed_from == ckpt.path(6) and ckpt.extra == {"epoch": 3}
+    for a, b in zip(ema.model.state_dict().values(), resumed_ema.model.state_dict().values()):
+        assert torch.equal(a, b)
+    _step(resumed, resumed_optim)
+    for a, b in zip(model.state_dict().values(), resumed.state_dict().values()):
+        assert torch.equal(a, b)
+
+    assert Checkpointer(str(tmp_path / "empty")).resume(_model()) == 0
@@ -0,0 +1,207 @@
+import copy
+import glob
+import os
+import random
+import re
+import threading
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+
+class EMA:
+    '''
+    Exponential moving average of the weights of a model.
+
+    Keeps a frozen copy of the model whose parameters are updated in place after every
+    optimizer step with ema = decay * ema + (1 - decay) * param. Where torch has the fused
+    foreach lerp the update is one kernel launch per step instead of one per tensor;
+    otherwise it falls back to an in-place lerp per parameter. The averaged copy (`ema.model`) is the one to sample from.
+
+    usage:
+        ema = EMA(nn_model, decay=0.999)
+        ...
+        optim.step()
+        ema.update(nn_model)
+    '''
+    def __init__(self, model: nn.Module, decay: float = 0.999, warmup: int = 0) -> None:
+        self.decay = decay
+        # number of updates during which the average just tracks the live weights
+        self.warmup = warmup
+        self.num_updates = 0
+        self.model = copy.deepcopy(model).eval()
+        self.model.requires_grad_(False)
+
+    @torch.no_grad()
+    def update(self, model: nn.Module) -> None:
+        self.num_updates += 1
+        decay = 0.0 if self.num_updates <= self.warmup else self.decay
+        ema_params = [p for p in self.model.parameters()]
+        params = [p.detach() for p in model.parameters()]
+        # ema + (1 - decay) * (param - ema), in place over the whole parameter list
+        _lerp_(ema_params, params, 1.0 - decay)
+        # batchnorm running statistics are already averages; copy them over as is
+        for ema_b, b in zip(self.model.buffers(), model.buffers()):
+            ema_b.copy_(b)
+
+    def state_dict(self):
+        return {
+            "model": self.model.state_dict(),
+            "decay": self.decay,
+            "warmup": self.warmup,
+            "num_updates": self.num_updates,
+        }
+
+    def load_state_dict(self, state):
+        self.model.load_state_dict(state["model"])
+        self.decay = state["decay"]
+        self.warmup = state["warmup"]
+        self.num_updates = state["num_updates"]
+
+
+def _lerp_(targets, sources, weight):
+    # torch._foreach_lerp_ is private, so keep a plain loop for versions without it
+    if hasattr(torch, "_foreach_lerp_"):
+        torch._foreach_lerp_(targets, sources, weight)
+    else:
+        for t, s in zip(targets, sources):
+            t.lerp_(s, weight)
+
+
+def get_rng_state():
+    # capture every random number generator a training loop touches
+    state = {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+def set_rng_state(state):
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+def to_cpu(obj):
+    # detached cpu copy of a (nested) state dict, safe to serialize while training goes on
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {k: to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return copy.deepcopy(obj)
+
+
+class Checkpointer:
+    '''
+    Periodic, asynchronous checkpoints of a training run.
+
+    A checkpoint holds the model, the EMA weights, the optimizer, the step (and any extra
+    values such as the epoch) and the state of all random number generators. A run resumed
+    from a checkpoint taken at the end of an epoch continues exactly like the interrupted
+    one; the position of the DataLoader is not saved, so from a checkpoint taken mid-epoch
+    the resumed run restarts that epoch's iteration with a new shuffle (pick `every` as a
+    multiple of the batches per epoch for exact resumes). The state is copied to
+    cpu on the calling thread and written to disk by a background thread; files are written
+    to a temporary name and renamed, so a crash never leaves a truncated checkpoint behind.
+
+    usage:
+        ckpt = Checkpointer(save_dir, every=1000)
+        step = ckpt.resume(nn_model, optim, ema)  # 0 when there is nothing to resume
+        ...
+        step += 1
+        ckpt.maybe_save(step, nn_model, optim, ema, epoch=ep)
+        ...
+        ckpt.wait()
+    '''
+    def __init__(self, save_dir, every=1000, keep=3, prefix="ckpt"):
+        if keep < 1:
+            raise ValueError("keep must be at least 1")
+        self.save_dir = save_dir
+        self.every = every
+        self.keep = keep
+        self.prefix = prefix
+        # extra values and path of the last resumed checkpoint
+        self.extra = {}
+        self.resumed_from = None
+        self._thread = None
+        self._error = None
+        os.makedirs(save_dir, exist_ok=True)
+
+    def path(self, step):
+        return os.path.join(self.save_dir, f"{self.prefix}_{step:08d}.pth")
+
+    def checkpoints(self):
+        # existing checkpoints, oldest first
+        pattern = re.compile(re.escape(self.prefix) + r"_(\d+)\.pth$")
+        paths = glob.glob(os.path.join(self.save_dir, f"{self.prefix}_*.pth"))
+        return sorted(p for p in paths if pattern.search(p))
+
+    def latest(self):
+        paths = self.checkpoints()
+        return paths[-1] if paths else None
+
+    def maybe_save(self, step, model, optim, ema=None, **extra):
+        if step % self.every == 0:
+            self.save(step, model, optim, ema, **extra)
+
+    def save(self, step, model, optim, ema=None, **extra):
+        # only one write in flight; wait for the previous one before taking a new snapshot
+        self.wait()
+        state = {
+            "step": step,
+            "model": to_cpu(model.state_dict()),
+            "optim": to_cpu(optim.state_dict()),
+            "ema": None if ema is None else to_cpu(ema.state_dict()),
+            "rng": get_rng_state(),
+            "extra": extra,
+        }
+        self._thread = threading.Thread(target=self._write, args=(state, self.path(step)), daemon=True)
+        self._thread.start()
+
+    def _write(self, state, path):
+        try:
+            tmp = path + ".tmp"
+            torch.save(state, tmp)
+            os.replace(tmp, path)
+            paths = self.checkpoints()
+            for old in paths[:len(paths) - self.keep]:
+                os.remove(old)
+        except Exception as e:
+            self._error = e
+
+    def wait(self):
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def resume(self, model, optim=None, ema=None, path=None, map_location=None):
+        '''
+        Restores the latest (or the given) checkpoint in place and returns its step, or 0 if
+        there is no checkpoint to resume from. Extra values are available as `self.extra` and
+        the path of the checkpoint as `self.resumed_from`.
+        '''
+        self.extra = {}
+        self.resumed_from = None
+        path = path or self.latest()
+        if path is None:
+            return 0
+        state = torch.load(path, map_location=map_location, weights_only=False)
+        model.load_state_dict(state["model"])
+        if optim is not None:
+            optim.load_state_dict(state["optim"])
+        if ema is not None and state["ema"] is not None:
+            ema.load_state_dict(state["ema"])
+        set_rng_state(state["rng"])
+        self.extra = state["extra"]
+        self.resumed_from = path
+        return state["step"]
@@ -21,11 +21,11 @@ from pyro.optim import Adam, SGD
 from pyro.infer.autoguide import AutoMultivariateNormal, init_to_mean, AutoNormal, AutoLaplaceApproximation
 
 from pyro.infer.mcmc.api import MCMC, NUTS
+from mcmc import run_chains
 from utils import HPDI, precis, conditional_independencies, conditional_independencies_v2, find_adjustment_sets, marginal_independencies
 #seed = 43
 #np.random.seed(seed)
 #pyro.set_rng_seed(seed)
-torch.multiprocessing.set_sharing_strategy('file_system')
 
 class LegSim:
     def __init__(self, df):
@@ -78,10 +78,8 @@ if __name__ == "__main__":
 
 
     m6_1_mcmc = LegSim(df)
-    nuts_kernel = NUTS(m6_1_mcmc)
-
-    mcmc = MCMC(nuts_kernel, num_samples=200, warmup_steps=100, num_chains=25, mp_context='spawn')
-    mcmc.run()
+    # the 25 chains advance together in one process
+    mcmc = run_chains(m6_1_mcmc, (), {}, num_warmup=100, num_samples=200, num_chains=25, chain_method="vectorized")
 
     hmc_samples = {k: v.detach().cpu().numpy() for k, v in mcmc.get_samples().items()}
     print(hmc_samples["a"].shape, hmc_samples["bl"].shape, hmc_samples["br"].shape, hmc_samples["sigma"].shape)
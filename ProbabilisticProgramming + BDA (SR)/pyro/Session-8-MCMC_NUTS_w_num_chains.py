@@ -1,3 +1,4 @@
+import os
 import sys
 import time
 from collections import deque
@@ -21,13 +22,17 @@ from pyro.optim import Adam, SGD
 from pyro.infer.autoguide import AutoMultivariateNormal, init_to_mean, init_to_value, AutoNormal, AutoLaplaceApproximation
 
 from pyro.infer.mcmc.api import MCMC, NUTS
+from pyro.ops.indexing import Vindex
 
+from mcmc import run_chains, run_checkpointed
 from models import RegressionBase
 from utils import HPDI, precis, sample_posterior, conditional_independencies, conditional_independencies_v2, find_adjustment_sets, marginal_independencies
+# opt in with CHECKPOINT_DIR=checkpoints python Session-8-MCMC_NUTS_w_num_chains.py
+CHECKPOINT_DIR = os.environ.get("CHECKPOINT_DIR")
+
 #seed = 43
 #np.random.seed(seed)
 #pyro.set_rng_seed(seed)
-torch.multiprocessing.set_sharing_strategy('file_system')
 
 class M8_5(RegressionBase):
     def __call__(self, data=None):
@@ -91,7 +96,8 @@ def model_m9_1(data, training=False):
     b = pyro.sample("b", Normal(0., 0.3).expand([2]).to_event(1))
     sigma = pyro.sample("sigma", Exponential(1.))
     A = data["cid"]
-    mu = a[A] + b[A] * (data["rugged_std"] - 0.215)
+    # Vindex keeps any batch (chain) dims of a and b to the left, so the model vectorizes over chains
+    mu = Vindex(a)[..., A] + Vindex(b)[..., A] * (data["rugged_std"] - 0.215)
     if training:
         with pyro.plate("N"):
             pyro.sample("log_gdp_std", Normal(mu, sigma), obs=data["log_gdp_std"])
@@ -171,11 +177,23 @@ def format_data(df, categoricals=None):
         data[col] = tt(df[col].values).long()
     return data
 
-def train_nuts(model, data, num_warmup, num_samples, num_chains=1, mp_context='spawn'):
-    kernel = NUTS(model, adapt_step_size=False, adapt_mass_matrix=True, jit_compile=True)
-    engine = MCMC(kernel, num_samples, num_warmup, num_chains=num_chains, mp_context=mp_context)
-    engine.run(data, training=True)
-    return engine
+def train_nuts(model, data, num_warmup, num_samples, num_chains=1, chain_method="vectorized", checkpoint=None):
+    # chains share one process (or, for models that do not vectorize, a persistent pool)
+    # instead of spawning a process per chain on every call; pool workers import the model
+    # by name, which is why the models live at module level and the script under __main__
+    kernel_kwargs = dict(adapt_step_size=False, adapt_mass_matrix=True, jit_compile=True)
+    if checkpoint is not None and CHECKPOINT_DIR:
+        # saved every 100 draws; a rerun resumes (or extends) the run instead of starting over,
+        # unless the model or data changed
+        os.makedirs(CHECKPOINT_DIR, exist_ok=True)
+        result = run_checkpointed(model, (data,), {"training": True}, num_warmup, num_samples, num_chains,
+                                  os.path.join(CHECKPOINT_DIR, checkpoint), **kernel_kwargs)
+    else:
+        result = run_chains(model, (data,), {"training": True}, num_warmup, num_samples, num_chains, chain_method,
+                            **kernel_kwargs)
+    # the compiled potential is cached, so refits on data of the same shape report ~0 s compile time
+    print(f"{model.__name__}: " + ", ".join(f"{k} {v:.1f} s" for k, v in result.timings.items()))
+    return result
 
 def trankplot(s, num_chains):
     fig, axes = plt.subplots(nrows=len(s), figsize=(12, len(s)*num_chains))
@@ -226,7 +244,7 @@ if __name__ == "__main__":
     print(f"Starting M9_1 {num_chains}-chain")
     data = format_data(dd[["log_gdp_std", "rugged_std", "cid"]], categoricals=("cid",))
 
-    m9_1 = train_nuts(model_m9_1, data, 1000, 1000, num_chains) # I should have 4 cpu's, but pyro only recognizes 3...
+    m9_1 = train_nuts(model_m9_1, data, 1000, 1000, num_chains, checkpoint="m9_1.pkl") # I should have 4 cpu's, but pyro only recognizes 3...
     
     samples["m9.1"] = {k: v.numpy() for k, v in m9_1.get_samples().items()}
     s = samples["m9.1"]
@@ -261,7 +279,7 @@ if __name__ == "__main__":
 
     print(f"Starting M9_2 {num_chains}-chain")
     data = {"y": tt([-1., 1.])}
-    m9_2 = train_nuts(model_m9_2, data, 1000, 1000, num_chains)
+    m9_2 = train_nuts(model_m9_2, data, 1000, 1000, num_chains, checkpoint="m9_2.pkl")
     print(m9_2.summary())
     s = {k: v.numpy() for k, v in m9_2.get_samples(group_by_chain=True).items()}
     traceplot(s, num_chains)
@@ -275,7 +293,7 @@ if __name__ == "__main__":
 
     print(f"Starting M9_3 {num_chains}-chain")
     data = {"y": tt([-1., 1.])}
-    m9_3 = train_nuts(model_m9_3, data, 1000, 1000, num_chains)
+    m9_3 = train_nuts(model_m9_3, data, 1000, 1000, num_chains, checkpoint="m9_3.pkl")
     print(m9_3.summary())
     traceplot(m9_3.get_samples(group_by_chain=True), num_chains)
     plt.show()
@@ -287,7 +305,7 @@ if __name__ == "__main__":
     plt.show()
     
     print(f"Starting M9_4 {num_chains}-chain")
-    m9_4 = train_nuts(model_m9_4, data, 1000, 1000, num_chains)
+    m9_4 = train_nuts(model_m9_4, data, 1000, 1000, num_chains, checkpoint="m9_4.pkl")
     print(m9_4.summary())
     traceplot(m9_4.get_samples(group_by_chain=True), num_chains)
     plt.show()
@@ -299,7 +317,7 @@ if __name__ == "__main__":
     plt.show()
 
     print(f"Starting M9_5 {num_chains}-chain")
-    m9_5 = train_nuts(model_m9_5, data, 2000, 2000, num_chains)
+    m9_5 = train_nuts(model_m9_5, data, 2000, 2000, num_chains, checkpoint="m9_5.pkl")
     print(m9_5.summary())
     traceplot(m9_5.get_samples(group_by_chain=True), num_chains)
     plt.show()
@@ -311,7 +329,7 @@ if __name__ == "__main__":
     plt.show()
     
     print(f"Starting M9_6 {num_chains}-chain")
-    m9_6 = train_nuts(model_m9_6, data, 1000, 1000, num_chains)
+    m9_6 = train_nuts(model_m9_6, data, 1000, 1000, num_chains, checkpoint="m9_6.pkl")
     print(m9_6.summary())
     traceplot(m9_6.get_samples(group_by_chain=True), num_chains)
     plt.show()
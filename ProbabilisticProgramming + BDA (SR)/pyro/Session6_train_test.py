@@ -1,4 +1,4 @@
-import concurrent.futures
+import functools
 
 import numpy as np
 import pandas as pd
@@ -16,22 +16,25 @@ from pyro.nn import PyroModule
 from pyro import poutine
 
 from models import RegressionBase
-from utils import sample_posterior, precis, HPDI, plot_intervals, conditional_independencies, marginal_independencies, conditional_independencies_v2
+from simulation import SimulationGrid
+from utils import sample_posterior, precis, HPDI, plot_intervals, conditional_independencies, marginal_independencies, conditional_independencies_v2, sample_guide, log_likelihood, lppd_pointwise
 
 class Fig7_6(RegressionBase):
     def __init__(self, df, n_feat):
-        super().__init__(df)
+        # X is (N, n_feat), or (K, N, n_feat) for K replicates
+        super().__init__(df, design=[f"x{i}" for i in range(n_feat)])
         self.n_feat = n_feat
-        self.X = torch.stack([getattr(self, f"x{i}") for i in range(n_feat)])
     
     def __call__(self, X=None):
         beta = pyro.sample("beta", Normal(0., 1.0).expand([self.n_feat]).to_event(1)).double()
         if X is None:
-            mu = torch.matmul(beta, self.X)
+            # broadcasts over replicates, whose beta is (K, 1, n_feat)
+            mu = (self.X * beta).sum(-1)
             with pyro.plate("N"):
                 pyro.sample("y", Normal(mu, 1.0), obs=self.y)
         else:
-            mu = torch.matmul(X, beta)
+            # broadcasts over the draws plate, where beta is (S, 1, n_feat)
+            mu = (X * beta).sum(-1)
             pyro.sample("y", Normal(mu, 1.0))
             
 def gen_data(n_feat, N):
@@ -41,75 +44,82 @@ def gen_data(n_feat, N):
     return X[:,:n_feat], y
 
 def LPPD(model, x, y, out_var_nm, num_samples=100):
-    logp = torch.zeros((num_samples, len(x)))
-    for i in range(num_samples):
-        tr = poutine.trace(poutine.condition(model, data=model.guide())).get_trace(x)
-        logp[i] = tr.nodes[out_var_nm]["fn"].log_prob(y).detach()
-    logpmax = logp.max(axis=0).values # logp = log probabilities of each observation
+    # all guide draws are evaluated in a single vectorized trace
+    samples = sample_guide(model.guide, num_samples)
+    logp = log_likelihood(model, samples, {out_var_nm: y}, x) # logp = log probabilities of each observation
     # we are using mean instead of sum in log-sum-exp trick because of the LPPD formula.
-    lppd = logpmax + (logp - logpmax).exp().mean(axis=0).log() # numerically stable version
-    return lppd
+    return lppd_pointwise(logp)
 
-def train_test(i):
-    # Generate training data
+def gen_frame(n_feat, N):
     X, y = gen_data(n_feat, N)
     X = np.concatenate([X, y[:,None]], axis=1)
-    d = pd.DataFrame(X, columns=[f"x{i}" for i in range(n_feat)] + ["y"])
+    return pd.DataFrame(X, columns=[f"x{i}" for i in range(n_feat)] + ["y"])
+
+def train_test(N, n_feat):
+    # Generate training data
+    d = gen_frame(n_feat, N)
     # Train model
     model = Fig7_6(d, n_feat=n_feat)
     loss = model.train(2000, autoguide="AutoDiagonalNormal", use_tqdm=False)
     # Get in-sample deviance
-    lppd_train = LPPD(model, model.X.T, tt(y), "y", 100).sum().item()
+    lppd_train = LPPD(model, model.X, model.y, "y", 100).sum().item()
     # Get out-of-sample deviance
     X, y = gen_data(n_feat, N)
     lppd_test = LPPD(model, tt(X), tt(y), "y", 100).sum().item()
     return -2*lppd_train, -2*lppd_test
 
+def train_test_replicates(N, n_feat, num_replicates=100):
+    # num_replicates runs of train_test, fitted together as replicates of one model
+    # (AutoNormal is the same mean-field family as AutoDiagonalNormal)
+    model = Fig7_6([gen_frame(n_feat, N) for _ in range(num_replicates)], n_feat=n_feat)
+    loss = model.train(2000, autoguide="AutoNormal", use_tqdm=False)
+    samples = sample_guide(model.guide, 100)
+    test = Fig7_6([gen_frame(n_feat, N) for _ in range(num_replicates)], n_feat=n_feat)
+    # in-sample and out-of-sample deviance of every replicate, (num_replicates, 2)
+    deviance = [-2*lppd_pointwise(log_likelihood(m, samples, {"y": m.y})).sum(-1) for m in (model, test)]
+    return torch.stack(deviance, dim=-1).numpy()
+
 
-deviance = {
-    n: {
-        "in": {i: [] for i in range(1, 6)},
-        "out": {i: [] for i in range(1, 6)},
-    } for n in (20, 100)
-}
-num_simulations = 10000
-pbar = tqdm.trange(2*5*num_simulations)
-for N in (20, 100):
-    # Loop over number of features to use
-    for n_feat in range(1, 6):
-        # Loop over simulations
-        # doing it in parallel
-        with concurrent.futures.ProcessPoolExecutor(max_workers=18) as pool:
-            deviance_train, deviance_test = zip(*pool.map(train_test, range(num_simulations)))
-            deviance[N]["in"][n_feat].extend(deviance_train)
-            deviance[N]["out"][n_feat].extend(deviance_test)
-        pbar.update(num_simulations)
-pbar.close()
+if __name__ == "__main__":
+    num_simulations = 10000
+    num_replicates = 100
+    grid = [dict(N=N, n_feat=n_feat) for N in (20, 100) for n_feat in range(1, 6)]
+    # one pool for the whole grid, each task fitting num_replicates simulations at once;
+    # running mean/std per (N, n_feat) instead of every result, saved as chunks finish so
+    # an interrupted run picks up where it stopped
+    runner = SimulationGrid(functools.partial(train_test_replicates, num_replicates=num_replicates), grid,
+                            num_simulations // num_replicates, chunk_size=1, max_workers=18,
+                            checkpoint="session6_deviance.pkl", batched=True)
+    pbar = tqdm.trange(len(grid)*num_simulations, initial=runner.num_done())
+    stats = runner.run(progress=pbar.update)
+    runner.close()
+    pbar.close()
 
-fig, axes = plt.subplots(ncols=2, figsize=(12, 6))
+    fig, axes = plt.subplots(ncols=2, figsize=(12, 6))
 
-for (N, d1), ax in zip(deviance.items(), axes):
-    plt.sca(ax)
-    plt.xlabel("number of parameters")
-    plt.ylabel("deviance")
-    plt.title(f"N = {N}")
-    for in_out, d2 in d1.items():
-        options = dict(
-            color = "C0" if (in_out == "in") else "black",
-            edgecolor = "C0" if (in_out == "in") else "black",
-            facecolor = "C0" if (in_out == "in") else "none",
-        )
-        offset = 0 if (in_out == "in") else 0.25
-        for n_feat, sample in d2.items():
-            mean = np.mean(sample)
-            std = np.std(sample)
-            plt.scatter([n_feat+offset], [mean], **options)
-            x = 2*[n_feat + offset]
-            y = [mean + std, mean - std]
-            plt.plot(x, y, color=options["color"])
+    for N, ax in zip((20, 100), axes):
+        plt.sca(ax)
+        plt.xlabel("number of parameters")
+        plt.ylabel("deviance")
+        plt.title(f"N = {N}")
+        for j, in_out in enumerate(("in", "out")):
+            options = dict(
+                color = "C0" if (in_out == "in") else "black",
+                edgecolor = "C0" if (in_out == "in") else "black",
+                facecolor = "C0" if (in_out == "in") else "none",
+            )
+            offset = 0 if (in_out == "in") else 0.25
+            for n_feat in range(1, 6):
+                s = stats[(("N", N), ("n_feat", n_feat))]
+                mean = s.mean[j]
+                std = s.std()[j]
+                plt.scatter([n_feat+offset], [mean], **options)
+                x = 2*[n_feat + offset]
+                y = [mean + std, mean - std]
+                plt.plot(x, y, color=options["color"])
+        plt.legend()
+    plt.plot([], [], color="C0", label="in")
+    plt.plot([], [], color="black", label="out")
+    fig.suptitle("In/out of sample deviance with increasing # of parameters", fontsize=20)
     plt.legend()
-plt.plot([], [], color="C0", label="in")
-plt.plot([], [], color="black", label="out")
-fig.suptitle("In/out of sample deviance with increasing # of parameters", fontsize=20)
-plt.legend()
-plt.show()
+    plt.show()
@@ -0,0 +1,122 @@
+"""
+Chain throughput of the ways to run several NUTS chains.
+
+For every number of chains runs the same model and data with
+    - mcmc:        MCMC(..., num_chains=k, mp_context='spawn'), fresh processes per run
+    - pool (cold): the persistent ChainPool, including starting its workers
+    - pool (warm): a second run on the already started pool
+    - vectorized:  VectorizedNUTS, all chains batched in this process
+and reports wall time, draws per second and the smallest effective sample size per
+second over the latent sites, as JSON.
+
+usage:
+    python benchmark_chains.py --num-chains 4 16 --num-warmup 300 --num-samples 500 --out bench.json
+"""
+import argparse
+import json
+import platform
+import time
+
+import torch
+import pyro
+import pyro.ops.stats as stats
+from pyro.distributions import Normal, Exponential
+from pyro.infer.mcmc import NUTS, MCMC
+
+from mcmc import ChainPool, VectorizedNUTS
+
+
+def model(data, training=False):
+    # the regression of model_legsim (Session 8) on simulated data
+    a = pyro.sample("a", Normal(10., 100.))
+    b = pyro.sample("b", Normal(2., 10.))
+    sigma = pyro.sample("sigma", Exponential(1.))
+    mu = a + b * data["x"]
+    with pyro.plate("N"):
+        return pyro.sample("y", Normal(mu, sigma), obs=data["y"] if training else None)
+
+
+def simulate(n):
+    x = torch.randn(n).double()
+    return {"x": x, "y": 1 + 2 * x + 0.5 * torch.randn(n).double()}
+
+
+def min_ess(samples):
+    # samples grouped by chain: (chains, draws, ...)
+    return min(stats.effective_sample_size(v.double(), chain_dim=0, sample_dim=1).min().item()
+               for v in samples.values())
+
+
+def timed(run):
+    start = time.perf_counter()
+    samples = run()
+    seconds = time.perf_counter() - start
+    return {"seconds": seconds, "min_ess": min_ess(samples), "min_ess_per_s": min_ess(samples) / seconds}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--num-chains", type=int, nargs="+", default=[4, 16])
+    parser.add_argument("--num-warmup", type=int, default=300)
+    parser.add_argument("--num-samples", type=int, default=500)
+    parser.add_argument("--num-data", type=int, default=100)
+    parser.add_argument("--num-workers", type=int, default=None)
+    parser.add_argument("--methods", nargs="+", default=["mcmc", "pool", "vectorized"])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default="bench_chains.json")
+    args = parser.parse_args(argv)
+
+    pyro.set_rng_seed(args.seed)
+    data = simulate(args.num_data)
+    run_args = (data,)
+    run_kwargs = {"training": True}
+    results = []
+    for k in args.num_chains:
+        r = {"num_chains": k}
+        if "mcmc" in args.methods:
+            def run():
+                engine = MCMC(NUTS(model, jit_compile=True), args.num_samples, args.num_warmup, num_chains=k,
+                              mp_context="spawn", disable_progbar=True)
+                engine.run(*run_args, **run_kwargs)
+                return engine.get_samples(group_by_chain=True)
+            r["mcmc"] = timed(run)
+        if "pool" in args.methods:
+            pool = ChainPool(args.num_workers)
+            def run():
+                result = pool.run(model, run_args, run_kwargs, args.num_warmup, args.num_samples, k, jit_compile=True)
+                return result.get_samples(group_by_chain=True)
+            r["pool_cold"] = timed(run)
+            r["pool_warm"] = timed(run)
+            pool.shutdown()
+        if "vectorized" in args.methods:
+            def run():
+                sampler = VectorizedNUTS(model, k, jit_compile=True)
+                sampler.setup(*run_args, **run_kwargs)
+                return sampler.run(args.num_warmup, args.num_samples).get_samples(group_by_chain=True)
+            r["vectorized"] = timed(run)
+        draws = k * args.num_samples
+        for method, m in r.items():
+            if method != "num_chains":
+                m["draws_per_s"] = draws / m["seconds"]
+        print(f"{k:3d} chains: " + ", ".join(
+            f"{method} {m['seconds']:.1f} s ({m['min_ess_per_s']:.0f} ess/s)"
+            for method, m in r.items() if method != "num_chains"))
+        results.append(r)
+
+    report = {
+        "torch": torch.__version__,
+        "pyro": pyro.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "num_warmup": args.num_warmup,
+        "num_samples": args.num_samples,
+        "num_data": args.num_data,
+        "results": results,
+    }
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"saved results at {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,294 @@
+import collections
+import itertools
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+
+import networkx as nx
+import pandas as pd
+
+
+def _bits(mask):
+    """Yields the indices of the set bits of an integer bitset"""
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+class DSeparation:
+    """d-separation oracle for a DAG, built for many repeated queries
+
+    Nodes are numbered once and every node set is an integer bitset. Parents,
+    children, ancestors and descendants of every node are precomputed, and a query
+    runs the Bayes-ball reachability algorithm (Koller & Friedman, Alg. 3.1) over
+    the bitsets. Its result, the set of nodes d-connected to ``x`` given ``Z``, is
+    cached per (x, Z), so all queries that share a source and a conditioning set
+    cost one traversal.
+    Arguments:
+        G (nx.DiGraph): the DAG
+    """
+    def __init__(self, G):
+        self.G = G
+        self.nodes = list(G.nodes)
+        self.index = {n: i for i, n in enumerate(self.nodes)}
+        self.parents = [self.mask(G.predecessors(n)) for n in self.nodes]
+        self.children = [self.mask(G.successors(n)) for n in self.nodes]
+        self.ancestors = [0] * len(self.nodes)
+        self.descendants = [0] * len(self.nodes)
+        for n in nx.topological_sort(G):
+            i = self.index[n]
+            for p in _bits(self.parents[i]):
+                self.ancestors[i] |= self.ancestors[p] | (1 << p)
+        for n in reversed(list(nx.topological_sort(G))):
+            i = self.index[n]
+            for c in _bits(self.children[i]):
+                self.descendants[i] |= self.descendants[c] | (1 << c)
+        self._reachable = dict()
+
+    def mask(self, nodes):
+        """Bitset of the given nodes"""
+        m = 0
+        for n in nodes:
+            m |= 1 << self.index[n]
+        return m
+
+    def members(self, mask):
+        """Nodes in a bitset, in the graph's node order"""
+        return [self.nodes[i] for i in _bits(mask)]
+
+    def ancestral_closure(self, mask):
+        """Bitset of the given nodes together with all their ancestors"""
+        out = mask
+        for i in _bits(mask):
+            out |= self.ancestors[i]
+        return out
+
+    def reachable(self, x, z_mask):
+        """Bitset of the nodes d-connected to node index ``x`` given the bitset ``z_mask``"""
+        key = (x, z_mask)
+        if key in self._reachable:
+            return self._reachable[key]
+        # nodes with a descendant (or themselves) in Z; colliders there are open
+        a_mask = self.ancestral_closure(z_mask)
+        up, down = 1 << x, 0                  # frontier arriving from a child / from a parent
+        seen_up, seen_down = 0, 0
+        while True:
+            up &= ~seen_up
+            down &= ~seen_down
+            if not (up or down):
+                break
+            seen_up |= up
+            seen_down |= down
+            next_up, next_down = 0, 0
+            for i in _bits(up & ~z_mask):
+                next_up |= self.parents[i]
+                next_down |= self.children[i]
+            for i in _bits(down & ~z_mask):
+                next_down |= self.children[i]
+            for i in _bits(down & a_mask):
+                next_up |= self.parents[i]
+            up, down = next_up, next_down
+        reach = (seen_up | seen_down) & ~z_mask
+        self._reachable[key] = reach
+        return reach
+
+    def d_separated(self, x, y, z=()):
+        """Whether the nodes ``x`` and ``y`` are d-separated given the nodes ``z``"""
+        z_mask = self.mask(z)
+        return not (self.reachable(self.index[x], z_mask) >> self.index[y]) & 1
+
+    def minimal_separators(self, x, y, candidates=None):
+        """All minimal sets (drawn from ``candidates``) that d-separate x and y
+
+        Candidate sets are enumerated by increasing size and supersets of sets already
+        found are skipped, so the result lists every minimal separator exactly once.
+        Minimal separators only contain ancestors of x and y, so only those candidates
+        are enumerated.
+        Arguments:
+            x, y: nodes
+            candidates (bitset): nodes allowed in a separator (default: all others)
+        Returns:
+            List[int]: separators as bitsets, in enumeration order
+        """
+        ix, iy = self.index[x], self.index[y]
+        if (self.parents[ix] | self.children[ix]) >> iy & 1:
+            return []
+        if candidates is None:
+            candidates = (1 << len(self.nodes)) - 1
+        candidates &= self.ancestors[ix] | self.ancestors[iy]
+        candidates &= ~((1 << ix) | (1 << iy))
+        # sorted like the original enumeration over sorted(G.nodes)
+        remaining = sorted(_bits(candidates), key=lambda i: self.nodes[i])
+        separators = []
+        for size in range(len(remaining) + 1):
+            for subset in itertools.combinations(remaining, size):
+                z_mask = 0
+                for i in subset:
+                    z_mask |= 1 << i
+                if any(s & ~z_mask == 0 for s in separators):
+                    continue
+                if not (self.reachable(ix, z_mask) >> iy) & 1:
+                    separators.append(z_mask)
+        return separators
+
+    def conditional_independencies(self):
+        """All minimal conditional independencies x _||_ y | Z of the DAG
+
+        Returns:
+            DefaultDict[Tuple, List[set]]: for every pair (in sorted order) with at
+            least one separator, its minimal separating sets
+        """
+        out = collections.defaultdict(list)
+        for x, y in itertools.combinations(sorted(self.nodes), 2):
+            separators = self.minimal_separators(x, y)
+            if separators:
+                out[(x, y)] = [set(self.members(s)) for s in separators]
+        return out
+
+    def independence_rows(self, z_masks, only_independent=True):
+        """d-separation of every pair of nodes outside Z, for every conditioning bitset Z
+
+        Reachability is symmetric, so one Bayes-ball traversal per (x, Z) answers the
+        queries of x against every other node: a conditioning set costs at most one
+        traversal per node instead of one ancestral moral graph per pair.
+        Arguments:
+            z_masks (List[int]): conditioning sets as bitsets
+            only_independent (bool): whether to drop the d-connected pairs
+        Returns:
+            List[tuple]: (x index, y index, position of Z in ``z_masks``, independent)
+            with x index < y index
+        """
+        rows = []
+        n = len(self.nodes)
+        for k, z_mask in enumerate(z_masks):
+            free = [i for i in range(n) if not z_mask >> i & 1]
+            for a, x in enumerate(free):
+                reach = self.reachable(x, z_mask)
+                for y in free[a + 1:]:
+                    independent = not reach >> y & 1
+                    if independent or not only_independent:
+                        rows.append((x, y, k, independent))
+        return rows
+
+    def adjustment_sets(self, treatment, outcome):
+        """All minimal sets satisfying the backdoor criterion for treatment -> outcome
+
+        Z is a valid adjustment set if it contains no descendant of the treatment and
+        d-separates treatment and outcome once the edges out of the treatment are
+        removed (i.e. it blocks every backdoor path). This enumerates candidate sets
+        and serves as the reference for ``minimal_adjustment_sets``, which scales to
+        large graphs.
+        Returns:
+            List[set]: minimal adjustment sets, smallest first
+        """
+        G = self.G.copy()
+        G.remove_edges_from(list(G.out_edges(treatment)))
+        backdoor = DSeparation(G)
+        allowed = ~(self.descendants[self.index[treatment]]) & ((1 << len(self.nodes)) - 1)
+        allowed = backdoor.mask(self.members(allowed))
+        return [set(backdoor.members(s)) for s in backdoor.minimal_separators(treatment, outcome, allowed)]
+
+
+def _minimal_separators(M, a, b):
+    """All minimal a,b-separators of the undirected graph M
+
+    Kloks & Kratsch (1998): start from the separator closest to a, N(C_b) with C_b
+    the component of b in M - N[a], and generate new ones from every separator S and
+    every x in S not adjacent to b as N(C_b) with C_b the component of b in
+    M - (S + N(x)). Each separator costs polynomial time, independent of how many
+    subsets of nodes there are.
+    """
+    def close_to_b(removed):
+        component = nx.node_connected_component(M.subgraph(set(M) - removed), b)
+        return frozenset(set().union(*(M[v] for v in component)) - component)
+
+    if b in M[a]:
+        return []
+    if not nx.has_path(M, a, b):
+        return [frozenset()]
+    first = close_to_b(set(M[a]) | {a})
+    found, queue = {first}, [first]
+    while queue:
+        S = queue.pop()
+        for x in S:
+            if b in M[x]:
+                continue
+            T = close_to_b(set(S) | set(M[x]))
+            if T not in found and a not in T:
+                found.add(T)
+                queue.append(T)
+    return list(found)
+
+
+def minimal_adjustment_sets(G, treatment, outcome):
+    """All minimal sets satisfying the backdoor criterion, in polynomial time per set
+
+    The backdoor graph (G without the edges out of the treatment) is restricted to
+    the ancestors of treatment and outcome and moralized; there, d-separation is plain
+    graph separation (Lauritzen et al. 1990). Descendants of the treatment may not be
+    adjusted for, so they are eliminated by turning their neighbourhood into a clique,
+    which keeps every path through them. The minimal treatment/outcome separators of
+    the remaining graph are the minimal adjustment sets.
+    Arguments:
+        G (nx.DiGraph): the DAG
+        treatment, outcome: nodes
+    Returns:
+        List[set]: minimal adjustment sets, ordered by size and then by sorted members
+    """
+    backdoor = G.copy()
+    backdoor.remove_edges_from(list(G.out_edges(treatment)))
+    relevant = nx.ancestors(backdoor, treatment) | nx.ancestors(backdoor, outcome) | {treatment, outcome}
+    M = nx.moral_graph(backdoor.subgraph(relevant))
+    for f in (nx.descendants(G, treatment) & relevant) - {outcome}:
+        neighbours = list(M[f])
+        M.add_edges_from(itertools.combinations(neighbours, 2))
+        M.remove_node(f)
+    separators = _minimal_separators(M, treatment, outcome)
+    return sorted((set(s) for s in separators), key=lambda s: (len(s), sorted(s)))
+
+
+def _independence_rows(G, z_masks, only_independent):
+    return DSeparation(G).independence_rows(z_masks, only_independent)
+
+
+def independence_table(G, conditioning_sets=None, max_conditioning=0, only_independent=True, num_workers=None):
+    """Testable (conditional) independencies of a DAG, as a table
+
+    All queries go through one ``DSeparation`` (ancestor bitsets computed once, one
+    traversal per node and conditioning set, see ``independence_rows``). With
+    ``num_workers`` the conditioning sets are split across a process pool, each
+    worker building its own oracle.
+    Arguments:
+        G (nx.DiGraph): the DAG
+        conditioning_sets (List[Iterable]): conditioning sets to test; by default all
+            sets of at most ``max_conditioning`` nodes (0: marginal independencies only)
+        max_conditioning (int): size of the largest default conditioning set
+        only_independent (bool): whether to drop the d-connected pairs
+        num_workers (int): number of worker processes (default: run in this process)
+    Returns:
+        pd.DataFrame: columns x, y, given (tuple of nodes) and independent, one row per
+        pair and conditioning set, ordered by x, y (in the graph's node order) and then
+        by conditioning set
+    """
+    ds = DSeparation(G)
+    if conditioning_sets is None:
+        conditioning_sets = [z for size in range(max_conditioning + 1)
+                             for z in itertools.combinations(ds.nodes, size)]
+    conditioning_sets = [tuple(z) for z in conditioning_sets]
+    z_masks = [ds.mask(z) for z in conditioning_sets]
+    if num_workers is None or num_workers <= 1:
+        rows = ds.independence_rows(z_masks, only_independent)
+    else:
+        # contiguous blocks of conditioning sets, renumbered back after the workers return
+        step = -(-len(z_masks) // num_workers)
+        starts = range(0, len(z_masks), step)
+        with ProcessPoolExecutor(num_workers, mp_context=mp.get_context("spawn")) as pool:
+            futures = [pool.submit(_independence_rows, G, z_masks[i:i + step], only_independent) for i in starts]
+            rows = [(x, y, k + i, ind) for i, f in zip(starts, futures) for x, y, k, ind in f.result()]
+    rows.sort(key=lambda r: r[:3])
+    return pd.DataFrame({
+        "x": [ds.nodes[r[0]] for r in rows],
+        "y": [ds.nodes[r[1]] for r in rows],
+        "given": [conditioning_sets[r[2]] for r in rows],
+        "independent": [r[3] for r in rows],
+    })
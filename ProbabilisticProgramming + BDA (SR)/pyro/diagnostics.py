@@ -0,0 +1,157 @@
+import numpy as np
+import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
+from scipy.stats import rankdata
+
+from sample_store import SampleStore
+
+
+def chain_components(s, num_chains=1):
+    """One (chains, draws) array per scalar component of every site
+
+    Multivariate sites are split into components named like ``unnest_samples``
+    (``b[0]``, ``b[1][2]``); the components are views, so a ``SampleStore`` is not
+    read until they are used.
+    Arguments:
+        s (Dict[str, np.array] or SampleStore): samples of shape [[chains,] draws [, idx1, ...]]
+        num_chains (int): number of chains, i.e. whether the leading axis indexes chains
+            (ignored for a store, which always has a chain axis)
+    Returns:
+        Dict[str, np.array]: components of shape (chains, draws)
+    """
+    if isinstance(s, SampleStore):
+        num_chains = s.num_chains
+    out = dict()
+    for k, v in s.items():
+        v = v if isinstance(v, np.ndarray) else np.asarray(v)
+        if num_chains == 1 and not isinstance(s, SampleStore):
+            v = v[None]
+        for idx in np.ndindex(*v.shape[2:]):
+            out[k + "".join(f"[{i}]" for i in idx)] = v[(slice(None), slice(None), *idx)]
+    return out
+
+
+def rank_draws(components):
+    """Ranks of all draws, pooled over chains, of every component in one pass
+
+    Arguments:
+        components (Dict[str, np.array]): (chains, draws) arrays of equal shape
+    Returns:
+        np.array: ranks (1 ... chains * draws, ties averaged) of shape (components, chains, draws)
+    """
+    x = np.stack([np.asarray(v, dtype=np.float64) for v in components.values()], axis=-1)
+    chains, draws, m = x.shape
+    return rankdata(x.reshape(-1, m), axis=0).T.reshape(m, chains, draws)
+
+
+def rank_histograms(ranks, num_bins=30):
+    """Counts of the ranks of every chain in ``num_bins`` equal bins
+
+    Arguments:
+        ranks (np.array): (components, chains, draws) as returned by ``rank_draws``
+    Returns:
+        np.array: counts of shape (components, chains, num_bins)
+    """
+    m, chains, draws = ranks.shape
+    bins = np.minimum(((ranks - 1) * num_bins / (chains * draws)).astype(np.int64), num_bins - 1)
+    offsets = (np.arange(m * chains) * num_bins).reshape(m, chains, 1)
+    counts = np.bincount((bins + offsets).ravel(), minlength=m * chains * num_bins)
+    return counts.reshape(m, chains, num_bins)
+
+
+def decimate(y, max_points=2000):
+    """Min/max decimation of traces along the last axis
+
+    The draws are split into ``max_points // 2`` buckets and every bucket is replaced
+    by its minimum and maximum, so the plotted envelope of the trace (and any spike)
+    is kept while the number of points no longer grows with the number of draws.
+    Arguments:
+        y (np.array): traces of shape (..., draws)
+    Returns:
+        Tuple[np.array, np.array]: draw indices (draws,) or (2 * buckets,) and the decimated traces
+    """
+    n = y.shape[-1]
+    if n <= max_points:
+        return np.arange(n), np.asarray(y)
+    starts = np.linspace(0, n, max_points // 2, endpoint=False).astype(np.int64)
+    lo = np.minimum.reduceat(y, starts, axis=-1)
+    hi = np.maximum.reduceat(y, starts, axis=-1)
+    widths = np.diff(np.append(starts, n))
+    x = np.stack([starts, starts + widths // 2], axis=-1).ravel()
+    return x, np.stack([lo, hi], axis=-1).reshape(*y.shape[:-1], -1)
+
+
+def _canvas(names, shared, height):
+    # one row of axes per component, or a single axes with one band per component
+    if shared:
+        fig, ax = plt.subplots(figsize=(12, max(3, 0.4 * len(names))))
+        ax.set_yticks(np.arange(len(names)) + 0.4)
+        ax.set_yticklabels(names)
+        ax.set_ylim(-0.2, len(names))
+        ax.invert_yaxis()
+        return fig, [ax] * len(names)
+    fig, axes = plt.subplots(nrows=len(names), figsize=(12, len(names) * height), squeeze=False)
+    for ax, k in zip(axes[:, 0], names):
+        ax.set_ylabel(k)
+    return fig, list(axes[:, 0])
+
+
+def traceplot(s, num_chains=1, max_points=2000, shared=False):
+    """Traces of every chain of every site (component)
+
+    Arguments:
+        s (Dict[str, np.array] or SampleStore): samples, see ``chain_components``
+        num_chains (int): number of chains
+        max_points (int): points per trace after min/max decimation
+        shared (bool): draw all components as bands of one axes, e.g. for many sites
+    Returns:
+        plt.Figure
+    """
+    components = chain_components(s, num_chains)
+    fig, axes = _canvas(list(components), shared, 5)
+    for i, (ax, v) in enumerate(zip(axes, components.values())):
+        x, y = decimate(np.asarray(v), max_points)
+        if shared:
+            # scaled into the band [i, i + 0.8] of the shared axes
+            lo, hi = y.min(), y.max()
+            y = i + 0.8 * (hi - y) / (hi - lo if hi > lo else 1.)
+            ax.add_collection(LineCollection([np.column_stack([x, yc]) for yc in y], linewidths=0.5,
+                                             colors=[f"C{c}" for c in range(len(y))]))
+        else:
+            for j, yc in enumerate(y):
+                ax.plot(x, yc, linewidth=0.5, color=f"C{j}")
+    if shared:
+        axes[0].set_xlim(0, next(iter(components.values())).shape[1])
+    plt.xlabel("Sample index")
+    return fig
+
+
+def trankplot(s, num_chains=None, num_bins=30, shared=False):
+    """Rank histograms of every chain (Vehtari et al. 2021) of every site (component)
+
+    The draws of all chains are ranked together; for well mixed chains every
+    chain's histogram is flat.
+    Arguments:
+        s (Dict[str, np.array] or SampleStore): samples, see ``chain_components``
+        num_chains (int): number of chains
+        num_bins (int): number of histogram bins
+        shared (bool): draw all components as bands of one axes, e.g. for many sites
+    Returns:
+        plt.Figure
+    """
+    components = chain_components(s, num_chains or 1)
+    chains, draws = next(iter(components.values())).shape
+    counts = rank_histograms(rank_draws(components), num_bins)
+    edges = np.linspace(0, chains * draws, num_bins + 1)
+    fig, axes = _canvas(list(components), shared, chains)
+    for i, (ax, c) in enumerate(zip(axes, counts)):
+        if shared:
+            # a flat histogram sits in the middle of the band
+            c = i + 0.4 * (2 - c / (draws / num_bins))
+        for j, cc in enumerate(c):
+            ax.stairs(cc, edges, baseline=None, linewidth=2, alpha=0.5, color=f"C{j}")
+        if not shared:
+            ax.set_yticks([])
+        ax.set_xlim(left=0, right=chains * draws)
+    plt.xlabel("sample rank")
+    return fig
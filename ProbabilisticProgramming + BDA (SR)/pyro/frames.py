@@ -0,0 +1,84 @@
+import warnings
+import weakref
+
+import numpy as np
+import torch
+
+_cache = dict()
+
+
+def _from_numpy(values, dtype):
+    # shares memory with ``values`` when it is contiguous and already of the right dtype
+    values = np.ascontiguousarray(values, dtype=torch.empty((), dtype=dtype).numpy().dtype)
+    with warnings.catch_warnings():
+        # pandas hands out read-only views; the tensors are only read
+        warnings.simplefilter("ignore", UserWarning)
+        return torch.from_numpy(values)
+
+
+def _signature(frames):
+    # column names and the memory of every column, which changes when a column is reassigned
+    return tuple((col, d[col].to_numpy().__array_interface__["data"][0], d[col].shape, str(d[col].dtype))
+                 for d in frames for col in d.columns)
+
+
+def _copy(tensors):
+    return {k: v.clone() for k, v in tensors.items()}
+
+
+def frame_tensors(df, categoricals=None, dtype=torch.float64, design=None, cache=True, copy=True):
+    """Tensors of the columns of a DataFrame (or of a list of K equally shaped DataFrames)
+
+    Numeric columns become ``dtype`` tensors and ``categoricals`` int64 tensors, built
+    with ``torch.from_numpy``: a column that already has the right dtype is not copied,
+    any other is converted once. ``design`` stacks the listed columns into one
+    contiguous (N, len(design)) matrix under the key ``"X"``. A list of DataFrames gives
+    (K, N) tensors, the replicates of ``RegressionBase``.
+    Conversions are cached per DataFrame object (while it is alive), so fitting several
+    models on the same frame builds its tensors once. A cached conversion is reused only
+    while the frame has the same columns, each backed by the same memory, so adding or
+    reassigning a column (``df["x"] = df["x"] * 10``) converts the frame again.
+    The cached tensors may share memory with the frame, so every call returns fresh
+    copies of them that the caller is free to modify (``x -= x.mean()``). With
+    ``copy=False`` the shared tensors themselves are returned, which skips the copy
+    but makes them strictly read-only: an in-place edit would change the DataFrame and
+    every later result for it. Values overwritten in place in a column that had to be
+    converted (e.g. int to float) are not seen by the cached conversion, which needs
+    ``cache=False``.
+    Arguments:
+        df (pd.DataFrame or List[pd.DataFrame]): the data
+        categoricals (List[str]): integer coded columns
+        dtype (torch.dtype): dtype of the numeric columns, e.g. torch.float32 for
+            faster NUTS/SVI
+        design (List[str]): columns of the design matrix ``X``
+        cache (bool): whether to reuse (and store) the conversion of this frame
+        copy (bool): return copies rather than tensors that may share memory with
+            the frame and the cache
+    Returns:
+        Dict[str, Tensor]: one tensor per column (and ``X``)
+    """
+    categoricals = tuple(categoricals or ())
+    frames = list(df) if isinstance(df, (list, tuple)) else [df]
+    key = (tuple(id(d) for d in frames), categoricals, dtype, tuple(design or ()))
+    signature = _signature(frames) if cache else None
+    if cache and key in _cache:
+        refs, cached_signature, tensors = _cache[key]
+        if all(r() is d for r, d in zip(refs, frames)) and cached_signature == signature:
+            return _copy(tensors) if copy else dict(tensors)
+    columns = frames[0].columns
+    if len(frames) == 1:
+        values = {col: frames[0][col].to_numpy() for col in columns}
+    else:
+        values = {col: np.stack([d[col].to_numpy() for d in frames]) for col in columns}
+    tensors = dict()
+    for col in columns:
+        tensors[col] = _from_numpy(values[col], torch.int64 if col in categoricals else dtype)
+    if design:
+        X = np.stack([values[col] for col in design], axis=-1)
+        tensors["X"] = _from_numpy(X, dtype)
+    if cache:
+        # dropped together with the first frame that is garbage collected
+        _cache[key] = ([weakref.ref(d) for d in frames], signature, tensors)
+        for d in frames:
+            weakref.finalize(d, _cache.pop, key, None)
+    return _copy(tensors) if copy else dict(tensors)
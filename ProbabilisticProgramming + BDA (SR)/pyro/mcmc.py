@@ -0,0 +1,787 @@
+import collections
+import hashlib
+import math
+import multiprocessing as mp
+import os
+import pickle
+import time
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import torch
+import pyro
+from pyro import poutine
+from pyro.infer.mcmc import NUTS, MCMC
+from pyro.infer.mcmc.util import diagnostics, print_summary, select_samples
+from pyro.ops.welford import WelfordCovariance
+from pyro.poutine.util import site_is_subsample
+from pyro.util import ignore_jit_warnings, optional
+from torch.distributions import biject_to
+
+from workers import init_worker, pack, unpack
+
+
+class ChainResult:
+    """Draws of a multi-chain run, with the parts of the ``MCMC`` interface used in the notebooks
+
+    ``get_samples``, ``diagnostics`` and ``summary`` behave like those of
+    ``pyro.infer.mcmc.MCMC`` and ``kernel.model`` is the model, so the result can be
+    passed to ``get_log_prob``, ``traceplot`` etc. in place of an ``MCMC`` engine.
+    """
+    def __init__(self, kernel, samples, chain_diagnostics, timings=None):
+        self.kernel = kernel
+        self.num_chains = len(chain_diagnostics)
+        self._samples = samples
+        self._diagnostics = chain_diagnostics
+        # seconds spent tracing/compiling the potential, in warmup and drawing samples
+        self.timings = timings or {}
+
+    def get_samples(self, num_samples=None, group_by_chain=False):
+        return select_samples(self._samples, num_samples, group_by_chain)
+
+    def diagnostics(self):
+        diag = diagnostics(self._samples)
+        for diag_name in self._diagnostics[0]:
+            diag[diag_name] = {f"chain {i}": d[diag_name] for i, d in enumerate(self._diagnostics)}
+        return diag
+
+    def summary(self, prob=0.9):
+        print_summary(self._samples, prob=prob)
+        print(f"Number of divergences: {sum(len(d['divergences']) for d in self._diagnostics)}")
+
+
+### Vectorized chains
+
+class _DualAveraging:
+    """Nesterov dual averaging of the log step size (Hoffman & Gelman 2014), one per chain"""
+    def __init__(self, step_size, t0=10, kappa=0.75, gamma=0.05):
+        self.prox_center = torch.log(10 * step_size)
+        self.t0, self.kappa, self.gamma = t0, kappa, gamma
+        self.t = 0
+        self.x_avg = torch.zeros_like(step_size)
+        self.g_avg = torch.zeros_like(step_size)
+
+    def step(self, g):
+        self.t += 1
+        self.g_avg = (1 - 1 / (self.t + self.t0)) * self.g_avg + g / (self.t + self.t0)
+        x = self.prox_center - math.sqrt(self.t) / self.gamma * self.g_avg
+        weight = self.t ** -self.kappa
+        self.x_avg = (1 - weight) * self.x_avg + weight * x
+        return x.exp()
+
+
+def _adaptation_windows(num_warmup, init_buffer=75, term_buffer=50, base_window=25):
+    """Mass matrix adaptation windows [start, end) of Stan's windowed warmup"""
+    if num_warmup < 20:
+        return []
+    if init_buffer + base_window + term_buffer > num_warmup:
+        init_buffer, term_buffer = int(0.15 * num_warmup), int(0.1 * num_warmup)
+        base_window = num_warmup - init_buffer - term_buffer
+    windows, start, size = [], init_buffer, base_window
+    last = num_warmup - term_buffer
+    while start < last:
+        end = start + size
+        # the last window takes up whatever does not fit another doubling
+        if end + 2 * size > last:
+            end = last
+        windows.append((start, end))
+        start, size = end, 2 * size
+    return windows
+
+
+# traced potentials, least recently used first; the keys hold on to the models, hence the bound
+_potential_cache = collections.OrderedDict()
+POTENTIAL_CACHE_SIZE = 16
+
+
+def clear_potential_cache():
+    """Drops the traced potentials kept by ``VectorizedNUTS(jit_compile=True)``"""
+    _potential_cache.clear()
+
+
+class _Leaf:
+    """Position of a tensor in the flattened model inputs"""
+    def __init__(self, i):
+        self.i = i
+
+    def __repr__(self):
+        return f"_Leaf({self.i})"
+
+
+def _flatten(obj, tensors=None):
+    # (template with the tensors replaced by _Leaf, the tensors in order)
+    tensors = [] if tensors is None else tensors
+    if isinstance(obj, torch.Tensor):
+        tensors.append(obj)
+        return _Leaf(len(tensors) - 1), tensors
+    if isinstance(obj, dict):
+        return {k: _flatten(v, tensors)[0] for k, v in obj.items()}, tensors
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_flatten(v, tensors)[0] for v in obj), tensors
+    return obj, tensors
+
+
+def _freeze(template):
+    # hashable form of a template; non-tensor inputs are compared by their hash and equality
+    if isinstance(template, _Leaf):
+        return _Leaf, template.i
+    if isinstance(template, dict):
+        return dict, tuple((k, _freeze(v)) for k, v in template.items())
+    if isinstance(template, (list, tuple)):
+        return type(template), tuple(_freeze(v) for v in template)
+    hash(template)
+    return template
+
+
+def _fill(template, tensors):
+    if isinstance(template, _Leaf):
+        return tensors[template.i]
+    if isinstance(template, dict):
+        return {k: _fill(v, tensors) for k, v in template.items()}
+    if isinstance(template, (list, tuple)):
+        return type(template)(_fill(v, tensors) for v in template)
+    return template
+
+
+class VectorizedNUTS:
+    """No-U-Turn sampler that advances all chains together in batched tensors
+
+    The model is run inside an outermost ``pyro.plate`` over the chains (as in
+    ``log_likelihood``), so one trace evaluates the log density of every chain, and the
+    states of all chains are rows of a single (num_chains, D) tensor of unconstrained
+    values. Every chain builds its own trajectory: directions, multinomial sampling,
+    U-turn checks (on every sub-tree, as in the recursive algorithm) and divergences are
+    per chain, and chains that have stopped are masked out until the slowest chain is
+    done. Step sizes (dual averaging) and diagonal mass matrices (Stan's windowed warmup)
+    are adapted per chain, so the draws of each chain follow the same algorithm as
+    ``pyro.infer.mcmc.NUTS`` with a diagonal mass matrix.
+
+    One leapfrog step of K chains costs about as much as one step of a single chain,
+    and there are no worker processes to spawn. Models must be vectorizable over the
+    chains plate, i.e. index parameters with ``a[..., idx]`` rather than ``a[idx]``;
+    ``setup`` checks this against the unvectorized model and raises a ValueError otherwise.
+    With ``jit_compile`` the traced potential takes the tensors among the model inputs
+    as inputs (rather than baking them in as constants) and is kept in a cache of the
+    ``POTENTIAL_CACHE_SIZE`` most recently used potentials, keyed by the model, the
+    number of chains, the shapes and dtypes of the tensor inputs and (by hash and
+    equality) the other inputs: refitting a model on data of the same shape skips
+    tracing and compiling. Models with unhashable non-tensor inputs are traced on
+    every fit. Tensors
+    the model reads from elsewhere (e.g. attributes of a model object) are constants of
+    the trace, so such a model must not change them between fits.
+    Arguments:
+        model (callable): the model
+        num_chains (int): number of chains
+        step_size, adapt_step_size, adapt_mass_matrix, target_accept_prob, max_tree_depth:
+            as for ``pyro.infer.mcmc.NUTS``
+        jit_compile (bool): trace the vectorized potential with ``torch.jit.trace``, once for
+            all chains (same caveats as for NUTS)
+    """
+    max_delta_energy = 1000.
+
+    def __init__(self, model, num_chains, step_size=1.0, adapt_step_size=True, adapt_mass_matrix=True,
+                 target_accept_prob=0.8, max_tree_depth=10, jit_compile=False, ignore_jit_warnings=False,
+                 full_mass=False):
+        if full_mass:
+            raise ValueError("vectorized chains only adapt a diagonal mass matrix")
+        self.model = model
+        self.num_chains = num_chains
+        self.init_step_size = step_size
+        self.adapt_step_size = adapt_step_size
+        self.adapt_mass_matrix = adapt_mass_matrix
+        self.target_accept_prob = target_accept_prob
+        self.max_tree_depth = max_tree_depth
+        self.jit_compile = jit_compile
+        self.ignore_jit_warnings = ignore_jit_warnings
+        self._adapted = False
+
+    def setup(self, *args, **kwargs):
+        """Lays out the latent sites, draws initial states and checks the vectorization"""
+        self._args, self._kwargs = args, kwargs
+        with poutine.block():
+            tr = poutine.trace(self.model).get_trace(*args, **kwargs)
+        rank = 0
+        self._layout = dict()
+        offset = 0
+        for name, site in tr.nodes.items():
+            if site["type"] != "sample" or site_is_subsample(site):
+                continue
+            rank = max(rank, len(site["fn"].batch_shape), site["value"].dim() - site["fn"].event_dim)
+            rank = max([rank] + [-f.dim for f in site["cond_indep_stack"] if f.vectorized])
+            if site["is_observed"]:
+                continue
+            if site["fn"].support.is_discrete:
+                raise ValueError(f"site {name} is discrete; vectorized chains need continuous latents")
+            t = biject_to(site["fn"].support)
+            shape = site["value"].shape
+            unconstrained_shape = t.inverse_shape(shape)
+            size = math.prod(unconstrained_shape)
+            batch_dim = site["value"].dim() - site["fn"].event_dim
+            self._layout[name] = (offset, size, unconstrained_shape, shape, batch_dim, t)
+            offset += size
+            self.dtype = site["value"].dtype
+        if not self._layout:
+            raise ValueError("the model has no latent sample sites to draw")
+        self.rank = rank
+        self.dim = offset
+        K = self.num_chains
+
+        def vectorized(*args, **kwargs):
+            with pyro.plate("_chains", K, dim=-rank - 1):
+                return self.model(*args, **kwargs)
+        self._vectorized = vectorized
+
+        self._tensors = []
+        self._potential_fn = self.potential
+        self.timings = {"compile": 0.}
+        # Pyro's default initialization: uniform in (-2, 2) on the unconstrained space
+        q = torch.empty(K, self.dim, dtype=self.dtype).uniform_(-2, 2)
+        for _ in range(100):
+            U, g = self.potential_grad(q)
+            bad = ~(torch.isfinite(U) & torch.isfinite(g).all(-1))
+            if not bad.any():
+                break
+            q[bad] = torch.empty(int(bad.sum()), self.dim, dtype=self.dtype).uniform_(-2, 2)
+        else:
+            raise ValueError("could not find a valid initial state for every chain")
+        self._check_vectorized(q, U)
+        if self.jit_compile:
+            self._compile(q)
+        self.q, self.U, self.grad = q, U, g
+        self.step_size = torch.full((K,), float(self.init_step_size), dtype=self.dtype)
+        self.inverse_mass = torch.ones(K, self.dim, dtype=self.dtype)
+
+    def _compile(self, q):
+        # the traced potential takes the input tensors as arguments, so it can be reused for new data
+        template, tensors = _flatten((self._args, self._kwargs))
+        try:
+            key = (self.model, self.num_chains, self.rank, tuple(self._layout_shapes().items()), _freeze(template),
+                   tuple((tuple(t.shape), t.dtype) for t in tensors))
+            hash(key)
+        except TypeError:
+            # unhashable non-tensor inputs: traced for this run only
+            key = None
+        start = time.perf_counter()
+        if key is None or key not in _potential_cache:
+            def potential(q, *tensors):
+                self._args, self._kwargs = _fill(template, tensors)
+                return self.potential(q)
+            with pyro.validation_enabled(False), optional(ignore_jit_warnings(), self.ignore_jit_warnings):
+                traced = torch.jit.trace(potential, (q, *tensors), check_trace=False)
+                # the profiling executor optimizes the graph over its first calls
+                for _ in range(2):
+                    q_ = q.detach().requires_grad_(True)
+                    torch.autograd.grad(traced(q_, *tensors).sum(), q_)
+            if key is not None:
+                _potential_cache[key] = traced
+                if len(_potential_cache) > POTENTIAL_CACHE_SIZE:
+                    _potential_cache.popitem(last=False)
+        else:
+            traced = _potential_cache[key]
+            _potential_cache.move_to_end(key)
+        self._tensors = tensors
+        self._potential_fn = lambda q: traced(q, *self._tensors)
+        self.timings["compile"] = time.perf_counter() - start
+
+    def constrain(self, q):
+        """Constrained values of the latent sites and the log |det J| of the transform,
+        for a (N, D) batch of unconstrained states"""
+        values, ladj = dict(), 0.
+        N = q.shape[0]
+        for name, (offset, size, unconstrained_shape, shape, _, t) in self._layout.items():
+            u = q[:, offset:offset + size].reshape((N,) + unconstrained_shape)
+            x = t(u)
+            ladj = ladj + t.log_abs_det_jacobian(u, x).reshape(N, -1).sum(-1)
+            values[name] = x
+        return values, ladj
+
+    def potential(self, q):
+        """Potential energy (negative log joint in unconstrained space) of every chain"""
+        K = self.num_chains
+        values, ladj = self.constrain(q)
+        # a site with b batch dims sits right of the chains plate at dim -rank-1
+        data = {
+            name: x.reshape((K,) + (1,) * (self.rank - self._layout[name][4]) + x.shape[1:])
+            for name, x in values.items()
+        }
+        # a diverging chain must not stop the others: let invalid values give nan energies
+        with pyro.validation_enabled(False):
+            tr = poutine.trace(poutine.condition(self._vectorized, data=data)).get_trace(*self._args, **self._kwargs)
+            tr.compute_log_prob()
+        log_joint = ladj
+        for name, site in tr.nodes.items():
+            if site["type"] != "sample" or site_is_subsample(site):
+                continue
+            log_prob = site["log_prob"]
+            if log_prob.dim() != self.rank + 1 or log_prob.shape[0] != K:
+                raise ValueError(f"site {name} has log_prob shape {tuple(log_prob.shape)} "
+                                 f"inside the chains plate")
+            log_joint = log_joint + log_prob.reshape(K, -1).sum(-1)
+        return -log_joint
+
+    def potential_grad(self, q):
+        q = q.detach().requires_grad_(True)
+        U = self._potential_fn(q)
+        # chains are independent, so the gradient of the sum is the gradient of each chain
+        grad, = torch.autograd.grad(U.sum(), q)
+        return U.detach(), grad
+
+    def _check_vectorized(self, q, U):
+        # the vectorized log density of every chain must equal the log density of the model
+        # itself; run once per setup, so checking all chains costs little
+        for c in range(self.num_chains):
+            values, ladj = self.constrain(q[c:c + 1])
+            tr = poutine.trace(poutine.condition(self.model, data={k: v[0] for k, v in values.items()}))
+            log_joint = tr.get_trace(*self._args, **self._kwargs).log_prob_sum() + ladj[0]
+            if not torch.allclose(-U[c], log_joint.detach(), rtol=1e-4, atol=1e-4):
+                raise ValueError(f"vectorized log density {-U[c].item():.4g} differs from the model's "
+                                 f"{log_joint.item():.4g}; the model does not vectorize over chains")
+
+    def _kinetic(self, p):
+        return 0.5 * (p * p * self.inverse_mass).sum(-1)
+
+    def _leapfrog(self, q, p, grad, step_size):
+        eps = step_size[:, None]
+        p = p - 0.5 * eps * grad
+        q = q + eps * self.inverse_mass * p
+        U, grad = self.potential_grad(q)
+        p = p - 0.5 * eps * grad
+        return q, p, grad, U
+
+    def _is_turning(self, q_start, p_start, q_end, p_end, direction):
+        # endpoint criterion of Hoffman & Gelman, in velocities v = M^-1 p
+        dq = (q_end - q_start) * direction[:, None]
+        v_start, v_end = self.inverse_mass * p_start, self.inverse_mass * p_end
+        return ((v_start * dq).sum(-1) < 0) | ((v_end * dq).sum(-1) < 0)
+
+    def _energy_error(self, U, p, H0):
+        delta = U + self._kinetic(p) - H0
+        return torch.where(torch.isnan(delta), torch.full_like(delta, math.inf), delta)
+
+    def transition(self, q, U, grad):
+        """One NUTS step of every chain (multinomial sampling, biased between sub-trees)
+
+        Returns:
+            new state (q, U, grad), mean acceptance probability over the trajectory, whether
+            the trajectory diverged and the tree depth, each per chain
+        """
+        K = self.num_chains
+        p = torch.randn_like(q) / self.inverse_mass.sqrt()
+        H0 = U + self._kinetic(p)
+        q_left, p_left, g_left = q, p, grad
+        q_right, p_right, g_right = q, p, grad
+        q_new, U_new, g_new = q, U, grad
+        log_weight = torch.zeros(K, dtype=q.dtype)
+        active = torch.ones(K, dtype=torch.bool)
+        diverging = torch.zeros(K, dtype=torch.bool)
+        sum_accept = torch.zeros(K, dtype=q.dtype)
+        num_steps = torch.zeros(K, dtype=q.dtype)
+        depth = torch.zeros(K, dtype=torch.long)
+        for j in range(self.max_tree_depth):
+            forward = torch.rand(K) < 0.5
+            direction = torch.where(forward, 1., -1.).to(q.dtype)
+            f = forward[:, None]
+            q_edge = torch.where(f, q_right, q_left)
+            p_edge = torch.where(f, p_right, p_left)
+            g_edge = torch.where(f, g_right, g_left)
+            # new sub-tree of 2^j leapfrog steps; checkpoints hold the first state of the
+            # current block of size 2^l so every block is checked for a U-turn once complete
+            checkpoints = [None] * (j + 1)
+            sub_active = active.clone()
+            sub_log_weight = torch.full((K,), -math.inf, dtype=q.dtype)
+            q_sub, U_sub, g_sub = q_new, U_new, g_new
+            for i in range(2 ** j):
+                q_edge, p_edge, g_edge, U_edge = self._leapfrog(q_edge, p_edge, g_edge, self.step_size * direction)
+                delta = self._energy_error(U_edge, p_edge, H0)
+                sum_accept += torch.where(sub_active, (-delta).exp().clamp(max=1), torch.zeros_like(delta))
+                num_steps += sub_active
+                new_log_weight = torch.logaddexp(sub_log_weight, -delta)
+                take = sub_active & (torch.rand(K, dtype=q.dtype).log() < -delta - new_log_weight)
+                q_sub = torch.where(take[:, None], q_edge, q_sub)
+                U_sub = torch.where(take, U_edge, U_sub)
+                g_sub = torch.where(take[:, None], g_edge, g_sub)
+                sub_log_weight = torch.where(sub_active, new_log_weight, sub_log_weight)
+                turning = torch.zeros(K, dtype=torch.bool)
+                for l in range(1, j + 1):
+                    if i % 2 ** l == 0:
+                        checkpoints[l] = (q_edge, p_edge)
+                    elif (i + 1) % 2 ** l == 0:
+                        turning |= self._is_turning(*checkpoints[l], q_edge, p_edge, direction)
+                diverged = sub_active & (delta > self.max_delta_energy)
+                diverging |= diverged
+                sub_active &= ~(diverged | turning)
+                if not sub_active.any():
+                    break
+            # chains whose sub-tree completed take its sample with probability w_sub / w_tree
+            take = sub_active & (torch.rand(K, dtype=q.dtype).log() < sub_log_weight - log_weight)
+            q_new = torch.where(take[:, None], q_sub, q_new)
+            U_new = torch.where(take, U_sub, U_new)
+            g_new = torch.where(take[:, None], g_sub, g_new)
+            log_weight = torch.where(sub_active, torch.logaddexp(log_weight, sub_log_weight), log_weight)
+            right, left = (sub_active & forward)[:, None], (sub_active & ~forward)[:, None]
+            q_right, p_right, g_right = (torch.where(right, q_edge, q_right), torch.where(right, p_edge, p_right),
+                                         torch.where(right, g_edge, g_right))
+            q_left, p_left, g_left = (torch.where(left, q_edge, q_left), torch.where(left, p_edge, p_left),
+                                      torch.where(left, g_edge, g_left))
+            depth += active
+            active = sub_active & ~self._is_turning(q_left, p_left, q_right, p_right, torch.ones_like(direction))
+            if not active.any():
+                break
+        return (q_new, U_new, g_new), sum_accept / num_steps.clamp(min=1), diverging, depth
+
+    def _reasonable_step_size(self, q, U, grad):
+        # per chain, double or halve the step size until the one-step acceptance crosses 0.8
+        step_size = self.step_size.clone()
+        threshold = math.log(0.8)
+        direction = None
+        searching = torch.ones(self.num_chains, dtype=torch.bool)
+        for _ in range(100):
+            p = torch.randn_like(q) / self.inverse_mass.sqrt()
+            H0 = U + self._kinetic(p)
+            if direction is None:
+                trial = step_size
+            else:
+                trial = torch.where(searching, step_size * 2. ** direction, step_size)
+            _, p_new, _, U_new = self._leapfrog(q, p, grad, trial)
+            log_accept = -self._energy_error(U_new, p_new, H0)
+            new_direction = torch.where(log_accept > threshold, 1., -1.).to(q.dtype)
+            if direction is None:
+                direction = new_direction
+                continue
+            step_size = trial
+            searching &= (new_direction == direction) & (step_size > 1e-10) & (step_size < 1e7)
+            if not searching.any():
+                break
+        return step_size
+
+    def warmup(self, num_warmup):
+        """Adapts the step sizes and mass matrices over ``num_warmup`` transitions
+
+        Adaptation starts from the current state, step sizes and mass matrices: after
+        ``load_state_dict`` (a warm start) the initial step size search is skipped and a
+        short warmup is usually enough; one shorter than 150 transitions only adapts the
+        step sizes.
+        """
+        if num_warmup == 0:
+            return
+        start = time.perf_counter()
+        q, U, grad = self.q, self.U, self.grad
+        windows = _adaptation_windows(num_warmup) if self.adapt_mass_matrix else []
+        if self._adapted and num_warmup < 150:
+            # too short for Stan's windows (75 + 25 + 50): keep the adapted mass matrix
+            windows = []
+        window_ends = {end for _, end in windows}
+        if self.adapt_step_size:
+            if not self._adapted:
+                self.step_size = self._reasonable_step_size(q, U, grad)
+            averaging = _DualAveraging(self.step_size)
+        welford = WelfordCovariance(diagonal=True)
+        for it in range(num_warmup):
+            (q, U, grad), accept_prob, _, _ = self.transition(q, U, grad)
+            if self.adapt_step_size:
+                self.step_size = averaging.step(self.target_accept_prob - accept_prob)
+            if any(start <= it < end for start, end in windows):
+                welford.update(q)
+            if it + 1 in window_ends:
+                self.inverse_mass = welford.get_covariance(regularize=True)
+                welford.reset()
+                if self.adapt_step_size:
+                    self.step_size = self._reasonable_step_size(q, U, grad)
+                    averaging = _DualAveraging(self.step_size)
+        if self.adapt_step_size:
+            self.step_size = averaging.x_avg.exp()
+        self.q, self.U, self.grad = q, U, grad
+        self._adapted = True
+        self.timings["warmup"] = self.timings.get("warmup", 0.) + time.perf_counter() - start
+
+    def sample(self, num_samples):
+        """Draws ``num_samples`` per chain with the current step sizes and mass matrices
+
+        Returns:
+            ChainResult: draws of shape (num_chains, num_samples, *site_shape)
+        """
+        K = self.num_chains
+        start = time.perf_counter()
+        q, U, grad = self.q, self.U, self.grad
+        draws, accept, divergent = [], [], []
+        for _ in range(num_samples):
+            (q, U, grad), accept_prob, diverging, _ = self.transition(q, U, grad)
+            draws.append(q)
+            accept.append(accept_prob)
+            divergent.append(diverging)
+        self.q, self.U, self.grad = q, U, grad
+        draws = torch.stack(draws, dim=1)
+        values, _ = self.constrain(draws.reshape(K * num_samples, self.dim))
+        samples = {name: x.reshape((K, num_samples) + x.shape[1:]).detach() for name, x in values.items()}
+        accept, divergent = torch.stack(accept, dim=1), torch.stack(divergent, dim=1)
+        chain_diagnostics = [
+            {"divergences": divergent[c].nonzero().reshape(-1).tolist(), "acceptance rate": accept[c].mean().item()}
+            for c in range(K)
+        ]
+        self.timings["sampling"] = self.timings.get("sampling", 0.) + time.perf_counter() - start
+        return ChainResult(self, samples, chain_diagnostics, dict(self.timings))
+
+    def run(self, num_warmup, num_samples):
+        """Warmup with adaptation, then draws ``num_samples`` per chain
+
+        Returns:
+            ChainResult: draws of shape (num_chains, num_samples, *site_shape)
+        """
+        self.warmup(num_warmup)
+        return self.sample(num_samples)
+
+    def _layout_shapes(self):
+        return {name: tuple(shape) for name, (_, _, _, shape, _, _) in self._layout.items()}
+
+    def state_dict(self):
+        """Last state, step size and inverse mass matrix of every chain"""
+        return {
+            "layout": self._layout_shapes(),
+            "q": self.q.detach(),
+            "step_size": self.step_size,
+            "inverse_mass": self.inverse_mass,
+            "adapted": self._adapted,
+        }
+
+    def load_state_dict(self, state):
+        """Continues from a saved state (after ``setup``), e.g. of a fit on earlier data
+
+        The latent sites must have the same names and shapes; the potential energy and
+        its gradient are recomputed, so the data may differ from that of the saved run.
+        """
+        if state["layout"] != self._layout_shapes():
+            raise ValueError(f"saved latent sites {state['layout']} differ from the model's {self._layout_shapes()}")
+        if state["q"].shape[0] != self.num_chains:
+            raise ValueError(f"saved state has {state['q'].shape[0]} chains, not {self.num_chains}")
+        self.q = state["q"].to(self.dtype)
+        self.U, self.grad = self.potential_grad(self.q)
+        self.step_size = state["step_size"].to(self.dtype)
+        self.inverse_mass = state["inverse_mass"].to(self.dtype)
+        self._adapted = state["adapted"]
+
+
+def _load_checkpoint(path):
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+
+def _hash_inputs(h, obj):
+    if isinstance(obj, torch.Tensor):
+        t = obj.detach().cpu().contiguous()
+        h.update(f"{t.dtype}{tuple(t.shape)}".encode())
+        h.update(t.numpy().tobytes())
+    elif isinstance(obj, dict):
+        for k in sorted(obj, key=repr):
+            h.update(repr(k).encode())
+            _hash_inputs(h, obj[k])
+    elif isinstance(obj, (list, tuple)):
+        for v in obj:
+            _hash_inputs(h, v)
+    else:
+        h.update(repr(obj).encode())
+
+
+def _fingerprint(model, args, kwargs, num_chains, num_warmup, kernel_kwargs):
+    """Digest of everything a checkpointed run depends on, except ``num_samples``
+
+    The model is identified by its qualified name and the bytecode and constants of
+    its function (or ``__call__``), so editing the model changes the fingerprint; the
+    data by the dtype, shape and bytes of every tensor input.
+    """
+    h = hashlib.sha1()
+    fn = model if hasattr(model, "__code__") else getattr(type(model).__call__, "__func__", type(model).__call__)
+    fn = getattr(fn, "__func__", fn)
+    code = getattr(fn, "__code__", None)
+    h.update(f"{getattr(model, '__module__', '')}.{getattr(model, '__qualname__', type(model).__qualname__)}".encode())
+    if code is not None:
+        h.update(code.co_code)
+        h.update(repr(code.co_consts).encode())
+    # the instance attributes of a model object (e.g. the tensors of a RegressionBase)
+    _hash_inputs(h, {k: v for k, v in getattr(model, "__dict__", {}).items() if isinstance(v, torch.Tensor)})
+    _hash_inputs(h, (args, kwargs, num_chains, num_warmup, kernel_kwargs))
+    return h.hexdigest()
+
+
+def run_checkpointed(model, args, kwargs, num_warmup, num_samples, num_chains=1, checkpoint=None,
+                     checkpoint_every=100, warm_start=None, **kernel_kwargs):
+    """Vectorized NUTS run that is saved as it goes, and can be resumed and extended
+
+    After warmup and after every ``checkpoint_every`` draws, the state of every chain
+    (last position, adapted step size and mass matrix), the draws so far and the random
+    number generator are written to ``checkpoint``. Calling again with the same
+    checkpoint resumes where the run stopped, skipping warmup, and draws until there are
+    ``num_samples`` per chain, so a killed run loses at most one block and a finished one
+    is extended by asking for more draws. A run interrupted during warmup restarts it.
+    The checkpoint records a fingerprint of the model (its code), the data, the number of
+    chains and warmup draws and the kernel arguments; a checkpoint made with any of them
+    different is not resumed: the run starts over (with a warning) and replaces it.
+    ``warm_start`` (a checkpoint of an earlier fit of the same model, e.g. on fewer
+    data) starts the chains and the adaptation from that fit's state, so ``num_warmup``
+    can be much shorter than for a cold start.
+    Arguments:
+        model, args, kwargs, num_warmup, num_samples, num_chains, **kernel_kwargs:
+            as for ``run_chains``
+        checkpoint (str): path of the checkpoint file
+        checkpoint_every (int): draws per chain between checkpoints
+        warm_start (str or dict): checkpoint path or ``VectorizedNUTS.state_dict()``
+    Returns:
+        ChainResult: all draws of the run, grouped by chain
+    """
+    sampler = VectorizedNUTS(model, num_chains, **kernel_kwargs)
+    sampler.setup(*args, **kwargs)
+    fingerprint = _fingerprint(model, args, kwargs, num_chains, num_warmup, kernel_kwargs)
+    saved = None
+    if checkpoint is not None and os.path.exists(checkpoint):
+        saved = _load_checkpoint(checkpoint)
+        if saved.get("fingerprint") != fingerprint:
+            warnings.warn(f"checkpoint {checkpoint} was made with a different model, data or settings; starting over")
+            saved = None
+    if saved is not None:
+        sampler.load_state_dict(saved["state"])
+        torch.set_rng_state(saved["rng"])
+        samples, chain_diagnostics = saved["samples"], saved["diagnostics"]
+    else:
+        if warm_start is not None:
+            state = _load_checkpoint(warm_start)["state"] if isinstance(warm_start, str) else warm_start
+            sampler.load_state_dict(state)
+        sampler.warmup(num_warmup)
+        samples = {name: torch.empty((num_chains, 0) + shape, dtype=sampler.dtype)
+                   for name, shape in sampler._layout_shapes().items()}
+        chain_diagnostics = [{"divergences": [], "acceptance rate": 0.} for _ in range(num_chains)]
+
+    def save():
+        if checkpoint is None:
+            return
+        state = {"state": sampler.state_dict(), "rng": torch.get_rng_state(), "samples": samples,
+                 "diagnostics": chain_diagnostics, "fingerprint": fingerprint}
+        with open(checkpoint + ".tmp", "wb") as f:
+            pickle.dump(state, f)
+        os.replace(checkpoint + ".tmp", checkpoint)
+
+    save()
+    while True:
+        done = next(iter(samples.values())).shape[1]
+        if done >= num_samples:
+            break
+        block = sampler.sample(min(checkpoint_every, num_samples - done))
+        n = next(iter(block._samples.values())).shape[1]
+        samples = {k: torch.cat([v, block._samples[k]], dim=1) for k, v in samples.items()}
+        for d, b in zip(chain_diagnostics, block._diagnostics):
+            d["divergences"] = d["divergences"] + [done + i for i in b["divergences"]]
+            d["acceptance rate"] = (d["acceptance rate"] * done + b["acceptance rate"] * n) / (done + n)
+        save()
+    return ChainResult(sampler, samples, chain_diagnostics, dict(sampler.timings))
+
+
+### Persistent pool of chain workers
+
+def _run_chain(model, args, kwargs, num_warmup, num_samples, kernel_kwargs, seed):
+    pyro.set_rng_seed(seed)
+    pyro.clear_param_store()
+    engine = MCMC(NUTS(model, **kernel_kwargs), num_samples, num_warmup, disable_progbar=True)
+    engine.run(*unpack(args), **unpack(kwargs))
+    samples = {k: v[0].detach().numpy() for k, v in engine.get_samples(group_by_chain=True).items()}
+    chain_diagnostics = {
+        k: v["chain 0"] for k, v in engine.diagnostics().items() if isinstance(v, dict) and "chain 0" in v
+    }
+    return samples, chain_diagnostics
+
+
+class ChainPool:
+    """Worker processes that run single NUTS chains and stay alive between runs
+
+    ``MCMC(..., num_chains=k)`` starts k fresh processes for every run and tears them
+    down afterwards, which dominates short runs. The pool is started once; later runs
+    only send the model and the data. Inputs and draws cross the process boundary as
+    numpy arrays, so ``torch.multiprocessing.set_sharing_strategy('file_system')`` is
+    not needed. Each chain gets its own seed, drawn from torch's generator, so
+    ``pyro.set_rng_seed`` in the parent makes runs reproducible. With
+    ``mp_context='spawn'`` the workers import the model by name, so it must be defined
+    at module level of an importable file whose script part is under a ``__main__``
+    guard; models defined in a notebook or inside a function raise a RuntimeError
+    saying so (and the pool is restarted).
+    Arguments:
+        num_workers (int): number of processes (default: number of cpus)
+        mp_context (str): multiprocessing start method
+    """
+    def __init__(self, num_workers=None, mp_context="spawn"):
+        self.num_workers = num_workers or os.cpu_count()
+        self.mp_context = mp_context
+        self._start()
+
+    def _start(self):
+        self._executor = ProcessPoolExecutor(self.num_workers, mp_context=mp.get_context(self.mp_context),
+                                             initializer=init_worker)
+
+    def run(self, model, args, kwargs, num_warmup, num_samples, num_chains=1, **kernel_kwargs):
+        kernel = NUTS(model, **kernel_kwargs)
+        seeds = torch.randint(2**31, (num_chains,)).tolist()
+        args, kwargs = pack(args), pack(kwargs)
+        futures = [
+            self._executor.submit(_run_chain, model, args, kwargs, num_warmup, num_samples, kernel_kwargs, seed)
+            for seed in seeds
+        ]
+        try:
+            chains = [f.result() for f in futures]
+        except (BrokenProcessPool, pickle.PicklingError, AttributeError) as e:
+            if isinstance(e, AttributeError) and "pickle" not in str(e):
+                raise
+            # the workers are lost (or never got the model); the next run gets fresh ones
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._start()
+            raise RuntimeError(
+                f"the chain workers could not run {getattr(model, '__qualname__', model)} ({e}). Worker "
+                "processes import the model by name: define it at module level in a file that guards "
+                "its script part with `if __name__ == \"__main__\":`, not in a notebook or a function; "
+                "or use a model that vectorizes over chains") from e
+        samples = {k: torch.stack([torch.from_numpy(s[k]) for s, _ in chains]) for k in chains[0][0]}
+        return ChainResult(kernel, samples, [d for _, d in chains])
+
+    def shutdown(self):
+        self._executor.shutdown()
+
+
+_pool = None
+
+
+def get_pool(num_workers=None):
+    """The pool shared by successive runs, (re)started when a different size is asked for"""
+    global _pool
+    if _pool is not None and num_workers is not None and _pool.num_workers != num_workers:
+        _pool.shutdown()
+        _pool = None
+    if _pool is None:
+        _pool = ChainPool(num_workers)
+    return _pool
+
+
+def run_chains(model, args, kwargs, num_warmup, num_samples, num_chains=1, chain_method="vectorized",
+               num_workers=None, **kernel_kwargs):
+    """Runs ``num_chains`` NUTS chains without starting processes for every run
+
+    Arguments:
+        model (callable): the model
+        args (tuple), kwargs (dict): inputs of the model
+        num_warmup, num_samples (int): warmup and kept draws per chain
+        num_chains (int): number of chains
+        chain_method (str): "vectorized" batches all chains in one process
+            (``VectorizedNUTS``) and falls back to the pool for models that do not
+            vectorize; "pool" runs one chain per task on the persistent ``ChainPool``,
+            whose workers import the model by name (see ``ChainPool``)
+        num_workers (int): size of the pool
+        **kernel_kwargs: arguments of NUTS
+    Returns:
+        ChainResult: the draws, grouped by chain
+    """
+    if chain_method == "vectorized":
+        try:
+            sampler = VectorizedNUTS(model, num_chains, **kernel_kwargs)
+            sampler.setup(*args, **kwargs)
+        except (TypeError, RuntimeError, ValueError, IndexError) as e:
+            warnings.warn(f"vectorized chains failed ({e}); falling back to the process pool")
+        else:
+            return sampler.run(num_warmup, num_samples)
+    elif chain_method != "pool":
+        raise ValueError(f"unknown chain_method {chain_method}")
+    return get_pool(num_workers).run(model, args, kwargs, num_warmup, num_samples, num_chains, **kernel_kwargs)
@@ -1,42 +1,278 @@
+import copy
+import multiprocessing as mp
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
 import tqdm
 import torch
 tt = torch.tensor
 import pyro
+from pyro import poutine
 from pyro.infer import SVI, Trace_ELBO
+from pyro.infer.util import zero_grads
+from pyro.poutine.messenger import Messenger
+from pyro.poutine.util import site_is_subsample
 import pyro.infer.autoguide
-from pyro.infer.autoguide import AutoMultivariateNormal, AutoDiagonalNormal, init_to_mean,  AutoLaplaceApproximation
+from pyro.infer.autoguide import AutoMultivariateNormal, AutoDiagonalNormal, AutoNormal, AutoDelta, init_to_mean, init_to_uniform, AutoLaplaceApproximation
 from pyro.optim import Adam
 from pyro.distributions import Normal, Exponential
+from torch.distributions import transform_to
 from pyro.infer.mcmc import NUTS, MCMC
 from pyro.infer.mcmc.nuts import HMC
 
+from frames import frame_tensors
+from workers import init_worker, pack, unpack
+
+class _ScaleSites(Messenger):
+    """Scales the log density of the sample sites inside the plate named ``plate``"""
+    def __init__(self, plate, scale):
+        super().__init__()
+        self.plate = plate
+        self.scale = scale
+
+    def _process_message(self, msg):
+        if any(frame.name == self.plate for frame in msg["cond_indep_stack"]):
+            msg["scale"] = msg["scale"] * self.scale
+
+
+class _RowBatch:
+    """Context in which the columns of a model are the rows ``idx``"""
+    def __init__(self, model, idx, plate):
+        self.model, self.idx, self.plate = model, idx, plate
+
+    def __enter__(self):
+        m = self.model
+        self.full = {col: getattr(m, col) for col in m._columns}
+        for col, v in self.full.items():
+            setattr(m, col, v[self.idx])
+        m._plate, m._batch_rows = self.plate, len(self.idx)
+
+    def __exit__(self, *exc):
+        for col, v in self.full.items():
+            setattr(self.model, col, v)
+        del self.model._plate, self.model._batch_rows
+
+
 class RegressionBase:
-    def __init__(self, df, categoricals=None):
-        if categoricals is None:
-            categoricals = []
-        for col in set(df.columns) - set(categoricals):
-            setattr(self, col, tt(df[col].values).double())
-        for col in categoricals:
-            setattr(self, col, tt(df[col].values).long())
+    """Base class of the regression models: every column of the data becomes a tensor attribute
+
+    Given a list of K DataFrames with the same columns and length instead of one, each
+    attribute stacks the K datasets along a leading dim, of shape (K, N), and ``train``
+    fits K independent replicates of the model at once. Subclasses support this when
+    ``__call__`` broadcasts over that leading dim (e.g. ``(self.X * beta).sum(-1)``
+    rather than ``beta @ self.X``); the replicates plate sits at ``replicate_dim``, left
+    of the model's own plates. ``dtype`` and ``design`` are those of ``frame_tensors``:
+    float32 data makes NUTS and SVI faster, and ``design`` adds the design matrix ``X``.
+    """
+    replicate_dim = -2
+
+    def __init__(self, df, categoricals=None, dtype=torch.float64, design=None):
+        self.num_replicates = len(df) if isinstance(df, (list, tuple)) else None
+        tensors = frame_tensors(df, categoricals, dtype, design)
+        self.__dict__.update(tensors)
+        self._columns = list(tensors)
+        self.num_rows = (df[0] if self.num_replicates else df).shape[0]
             
     def __call__(self):
         raise NotImplementedError
-        
-    def train(self, num_steps, lr=1e-2, restart=True, autoguide=None, use_tqdm=True):
+
+    def replicated(self, *args, **kwargs):
+        # the model with every replicate in its own slice of the replicates plate
+        with pyro.plate("replicates", self.num_replicates, dim=self.replicate_dim):
+            return self(*args, **kwargs)
+
+    def replicate_elbo(self, *args, **kwargs):
+        """Single-sample Trace_ELBO estimate of every replicate, shape (K,)
+
+        The model and guide are traced once for all replicates; log densities are
+        summed over every dim except the replicates one instead of over everything.
+        """
+        guide_tr = poutine.trace(self.guide).get_trace(*args, **kwargs)
+        model_tr = poutine.trace(poutine.replay(self.replicated, trace=guide_tr)).get_trace(*args, **kwargs)
+        elbo = 0.
+        for tr, sign in ((model_tr, 1.), (guide_tr, -1.)):
+            tr.compute_log_prob()
+            for site in tr.nodes.values():
+                if site["type"] != "sample" or site_is_subsample(site):
+                    continue
+                log_prob = site["log_prob"]
+                log_prob = log_prob.movedim(log_prob.dim() + self.replicate_dim, 0)
+                elbo = elbo + sign * log_prob.reshape(self.num_replicates, -1).sum(-1)
+        return elbo
+
+    def replicate_params(self):
+        """Fitted guide parameters, indexed by replicate along the leading dim"""
+        return {name: value.detach() for name, value in pyro.get_param_store().items()}
+
+    def train(self, num_steps, lr=1e-2, restart=True, autoguide=None, use_tqdm=True, batch_size=None,
+              tol=None, window=100, plate="N", init_loc_fn=init_to_mean):
+        """Fits the guide with SVI
+
+        With ``batch_size`` every step sees a mini-batch of the rows instead of all of
+        them: the rows are visited in a new random order every epoch, every column with
+        one entry per row is sliced to the batch, and the log densities of the sites in
+        ``plate`` are scaled by rows / batch size, so the ELBO stays an unbiased estimate
+        of the full-data one at O(batch_size) cost per step. The latent sites must be
+        global (outside ``plate``).
+        With ``tol`` the fit stops early once the loss improves by less than ``tol``
+        (relative) from one window of ``window`` steps to the next; ``num_steps`` is then
+        the maximum number of steps. With ``batch_size`` the loss of a step is a noisy
+        mini-batch estimate and the fit itself jitters, so the loss of a window is instead
+        a 10 particle estimate of the full-data loss at its end (with the same random
+        numbers every time, so that successive estimates differ by the change of the fit
+        rather than by their noise), and the fit stops once 3 windows in a row fail to
+        improve on the best one by ``tol``. The test is relative to
+        the whole loss, which grows with the number of rows while the terms that set the
+        posterior scales do not: on large data sets ``tol`` has to be small (e.g. 1e-5)
+        for the scales to converge, not only the means.
+        Returns:
+            List[float]: the loss of every step
+        """
+        if self.num_replicates is not None:
+            if batch_size is not None or tol is not None:
+                raise ValueError("<batch_size> and <tol> are not supported for replicates")
+            return self._train_replicates(num_steps, lr, restart, autoguide, use_tqdm, init_loc_fn)
         if restart:
             pyro.clear_param_store()
             if autoguide is None:
                 autoguide = AutoMultivariateNormal
             else:
                 autoguide = getattr(pyro.infer.autoguide, autoguide)
-            self.guide = autoguide(self, init_loc_fn=init_to_mean)
-        svi = SVI(self, guide=self.guide, optim=Adam({"lr": lr}), loss=Trace_ELBO())
+            self.guide = autoguide(self, init_loc_fn=init_loc_fn)
+        model = self if batch_size is None else self._subsampled
+        svi = SVI(model, guide=self.guide, optim=Adam({"lr": lr}), loss=Trace_ELBO())
+        batches = None if batch_size is None else self._batches(batch_size, plate)
+        full_elbo = Trace_ELBO(num_particles=10)
+        loss, window_loss = [], []
+        patience = 1 if batches is None else 3
+        if use_tqdm:
+            iterator = tqdm.notebook.tnrange(num_steps)
+        else:
+            iterator = range(num_steps)
+        for step in iterator:
+            if batches is None:
+                loss.append(svi.step())
+            else:
+                with next(batches):
+                    loss.append(svi.step())
+            if tol is not None and (step + 1) % window == 0:
+                if batches is None:
+                    window_loss.append(np.mean(loss[-window:]))
+                else:
+                    # the same guide draws at every check, so that their noise cancels in the difference
+                    with torch.random.fork_rng(devices=[]):
+                        torch.manual_seed(0)
+                        window_loss.append(full_elbo.loss(self, self.guide))
+                best = min(window_loss[:-patience] or [np.inf])
+                if len(window_loss) > patience and all(best - w < tol * abs(w) for w in window_loss[-patience:]):
+                    break
+        return loss
+
+    def _batches(self, batch_size, plate):
+        # endless stream of mini-batches, reshuffled every epoch
+        while True:
+            for idx in torch.randperm(self.num_rows).split(batch_size):
+                yield _RowBatch(self, idx, plate)
+
+    def _subsampled(self, *args, **kwargs):
+        with _ScaleSites(self._plate, self.num_rows / self._batch_rows):
+            return self(*args, **kwargs)
+
+    def _train_replicates(self, num_steps, lr, restart, autoguide, use_tqdm, init_loc_fn=init_to_mean):
+        # one optimizer over the parameters of all replicates; Adam is elementwise and the
+        # replicates share no parameters, so each one follows its own loss
+        if restart:
+            pyro.clear_param_store()
+            autoguide = getattr(pyro.infer.autoguide, autoguide or "AutoNormal")
+            if autoguide not in (AutoNormal, AutoDelta):
+                raise ValueError(f"{autoguide.__name__} couples the replicates; use AutoNormal or AutoDelta")
+            self.guide = autoguide(self.replicated, init_loc_fn=init_loc_fn)
+        optim = Adam({"lr": lr})
         loss = []
         if use_tqdm:
             iterator = tqdm.notebook.tnrange(num_steps)
         else:
             iterator = range(num_steps)
         for _ in iterator:
-            loss.append(svi.step())
-        return loss
+            with poutine.trace(param_only=True) as param_capture:
+                elbo = self.replicate_elbo()
+                (-elbo.sum()).backward()
+            params = set(site["value"].unconstrained() for site in param_capture.trace.nodes.values())
+            optim(params)
+            zero_grads(params)
+            loss.append(-elbo.detach().numpy())
+        # (num_steps, K) losses, one column per replicate
+        return np.stack(loss)
+
+    def train_restarts(self, num_restarts, num_steps, method="pool", num_workers=None, autoguide=None,
+                       window=None, seed=0, **train_kwargs):
+        """Fits the guide from ``num_restarts`` random initializations and keeps the best
+
+        Every restart starts from uniform draws in (-2, 2) on the unconstrained space
+        (``init_to_uniform``). With ``method="pool"`` the restarts run as ``train`` in
+        worker processes, each with its own parameter store; with "vectorized" they run
+        in this process as replicates of the same data (see ``_train_replicates``, which
+        needs AutoNormal or AutoDelta and a model that broadcasts over replicates). The
+        restart with the lowest mean loss over the last ``window`` steps (default: a
+        tenth of them) wins: its parameters are loaded into the parameter store and
+        ``self.guide``, as after ``train``.
+        Arguments:
+            num_restarts (int): number of restarts R
+            num_steps (int): SVI steps per restart
+            method (str): "pool" or "vectorized"
+            num_workers (int): pool size (default: number of cpus)
+            seed (int): base seed (restart r of the pool uses seed + r)
+            **train_kwargs: arguments of ``train``
+        Returns:
+            Tuple[int, List[np.array]]: index of the best restart and the loss curve of every restart
+        """
+        window = window or max(1, num_steps // 10)
+        if method == "pool":
+            autoguide = autoguide or "AutoMultivariateNormal"
+            # the data go to the workers as numpy arrays (see mcmc.ChainPool), without any fitted guide
+            state = pack({k: v for k, v in self.__dict__.items() if k != "guide"})
+            with ProcessPoolExecutor(num_workers or min(num_restarts, os.cpu_count()),
+                                     mp_context=mp.get_context("spawn"), initializer=init_worker) as pool:
+                runs = list(pool.map(_fit_restart, [type(self)] * num_restarts, [state] * num_restarts,
+                                     range(seed, seed + num_restarts), [num_steps] * num_restarts,
+                                     [autoguide] * num_restarts, [train_kwargs] * num_restarts))
+            losses = [np.asarray(loss) for loss, _ in runs]
+            best = int(np.argmin([loss[-window:].mean() for loss in losses]))
+            state = unpack(runs[best][1])
+        elif method == "vectorized":
+            autoguide = autoguide or "AutoNormal"
+            pyro.set_rng_seed(seed)
+            replicates = copy.copy(self)
+            for col in self._columns:
+                v = getattr(self, col)
+                setattr(replicates, col, v.expand((num_restarts,) + v.shape))
+            replicates.num_replicates = num_restarts
+            loss = replicates.train(num_steps, autoguide=autoguide, use_tqdm=False, init_loc_fn=init_to_uniform,
+                                    **train_kwargs)
+            losses = list(loss.T)
+            best = int(np.argmin(loss[-window:].mean(0)))
+            params = replicates.replicate_params()
+            # the parameters of the best replicate, in the shapes of the unreplicated guide
+            pyro.clear_param_store()
+            getattr(pyro.infer.autoguide, autoguide)(self, init_loc_fn=init_to_mean)()
+            state = pyro.get_param_store().get_state()
+            for name, value in state["params"].items():
+                constrained = params[name][best].reshape(value.shape)
+                state["params"][name] = transform_to(state["constraints"][name]).inv(constrained)
+        else:
+            raise ValueError(f"unknown method {method}")
+        pyro.clear_param_store()
+        pyro.get_param_store().set_state(state)
+        self.guide = getattr(pyro.infer.autoguide, autoguide)(self, init_loc_fn=init_to_mean)
+        self.guide()
+        return best, losses
+
 
+def _fit_restart(cls, state, seed, num_steps, autoguide, train_kwargs):
+    # runs in a worker process, whose parameter store belongs to this restart alone
+    model = cls.__new__(cls)
+    model.__dict__.update(unpack(state))
+    pyro.set_rng_seed(seed)
+    loss = model.train(num_steps, autoguide=autoguide, use_tqdm=False, init_loc_fn=init_to_uniform, **train_kwargs)
+    return loss, pack(pyro.get_param_store().get_state())
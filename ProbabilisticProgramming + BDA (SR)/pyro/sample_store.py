@@ -0,0 +1,140 @@
+import json
+import os
+import re
+from collections.abc import Mapping
+
+import numpy as np
+
+_INDEXED = re.compile(r"^(.*?)((?:\[\d+\])+)$")
+
+
+class SampleStore(Mapping):
+    """Draws of a model on disk, one memory-mapped array per site
+
+    Every site is a ``.npy`` file of shape (chains, draws, *site_shape) in the directory
+    ``path``; ``meta.json`` records the site names, shapes, dtypes and dimension names
+    (``chain``, ``draw``, then ``<site>_dim_<i>`` unless given, as in ArviZ). Draws are
+    written chunk by chunk into preallocated files, so a model with many draws or large
+    sites never has to fit in memory, and reading is lazy: ``store["b"]`` is a read-only
+    memmap and ``store["b[1]"]`` a view of one component, neither of which loads data
+    until it is used. The store is a mapping of site names to (chains, draws, ...) arrays,
+    so ``precis``, ``traceplot`` and ``trankplot`` can read from it directly.
+
+    usage:
+        store = SampleStore("m9_1_samples")
+        store.add(mcmc.get_samples(group_by_chain=True), group_by_chain=True)
+        precis(store, detailed=True)
+        trankplot(store.select("a[0]", "a[1]", "sigma"), num_chains=4)
+        store.to_netcdf("m9_1.nc")
+    Arguments:
+        path (str): directory of the store, created if needed
+    """
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.meta = {"sites": {}}
+        if os.path.exists(self._meta_path):
+            with open(self._meta_path) as f:
+                self.meta = json.load(f)
+        self._arrays = dict()
+
+    @property
+    def _meta_path(self):
+        return os.path.join(self.path, "meta.json")
+
+    def _save_meta(self):
+        with open(self._meta_path + ".tmp", "w") as f:
+            json.dump(self.meta, f, indent=1)
+        os.replace(self._meta_path + ".tmp", self._meta_path)
+
+    def allocate(self, name, num_chains, num_draws, shape=(), dtype=np.float32, dims=None):
+        """Creates (or replaces) the file of a site, to be filled with ``write``"""
+        shape = tuple(shape)
+        if dims is None:
+            dims = [f"{name}_dim_{i}" for i in range(len(shape))]
+        fn = self.meta["sites"][name]["file"] if name in self.meta["sites"] else f"site_{len(self.meta['sites'])}.npy"
+        self._arrays.pop(name, None)
+        np.lib.format.open_memmap(os.path.join(self.path, fn), mode="w+", dtype=np.dtype(dtype),
+                                  shape=(num_chains, num_draws) + shape)
+        self.meta["sites"][name] = {"file": fn, "shape": [num_chains, num_draws, *shape],
+                                    "dtype": np.dtype(dtype).str, "dims": ["chain", "draw", *dims]}
+        self._save_meta()
+
+    def write(self, name, values, start=0, chain=None):
+        """Writes draws ``start:start + len`` of a site, for one chain or (chain=None) all chains
+
+        ``values`` is (chains, n, *site_shape), or (n, *site_shape) when ``chain`` is given.
+        """
+        values = _to_numpy(values)
+        info = self.meta["sites"][name]
+        out = np.load(os.path.join(self.path, info["file"]), mmap_mode="r+")
+        if chain is None:
+            out[:, start:start + values.shape[1]] = values
+        else:
+            out[chain, start:start + values.shape[0]] = values
+        out.flush()
+        del out
+
+    def add(self, samples, group_by_chain=False, chunk_size=1000, dims=None):
+        """Writes a dictionary of draws, ``chunk_size`` draws at a time
+
+        Arguments:
+            samples (Dict[str, array]): draws of shape [[chains,] draws [, idx1, ...]],
+                as numpy arrays or tensors
+            group_by_chain (bool): whether the leading axis indexes chains
+            dims (Dict[str, List[str]]): dimension names of the site components
+        """
+        dims = dims or {}
+        for name, v in samples.items():
+            if not group_by_chain:
+                v = v[None]
+            first = _to_numpy(v[:, :1])
+            self.allocate(name, v.shape[0], v.shape[1], first.shape[2:], first.dtype, dims.get(name))
+            for start in range(0, v.shape[1], chunk_size):
+                self.write(name, v[:, start:start + chunk_size], start)
+        return self
+
+    @classmethod
+    def from_mcmc(cls, mcmc, path, chunk_size=1000):
+        """Store of the draws of a fitted ``MCMC`` (or ``ChainResult``), grouped by chain"""
+        return cls(path).add(mcmc.get_samples(group_by_chain=True), group_by_chain=True, chunk_size=chunk_size)
+
+    def __getitem__(self, name):
+        match = _INDEXED.match(name)
+        if name not in self.meta["sites"] and match is not None:
+            # b[1][2] -> a view of component (1, 2) of site b
+            idx = tuple(int(i) for i in re.findall(r"\d+", match.group(2)))
+            return self[match.group(1)][(slice(None), slice(None), *idx)]
+        if name not in self._arrays:
+            info = self.meta["sites"][name]
+            self._arrays[name] = np.load(os.path.join(self.path, info["file"]), mmap_mode="r")
+        return self._arrays[name]
+
+    def __iter__(self):
+        return iter(self.meta["sites"])
+
+    def __len__(self):
+        return len(self.meta["sites"])
+
+    @property
+    def num_chains(self):
+        return next(iter(self.meta["sites"].values()))["shape"][0]
+
+    def select(self, *names):
+        """Lazy (chains, draws) views of the given sites or components, e.g. "b[1]" """
+        return {name: self[name] for name in names}
+
+    def to_inference_data(self, coords=None):
+        """The draws as the posterior group of an ``arviz.InferenceData`` (loads them)"""
+        import arviz as az
+        dims = {name: info["dims"][2:] for name, info in self.meta["sites"].items()}
+        return az.from_dict(posterior={name: np.asarray(self[name]) for name in self}, coords=coords, dims=dims)
+
+    def to_netcdf(self, filename, coords=None):
+        return self.to_inference_data(coords).to_netcdf(filename)
+
+
+def _to_numpy(v):
+    if hasattr(v, "detach"):
+        return v.detach().cpu().numpy()
+    return np.asarray(v)
@@ -0,0 +1,208 @@
+import functools
+import hashlib
+import multiprocessing as mp
+import os
+import pickle
+import zlib
+
+import numpy as np
+import torch
+import pyro
+
+
+class RunningMoments:
+    """Streaming mean and variance (Welford), mergeable across workers (Chan et al.)
+
+    Arguments:
+        shape (tuple): shape of one observation (e.g. (2,) for in/out-of-sample deviance)
+    """
+    def __init__(self, shape=()):
+        self.n = 0
+        self.mean = np.zeros(shape)
+        self.m2 = np.zeros(shape)
+
+    def update(self, x):
+        x = np.asarray(x, dtype=float)
+        self.n += 1
+        delta = x - self.mean
+        self.mean = self.mean + delta / self.n
+        self.m2 = self.m2 + delta * (x - self.mean)
+
+    def update_batch(self, xs):
+        # observations along the leading dim of xs
+        xs = np.asarray(xs, dtype=float)
+        batch = RunningMoments(xs.shape[1:])
+        batch.n = len(xs)
+        batch.mean = xs.mean(0)
+        batch.m2 = ((xs - batch.mean)**2).sum(0)
+        return self.merge(batch)
+
+    def merge(self, other):
+        if other.n == 0:
+            return self
+        n = self.n + other.n
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * other.n / n
+        self.m2 = self.m2 + other.m2 + delta**2 * self.n * other.n / n
+        self.n = n
+        return self
+
+    def var(self, ddof=0):
+        return self.m2 / (self.n - ddof)
+
+    def std(self, ddof=0):
+        return np.sqrt(self.var(ddof))
+
+
+def _init_worker():
+    # one simulation per process at a time; more intra-op threads would oversubscribe the cpus
+    torch.set_num_threads(1)
+
+
+def _fingerprint(fn, batched):
+    """Digest of the simulation: the qualified name, bytecode and constants of ``fn``
+    (and the arguments bound by a ``functools.partial``) and ``batched``"""
+    h = hashlib.sha1()
+    while isinstance(fn, functools.partial):
+        h.update(repr((fn.args, sorted(fn.keywords.items()))).encode())
+        fn = fn.func
+    h.update(f"{getattr(fn, '__module__', '')}.{getattr(fn, '__qualname__', type(fn).__qualname__)}".encode())
+    code = getattr(fn, "__code__", None)
+    if code is not None:
+        h.update(code.co_code)
+        h.update(repr(code.co_consts).encode())
+    h.update(repr(batched).encode())
+    return h.hexdigest()
+
+
+def _run_chunk(task):
+    fn, key, chunk, seeds, batched = task
+    stats = None
+    for seed in seeds:
+        pyro.set_rng_seed(seed)
+        x = np.asarray(fn(**dict(key)), dtype=float)
+        if stats is None:
+            stats = RunningMoments(x.shape[1:] if batched else x.shape)
+        if batched:
+            stats.update_batch(x)
+        else:
+            stats.update(x)
+    return key, chunk, stats
+
+
+class SimulationGrid:
+    """Repeats a simulation for every point of a parameter grid on one persistent pool
+
+    ``fn(**params)`` is run ``num_simulations`` times for every ``params`` in ``grid``.
+    Simulations are grouped into chunks of ``chunk_size``; a worker aggregates its
+    chunk into ``RunningMoments`` and the parent merges chunks as they complete
+    (``imap_unordered``), so memory does not grow with the number of simulations. Every
+    simulation is seeded from (seed, params, index), so the aggregates (up to rounding) do
+    not depend on the chunking, the number of workers or the order chunks finish in. With
+    ``checkpoint`` set, the aggregates and the completed chunks are saved every
+    ``checkpoint_every`` chunks and an interrupted grid resumes where it stopped. The
+    checkpoint records a fingerprint of ``fn`` (its code and bound arguments) and of
+    ``batched``, and one made with a different simulation or settings is refused.
+    With ``batched=True`` every call of ``fn`` returns a batch of simulations along its
+    leading dim (e.g. replicates fitted together), each aggregated as one observation.
+
+    usage:
+        grid = SimulationGrid(train_test, [dict(N=N, n_feat=k) for N in (20, 100) for k in range(1, 6)],
+                              num_simulations=10000, checkpoint="deviance.pkl")
+        stats = grid.run()  # {(("N", 20), ("n_feat", 1)): RunningMoments, ...}
+        grid.close()
+    Arguments:
+        fn (callable): picklable simulation returning a number or an array
+        grid (List[dict]): parameter sets, passed to ``fn`` as keyword arguments
+        num_simulations (int): calls of ``fn`` per parameter set
+        chunk_size (int): simulations per task
+        max_workers (int): pool size (default: number of cpus)
+        checkpoint (str): path of the checkpoint file
+        checkpoint_every (int): chunks between checkpoints
+        seed (int): base seed
+        mp_context (str): multiprocessing start method
+        batched (bool): whether ``fn`` returns a batch of simulations
+    """
+    def __init__(self, fn, grid, num_simulations, chunk_size=100, max_workers=None, checkpoint=None,
+                 checkpoint_every=10, seed=0, mp_context="spawn", batched=False):
+        self.fn = fn
+        self.batched = batched
+        self.keys = [tuple(sorted(params.items())) for params in grid]
+        self.num_simulations = num_simulations
+        self.chunk_size = chunk_size
+        self.checkpoint = checkpoint
+        self.checkpoint_every = checkpoint_every
+        self.seed = seed
+        self.fingerprint = _fingerprint(fn, batched)
+        self.stats = {key: RunningMoments() for key in self.keys}
+        self.done = set()
+        if checkpoint is not None and os.path.exists(checkpoint):
+            self.load(checkpoint)
+        self._pool = mp.get_context(mp_context).Pool(max_workers or os.cpu_count(), initializer=_init_worker)
+
+    def seeds(self, key, chunk):
+        start = chunk * self.chunk_size
+        stop = min(start + self.chunk_size, self.num_simulations)
+        entropy = (self.seed, zlib.crc32(repr(key).encode()))
+        return [int(np.random.SeedSequence(entropy + (i,)).generate_state(1)[0]) for i in range(start, stop)]
+
+    def tasks(self):
+        num_chunks = -(-self.num_simulations // self.chunk_size)
+        for key in self.keys:
+            for chunk in range(num_chunks):
+                if (key, chunk) not in self.done:
+                    yield self.fn, key, chunk, self.seeds(key, chunk), self.batched
+
+    def run(self, progress=None):
+        """Runs the remaining chunks and returns the aggregates per parameter set
+
+        Arguments:
+            progress (callable): called with the number of simulations of every finished chunk
+        Returns:
+            Dict[tuple, RunningMoments]: aggregates keyed by the sorted (name, value) pairs of the parameters
+        """
+        since_checkpoint = 0
+        for key, chunk, stats in self._pool.imap_unordered(_run_chunk, self.tasks()):
+            self.stats[key].merge(stats)
+            self.done.add((key, chunk))
+            if progress is not None:
+                progress(stats.n)
+            since_checkpoint += 1
+            if self.checkpoint is not None and since_checkpoint == self.checkpoint_every:
+                self.save(self.checkpoint)
+                since_checkpoint = 0
+        if self.checkpoint is not None:
+            self.save(self.checkpoint)
+        return self.stats
+
+    def num_done(self):
+        return sum(stats.n for stats in self.stats.values())
+
+    def save(self, path):
+        # written to a temporary file and renamed, so an interruption never corrupts the checkpoint
+        state = {
+            "num_simulations": self.num_simulations,
+            "chunk_size": self.chunk_size,
+            "seed": self.seed,
+            "fingerprint": self.fingerprint,
+            "stats": self.stats,
+            "done": self.done,
+        }
+        with open(path + ".tmp", "wb") as f:
+            pickle.dump(state, f)
+        os.replace(path + ".tmp", path)
+
+    def load(self, path):
+        with open(path, "rb") as f:
+            state = pickle.load(f)
+        for name in ("num_simulations", "chunk_size", "seed"):
+            if state[name] != getattr(self, name):
+                raise ValueError(f"checkpoint {path} was made with {name}={state[name]}, not {getattr(self, name)}")
+        if state.get("fingerprint") != self.fingerprint:
+            raise ValueError(f"checkpoint {path} was made with a different simulation function or batched setting")
+        self.stats.update({key: stats for key, stats in state["stats"].items() if key in self.stats})
+        self.done = {(key, chunk) for key, chunk in state["done"] if key in self.stats}
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
@@ -0,0 +1,74 @@
+import itertools
+import random
+
+import networkx as nx
+import pytest
+
+from causal import DSeparation, independence_table, minimal_adjustment_sets
+from utils import independent
+
+
+def _random_dag(seed, n=8, p=0.3):
+    # edges follow a random order of the nodes, so the names carry no topological order
+    rng = random.Random(seed)
+    names = [chr(ord("A") + i) for i in range(n)]
+    rng.shuffle(names)
+    G = nx.DiGraph()
+    G.add_nodes_from(sorted(names))
+    G.add_edges_from((names[i], names[j]) for i, j in itertools.combinations(range(n), 2) if rng.random() < p)
+    return G
+
+
+def _subsets(nodes, max_size):
+    return [set(z) for size in range(max_size + 1) for z in itertools.combinations(nodes, size)]
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_d_separation_matches_networkx(seed):
+    G = _random_dag(seed)
+    ds = DSeparation(G)
+    for x, y in itertools.combinations(G.nodes, 2):
+        for z in _subsets(set(G.nodes) - {x, y}, 2):
+            assert ds.d_separated(x, y, z) == nx.is_d_separator(G, {x}, {y}, z), (x, y, z)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_conditional_independencies_are_minimal_separators(seed):
+    G = _random_dag(seed, n=7)
+    found = DSeparation(G).conditional_independencies()
+    for x, y in itertools.combinations(sorted(G.nodes), 2):
+        separators = [z for z in _subsets(set(G.nodes) - {x, y}, 5) if nx.is_d_separator(G, {x}, {y}, z)]
+        minimal = [z for z in separators if not any(s < z for s in separators)]
+        assert sorted(map(sorted, found.get((x, y), []))) == sorted(map(sorted, minimal)), (x, y)
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_minimal_adjustment_sets_match_brute_force(seed):
+    G = _random_dag(seed, n=9, p=0.35)
+    ds = DSeparation(G)
+    for treatment, outcome in itertools.permutations(G.nodes, 2):
+        expected = sorted(ds.adjustment_sets(treatment, outcome), key=lambda s: (len(s), sorted(s)))
+        assert minimal_adjustment_sets(G, treatment, outcome) == expected, (treatment, outcome)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_independence_table_matches_independent(seed):
+    G = _random_dag(seed)
+    table = independence_table(G, max_conditioning=2, only_independent=False)
+    rows = {(x, y, given): ind for x, y, given, ind in table.itertuples(index=False)}
+    count = 0
+    for size in range(3):
+        for z in itertools.combinations(G.nodes, size):
+            for x, y in itertools.combinations(set(G.nodes) - set(z), 2):
+                x, y = sorted((x, y), key=list(G.nodes).index)
+                assert rows[(x, y, z)] == independent(G, x, y, set(z)), (x, y, z)
+                count += 1
+    assert count == len(table)
+    only = independence_table(G, max_conditioning=2)
+    assert only.equals(table[table["independent"]].reset_index(drop=True))
+
+
+def test_independence_table_workers():
+    G = _random_dag(0)
+    serial = independence_table(G, max_conditioning=2, only_independent=False)
+    assert serial.equals(independence_table(G, max_conditioning=2, only_independent=False, num_workers=2))
@@ -0,0 +1,52 @@
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+import numpy as np
+from scipy.stats import rankdata
+
+from diagnostics import chain_components, decimate, rank_draws, rank_histograms, traceplot, trankplot
+from sample_store import SampleStore
+
+
+def _samples():
+    rng = np.random.default_rng(0)
+    return {"a": rng.normal(size=(3, 400)), "b": rng.normal(size=(3, 400, 2)).round(1)}
+
+
+def test_ranks_and_histograms():
+    components = chain_components(_samples(), num_chains=3)
+    assert list(components) == ["a", "b[0]", "b[1]"]
+    ranks = rank_draws(components)
+    for r, v in zip(ranks, components.values()):
+        # pooled over chains, ties averaged
+        assert np.array_equal(r, rankdata(v).reshape(v.shape))
+    counts = rank_histograms(ranks, num_bins=20)
+    edges = np.linspace(1, 1201, 21)
+    for c, r in zip(counts, ranks):
+        assert np.array_equal(c, [np.histogram(rc, edges)[0] for rc in r])
+
+
+def test_decimate_keeps_the_envelope():
+    y = np.random.default_rng(1).normal(size=(2, 10001))
+    y[1, 5000] = 100.
+    x, d = decimate(y, max_points=200)
+    assert d.shape == (2, 200) and x.shape == (200,)
+    assert np.array_equal(d.max(-1), y.max(-1)) and np.array_equal(d.min(-1), y.min(-1))
+    assert np.all(np.diff(x) >= 0)
+    x, d = decimate(y[:, :150], max_points=200)
+    assert np.array_equal(d, y[:, :150]) and np.array_equal(x, np.arange(150))
+
+
+def test_plots_read_a_store(tmp_path):
+    samples = _samples()
+    store = SampleStore(str(tmp_path)).add(samples, group_by_chain=True)
+    components = chain_components(store)
+    for k, v in chain_components(samples, num_chains=3).items():
+        assert np.array_equal(components[k], v)
+    for fig in (traceplot(store, max_points=100), trankplot(store), trankplot(samples, 3, shared=True)):
+        assert len(fig.axes) in (1, 3)
+        plt.close(fig)
+    # a single chain has no chain axis
+    fig = traceplot({"a": samples["a"][0]})
+    assert len(fig.axes) == 1
+    plt.close(fig)
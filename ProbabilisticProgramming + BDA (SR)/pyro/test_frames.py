@@ -0,0 +1,39 @@
+import numpy as np
+import pandas as pd
+import torch
+
+from frames import frame_tensors
+
+
+def _frame():
+    return pd.DataFrame({"x": np.arange(5.), "n": np.arange(5), "cid": [0, 1, 0, 1, 1]})
+
+
+def test_in_place_edits_stay_local():
+    df = _frame()
+    t = frame_tensors(df, ["cid"])
+    t["x"] -= t["x"].mean()
+    t["cid"] += 1
+    assert np.array_equal(df["x"], np.arange(5.))
+    again = frame_tensors(df, ["cid"])
+    assert torch.equal(again["x"], torch.arange(5.).double())
+    assert torch.equal(again["cid"], torch.tensor([0, 1, 0, 1, 1]))
+
+
+def test_cache_and_zero_copy():
+    df = _frame()
+    first = frame_tensors(df, ["cid"], design=["x", "n"], copy=False)
+    second = frame_tensors(df, ["cid"], design=["x", "n"], copy=False)
+    # converted once, and a float64 column is not copied at all
+    assert all(first[k].data_ptr() == second[k].data_ptr() for k in first)
+    assert first["x"].data_ptr() == df["x"].to_numpy().__array_interface__["data"][0]
+    assert first["X"].shape == (5, 2) and first["n"].dtype == torch.float64
+    df["x"] = df["x"] * 10
+    assert torch.equal(frame_tensors(df, copy=False)["x"], 10 * torch.arange(5.).double())
+
+
+def test_replicates():
+    frames = [_frame(), _frame() + 1]
+    t = frame_tensors(frames, ["cid"])
+    assert t["x"].shape == (2, 5) and t["cid"].dtype == torch.int64
+    assert torch.equal(t["n"][1], torch.arange(1., 6.).double())
@@ -0,0 +1,133 @@
+import pytest
+import torch
+import pyro
+import pyro.distributions as dist
+from pyro.infer.mcmc import NUTS, MCMC
+
+import mcmc
+from mcmc import ChainPool, VectorizedNUTS, _potential_cache, clear_potential_cache, run_chains, run_checkpointed
+from test_utils import _session_module
+
+
+def _regression(x, y):
+    a = pyro.sample("a", dist.Normal(0., 10.))
+    b = pyro.sample("b", dist.Normal(0., 10.))
+    sigma = pyro.sample("sigma", dist.Exponential(1.))
+    with pyro.plate("N", len(x)):
+        pyro.sample("y", dist.Normal(a + b * x, sigma), obs=y)
+
+
+def _no_latents(y):
+    pyro.sample("y", dist.Normal(0., 1.), obs=y)
+
+
+def _compare_with_nuts(model, args, kwargs, num_chains=4):
+    pyro.set_rng_seed(0)
+    vectorized = VectorizedNUTS(model, num_chains)
+    vectorized.setup(*args, **kwargs)
+    ours = vectorized.run(300, 500).get_samples()
+    pyro.set_rng_seed(0)
+    engine = MCMC(NUTS(model), 1000, 300, disable_progbar=True)
+    engine.run(*args, **kwargs)
+    reference = engine.get_samples()
+    for name, v in reference.items():
+        v, w = v.double(), ours[name].double()
+        mean, sd = v.mean(0), v.std(0)
+        # a few Monte Carlo standard errors apart at most
+        assert torch.all((w.mean(0) - mean).abs() < 0.2 * sd), name
+        assert torch.allclose(w.std(0), sd, rtol=0.2), name
+
+
+def test_regression_matches_nuts():
+    pyro.set_rng_seed(1)
+    x = torch.randn(60, dtype=torch.float64)
+    y = 1 + 2 * x + 0.5 * torch.randn(60, dtype=torch.float64)
+    _compare_with_nuts(_regression, (x, y), {})
+
+
+def test_m9_1_matches_nuts():
+    s8 = _session_module("Session-8-MCMC_NUTS_w_num_chains.py")
+    pyro.set_rng_seed(1)
+    N = 80
+    cid = torch.randint(0, 2, (N,))
+    rugged = torch.rand(N)
+    data = {"cid": cid, "rugged_std": rugged,
+            "log_gdp_std": 1 + 0.2 * (cid == 0) * (rugged - 0.215) + 0.1 * torch.randn(N)}
+    _compare_with_nuts(s8.model_m9_1, (data,), {"training": True})
+
+
+def test_chain_result_shapes():
+    pyro.set_rng_seed(0)
+    x = torch.randn(20, dtype=torch.float64)
+    result = run_chains(_regression, (x, 2 * x), {}, 50, 30, num_chains=3)
+    assert {k: tuple(v.shape) for k, v in result.get_samples(group_by_chain=True).items()} == \
+        {"a": (3, 30), "b": (3, 30), "sigma": (3, 30)}
+    assert result.get_samples()["a"].shape == (90,)
+    assert result.num_chains == 3
+    assert set(result.timings) == {"compile", "warmup", "sampling"}
+
+
+def test_no_latents():
+    with pytest.raises(ValueError, match="no latent"):
+        VectorizedNUTS(_no_latents, 2).setup(torch.zeros(3))
+
+
+def test_chain_pool():
+    # the workers import _regression from this module by name
+    pyro.set_rng_seed(0)
+    x = torch.randn(20, dtype=torch.float64)
+    pool = ChainPool(2)
+    try:
+        result = pool.run(_regression, (x, 2 * x), {}, 30, 20, num_chains=2)
+    finally:
+        pool.shutdown()
+    assert result.get_samples(group_by_chain=True)["b"].shape == (2, 20)
+
+
+def test_checkpointed_extension_is_exact(tmp_path):
+    x = torch.randn(20, dtype=torch.float64)
+    args = (x, 1 + 2 * x)
+    pyro.set_rng_seed(0)
+    full = run_checkpointed(_regression, args, {}, 50, 60, 2, checkpoint=str(tmp_path / "full.pkl"),
+                            checkpoint_every=20).get_samples(group_by_chain=True)
+    path = str(tmp_path / "run.pkl")
+    pyro.set_rng_seed(0)
+    first = run_checkpointed(_regression, args, {}, 50, 20, 2, checkpoint=path,
+                             checkpoint_every=20).get_samples(group_by_chain=True)
+    # the resumed run restores the random state of the checkpoint, whatever the caller's
+    torch.manual_seed(123)
+    extended = run_checkpointed(_regression, args, {}, 50, 60, 2, checkpoint=path,
+                                checkpoint_every=20).get_samples(group_by_chain=True)
+    for k, v in full.items():
+        assert torch.equal(extended[k][:, :20], first[k])
+        assert torch.equal(extended[k], v)
+    with pytest.warns(UserWarning, match="starting over"):
+        restarted = run_checkpointed(_regression, (x, 2 * x), {}, 50, 20, 2, checkpoint=path)
+    assert restarted.get_samples(group_by_chain=True)["a"].shape == (2, 20)
+
+
+def _jit_sampler(x, y):
+    sampler = VectorizedNUTS(_regression, 2, jit_compile=True, ignore_jit_warnings=True)
+    sampler.setup(x, y)
+    return sampler
+
+
+def test_potential_cache(monkeypatch):
+    clear_potential_cache()
+    pyro.set_rng_seed(0)
+    x = torch.randn(20, dtype=torch.float64)
+    _jit_sampler(x, 2 * x)
+    assert len(_potential_cache) == 1
+    # new data of the same shape reuses the trace, which reads the new tensors
+    x2 = torch.randn(20, dtype=torch.float64)
+    sampler = _jit_sampler(x2, 1 - x2)
+    assert len(_potential_cache) == 1
+    q = torch.randn(2, sampler.dim, dtype=torch.float64)
+    assert torch.allclose(sampler._potential_fn(q), sampler.potential(q))
+    monkeypatch.setattr(mcmc, "POTENTIAL_CACHE_SIZE", 2)
+    for n in (10, 30):
+        x = torch.randn(n, dtype=torch.float64)
+        _jit_sampler(x, x)
+    assert len(_potential_cache) == 2
+    assert [k[-1][0][0] for k in _potential_cache] == [(10,), (30,)]
+    clear_potential_cache()
@@ -0,0 +1,74 @@
+import numpy as np
+import pandas as pd
+import pytest
+import torch
+import pyro
+from pyro.distributions import Exponential, Normal
+from pyro.infer import Trace_ELBO
+
+from models import RegressionBase
+
+
+class _Linear(RegressionBase):
+    # module level, so that the restart workers can import it
+    def __call__(self):
+        a = pyro.sample("a", Normal(0., 10.))
+        b = pyro.sample("b", Normal(0., 10.))
+        sigma = pyro.sample("sigma", Exponential(1.))
+        with pyro.plate("N", self.x.shape[-1]):
+            return pyro.sample("y", Normal(a + b * self.x, sigma), obs=self.y)
+
+
+class _Square(RegressionBase):
+    # two modes, a = +-2; the prior makes the positive one better
+    def __call__(self):
+        a = pyro.sample("a", Normal(1., 1.))
+        with pyro.plate("N", self.y.shape[-1]):
+            return pyro.sample("y", Normal(a ** 2, 0.5), obs=self.y)
+
+
+def _frame(n, seed=0):
+    rng = np.random.default_rng(seed)
+    x = rng.normal(size=n)
+    return pd.DataFrame({"x": x, "y": 1 + 2 * x + 0.5 * rng.normal(size=n)})
+
+
+def _median(model):
+    return {k: v.item() for k, v in model.guide.median().items()}
+
+
+def test_mini_batch_matches_full_batch():
+    df = _frame(2000)
+    pyro.set_rng_seed(0)
+    model = _Linear(df)
+    model.train(3000, lr=0.02, use_tqdm=False)
+    full = _median(model)
+    pyro.set_rng_seed(0)
+    loss = model.train(20000, lr=0.02, use_tqdm=False, batch_size=100, tol=1e-5)
+    assert len(loss) < 20000
+    # the columns are whole again after the last mini-batch
+    assert model.x.shape == (2000,) and not hasattr(model, "_batch_rows")
+    for k, v in _median(model).items():
+        assert abs(v - full[k]) < 0.05, k
+
+
+def test_replicates_reject_mini_batches():
+    model = _Linear([_frame(50, 0), _frame(50, 1)])
+    with pytest.raises(ValueError, match="replicates"):
+        model.train(10, use_tqdm=False, batch_size=10)
+
+
+@pytest.mark.parametrize("method", ["vectorized", "pool"])
+def test_restarts_keep_the_best(method):
+    y = 4 + 0.5 * torch.randn(100, generator=torch.Generator().manual_seed(0)).numpy()
+    model = _Square(pd.DataFrame({"y": y}))
+    kwargs = {"autoguide": "AutoNormal"} if method == "pool" else {}
+    best, losses = model.train_restarts(6, 1000, method=method, num_workers=2, seed=1, **kwargs)
+    assert len(losses) == 6
+    final = [loss[-100:].mean() for loss in losses]
+    assert best == int(np.argmin(final))
+    assert abs(_median(model)["a"] - 2) < 0.1
+    # the loaded guide is the winning fit
+    pyro.set_rng_seed(0)
+    elbo = Trace_ELBO(num_particles=100).loss(model, model.guide)
+    assert abs(elbo - final[best]) < 1.
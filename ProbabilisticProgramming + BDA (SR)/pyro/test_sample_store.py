@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+import torch
+
+from sample_store import SampleStore
+from utils import precis
+
+
+def _draws():
+    rng = np.random.default_rng(0)
+    return {"a": rng.normal(size=(3, 250)).astype(np.float32), "b": rng.normal(size=(3, 250, 2, 4)),
+            "n": torch.arange(750).reshape(3, 250)}
+
+
+def test_round_trip(tmp_path):
+    draws = _draws()
+    SampleStore(str(tmp_path)).add(draws, group_by_chain=True, chunk_size=100, dims={"b": ["row", "col"]})
+    store = SampleStore(str(tmp_path))
+    assert list(store) == ["a", "b", "n"] and store.num_chains == 3
+    for k, v in draws.items():
+        v = np.asarray(v)
+        assert store[k].dtype == v.dtype and np.array_equal(store[k], v)
+    assert np.array_equal(store["b[1][2]"], draws["b"][:, :, 1, 2])
+    assert store.meta["sites"]["b"]["dims"] == ["chain", "draw", "row", "col"]
+    with pytest.raises(ValueError):
+        store["a"][0, 0] = 1.
+
+
+def test_write_per_chain_and_replace(tmp_path):
+    store = SampleStore(str(tmp_path))
+    store.allocate("x", 2, 10, shape=(3,))
+    for chain in range(2):
+        store.write("x", np.full((10, 3), chain), chain=chain)
+    assert np.array_equal(store["x"][:, :, 0], np.repeat([[0.], [1.]], 10, axis=1))
+    store.add({"x": np.ones(5)})
+    assert store["x"].shape == (1, 5) and len(store) == 1
+
+
+def test_precis_reads_the_store(tmp_path):
+    draws = {k: v for k, v in _draws().items() if k != "n"}
+    store = SampleStore(str(tmp_path)).add(draws, group_by_chain=True)
+    assert np.allclose(precis(store), precis(draws))
+    detailed = precis(store, detailed=True)
+    assert np.allclose(detailed, precis(draws, group_by_chain=True, detailed=True))
+    # the row names of the components are the names the store reads them back by
+    assert list(detailed.index[:3]) == ["a", "b[0][0]", "b[0][1]"] and len(detailed) == 9
+    assert np.isclose(detailed.loc["b[1][2]", "mean"], store["b[1][2]"].mean())
+
+
+def test_inference_data(tmp_path):
+    pytest.importorskip("arviz")
+    store = SampleStore(str(tmp_path)).add(_draws(), group_by_chain=True, dims={"b": ["row", "col"]})
+    posterior = store.to_inference_data().posterior
+    assert posterior["b"].dims == ("chain", "draw", "row", "col")
+    assert np.array_equal(posterior["a"].values, store["a"])
@@ -0,0 +1,55 @@
+import functools
+
+import numpy as np
+import pytest
+import torch
+
+from simulation import RunningMoments, SimulationGrid
+
+
+def _draw(loc, scale=1.0):
+    return torch.normal(float(loc), scale, (2,)).numpy()
+
+
+def _draw_twice(loc, scale=1.0):
+    return 2 * _draw(loc, scale)
+
+
+def test_running_moments_merge():
+    x = np.random.default_rng(0).normal(size=(50, 3))
+    stats = RunningMoments((3,))
+    for row in x[:20]:
+        stats.update(row)
+    stats.update_batch(x[20:])
+    assert np.allclose(stats.mean, x.mean(0)) and np.allclose(stats.var(1), x.var(0, ddof=1))
+
+
+def test_checkpoint_resume_and_fingerprint(tmp_path):
+    path = str(tmp_path / "grid.pkl")
+    grid = [dict(loc=0), dict(loc=3)]
+    runner = SimulationGrid(_draw, grid, 40, chunk_size=10, max_workers=1, checkpoint=path)
+    try:
+        stats = runner.run()
+    finally:
+        runner.close()
+    resumed = SimulationGrid(_draw, grid, 40, chunk_size=10, max_workers=1, checkpoint=path)
+    resumed.close()
+    assert resumed.num_done() == 80
+    assert np.allclose(resumed.stats[(("loc", 3),)].mean, stats[(("loc", 3),)].mean)
+    for fn in (_draw_twice, functools.partial(_draw, scale=2.0)):
+        with pytest.raises(ValueError, match="different simulation"):
+            SimulationGrid(fn, grid, 40, chunk_size=10, max_workers=1, checkpoint=path)
+    with pytest.raises(ValueError, match="different simulation"):
+        SimulationGrid(_draw, grid, 40, chunk_size=10, max_workers=1, checkpoint=path, batched=True)
+
+
+def test_chunking_does_not_change_the_result():
+    grid = [dict(loc=1)]
+    results = []
+    for chunk_size in (7, 40):
+        runner = SimulationGrid(_draw, grid, 40, chunk_size=chunk_size, max_workers=2)
+        try:
+            results.append(runner.run()[(("loc", 1),)])
+        finally:
+            runner.close()
+    assert np.allclose(results[0].mean, results[1].mean) and np.allclose(results[0].m2, results[1].m2)
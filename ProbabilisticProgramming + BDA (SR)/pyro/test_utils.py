@@ -0,0 +1,177 @@
+import importlib.util
+import warnings
+
+import numpy as np
+import pytest
+import torch
+import pyro
+import pyro.distributions as dist
+from pyro.infer import Predictive
+from pyro.infer.autoguide import AutoNormal
+
+from utils import (OrderedCategorical, RunningWAIC, WAIC, log_likelihood, posterior_predictive, precis,
+                   sample_guide, waic_pointwise)
+
+
+def _session_module(filename):
+    # the course scripts are not importable by name (spaces and dashes)
+    spec = importlib.util.spec_from_file_location(filename.replace("-", "_")[:-3], filename)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _event_model(x, y=None):
+    ab = pyro.sample("ab", dist.Normal(0., 1.).expand([2]).to_event(1))
+    sigma = pyro.sample("sigma", dist.Exponential(1.))
+    mu = ab[..., 0] + ab[..., 1] * x
+    with pyro.plate("N", len(x)):
+        return pyro.sample("y", dist.Normal(mu, sigma), obs=y)
+
+
+@pytest.mark.parametrize("S", [50, 30])
+def test_log_likelihood_event_dims(S):
+    # S == N is the case where a misplaced event dim broadcasts silently
+    pyro.set_rng_seed(0)
+    x = torch.randn(50)
+    y = 1 + 2 * x + torch.randn(50)
+    samples = {"ab": torch.randn(S, 2), "sigma": torch.rand(S) + 0.5}
+    serial = log_likelihood(_event_model, samples, {"y": y}, x, parallel=False)
+    with warnings.catch_warnings():
+        # no fallback to the serial loop
+        warnings.simplefilter("error")
+        vectorized = log_likelihood(_event_model, samples, {"y": y}, x)
+    assert vectorized.shape == (S, 50)
+    assert torch.allclose(vectorized, serial)
+
+
+class _Fitted:
+    # the interface of a trained model that WAIC expects: callable, with a guide
+    def __init__(self, x):
+        guide = AutoNormal(_event_model)
+        guide(x)
+        self.guide = lambda: guide(x)
+
+    def __call__(self, *args, **kwargs):
+        return _event_model(*args, **kwargs)
+
+
+def test_running_waic_matches_full_matrix():
+    pyro.set_rng_seed(0)
+    x = torch.randn(50)
+    y = 1 + 2 * x + torch.randn(50)
+    samples = {"ab": torch.randn(200, 2), "sigma": torch.rand(200) + 0.5}
+    log_prob = log_likelihood(_event_model, samples, {"y": y}, x)
+    acc = RunningWAIC()
+    for start in range(0, 200, 50):
+        acc.update(log_prob[start:start + 50])
+    assert torch.allclose(acc.waic(), waic_pointwise(log_prob))
+
+
+def test_waic_matches_full_matrix():
+    # N == chunk_size: every chunk goes through the vectorized log_likelihood at S == N
+    x = torch.randn(50)
+    y = 1 + 2 * x + torch.randn(50)
+    model = _Fitted(x)
+    pyro.set_rng_seed(1)
+    waic, se = WAIC(model, x, y, "y", num_samples=150, chunk_size=50, se=True)
+    pyro.set_rng_seed(1)
+    samples = [sample_guide(model.guide, 50) for _ in range(3)]
+    samples = {k: torch.cat([s[k] for s in samples]) for k in samples[0]}
+    expected = waic_pointwise(log_likelihood(model, samples, {"y": y}, x, parallel=False))
+    assert torch.allclose(waic, expected)
+    assert np.isclose(se, np.sqrt(50 * expected.var().item()))
+    with pytest.raises(ValueError):
+        WAIC(model, x, y, "y", num_samples=1)
+
+
+def _plate_model(data, training=False):
+    a = pyro.sample("a", dist.Normal(0., 1.))
+    b = pyro.sample("b", dist.Normal(0., 1.))
+    with pyro.plate("N", len(data["x"])):
+        return pyro.sample("y", dist.Normal(a + b * data["x"], 0.5))
+
+
+def _check_predictive(model, data, site, posterior, chunk_size):
+    pyro.set_rng_seed(0)
+    summary = posterior_predictive(model, data, [site], posterior, chunk_size=chunk_size)[site]
+    # one-shot reference, one trace per draw
+    y = Predictive(model, posterior, return_sites=[site])(data)[site].reshape(len(next(iter(posterior.values()))), -1)
+    S = y.shape[0]
+    assert summary.shape == (y.shape[1], 6)
+    assert np.allclose(summary["mean"], y.mean(0), atol=5 * y.std(0).max().item() / S**0.5)
+    assert np.allclose(summary["stddev"], y.std(0), rtol=0.1)
+    lower = np.quantile(y.numpy(), 0.055, axis=0)
+    assert np.allclose(summary["5.5%"], lower, atol=0.15 * y.std(0).max().item())
+
+
+def test_posterior_predictive_m9_1():
+    # no plate over the observations in the prediction branch
+    s8 = _session_module("Session-8-MCMC_NUTS_w_num_chains.py")
+    pyro.set_rng_seed(0)
+    S, N = 2000, 45
+    posterior = {"a": 1 + 0.05 * torch.randn(S, 2), "b": 0.1 * torch.randn(S, 2), "sigma": 0.1 + 0.02 * torch.rand(S)}
+    data = {"cid": torch.randint(0, 2, (N,)), "rugged_std": torch.rand(N)}
+    _check_predictive(s8.model_m9_1, data, "log_gdp_std", posterior, chunk_size=20)
+
+
+def test_posterior_predictive_plate():
+    pyro.set_rng_seed(0)
+    S, N = 2000, 45
+    posterior = {"a": torch.randn(S), "b": 1 + 0.1 * torch.randn(S)}
+    _check_predictive(_plate_model, {"x": torch.randn(N)}, "y", posterior, chunk_size=20)
+
+
+def test_precis_layouts():
+    rng = np.random.default_rng(0)
+    samples = {"a": rng.normal(size=400), "b": rng.normal(size=(400, 2)) + [0., 3.]}
+    table = precis(samples)
+    # the original layout: one row per site, components pooled
+    assert list(table.index) == ["a", "b"]
+    assert list(table.columns) == ["mean", "stddev", "5.5%", "94.5%"]
+    for k, v in samples.items():
+        assert np.allclose(table.loc[k], [v.mean(), v.std(), *np.quantile(v, [0.055, 0.945])])
+    detailed = precis(samples, detailed=True)
+    assert list(detailed.index) == ["a", "b[0]", "b[1]"]
+    assert list(detailed.columns[-2:]) == ["n_eff", "r_hat"]
+    assert np.allclose(detailed.loc["b[1]", "mean"], samples["b"][:, 1].mean())
+
+
+def _ordered_categorical_loop(phi, cutpoints):
+    # the original implementation: 1d phi and cutpoints, probabilities filled in column by column
+    N, K = phi.shape[0], cutpoints.shape[0] + 1
+    cutpoints = cutpoints.exp().cumsum(dim=-1).log().reshape(1, -1)
+    q = torch.sigmoid(cutpoints - phi.reshape(-1, 1))
+    p = torch.zeros((N, K), dtype=q.dtype)
+    p[:,0] = q[:,0]
+    p[:,1:-1] = (q - torch.roll(q, 1, dims=1))[:,1:]
+    p[:,-1] = 1 - q[:,-1]
+    return q, dist.Categorical(p)
+
+
+def test_ordered_categorical_matches_original():
+    torch.manual_seed(0)
+    S, N, K = 4, 30, 6
+    phi = torch.randn(S, N, dtype=torch.float64)
+    cutpoints = torch.randn(S, 1, K - 1, dtype=torch.float64)
+    d = OrderedCategorical(phi, cutpoints)
+    assert d.batch_shape == (S, N) and d.probs.dtype == torch.float64
+    values = torch.arange(K).reshape(K, 1, 1).expand(K, S, N)
+    log_prob = d.log_prob(values)
+    for s in range(S):
+        q, reference = _ordered_categorical_loop(phi[s], cutpoints[s, 0])
+        assert torch.allclose(d.cum_prob[s], q)
+        assert torch.allclose(d.probs[s], reference.probs)
+        assert torch.allclose(log_prob[:, s], reference.log_prob(values[:, s]))
+
+
+def test_ordered_categorical_tails():
+    # cumulative probabilities that round to 1 still give finite log-probabilities
+    d = OrderedCategorical(torch.tensor([-40., 0., 40.]), torch.tensor([0., 0.5, 0.5]))
+    log_prob = d.log_prob(torch.arange(4).reshape(4, 1))
+    assert torch.isfinite(log_prob).all()
+    assert torch.allclose(log_prob.exp().sum(0), torch.ones(3))
+    torch.manual_seed(0)
+    counts = torch.bincount(OrderedCategorical(torch.zeros(()), torch.zeros(3)).sample((20000,)), minlength=4)
+    expected = OrderedCategorical(torch.zeros(()), torch.zeros(3)).probs
+    assert torch.allclose(counts / 20000., expected, atol=0.015)
@@ -0,0 +1,16 @@
+import pickle
+
+import torch
+
+from workers import Tensor, pack, unpack
+
+
+def test_pack_round_trip():
+    obj = {"x": torch.arange(6.).reshape(2, 3), "rows": [torch.ones(2, dtype=torch.long), 3], "name": "y",
+           "pair": (torch.zeros(1), None)}
+    packed = pack(obj)
+    assert isinstance(packed["x"], Tensor) and isinstance(packed["pair"], tuple)
+    out = unpack(pickle.loads(pickle.dumps(packed)))
+    assert out["name"] == "y" and out["rows"][1] == 3 and out["pair"][1] is None
+    for a, b in [(obj["x"], out["x"]), (obj["rows"][0], out["rows"][0]), (obj["pair"][0], out["pair"][0])]:
+        assert torch.equal(a, b) and a.dtype == b.dtype
@@ -19,6 +19,7 @@ from pyro.infer.mcmc import NUTS, MCMC
 from pyro.contrib.autoguide import AutoLaplaceApproximation
 from pyro.infer import TracePosterior, TracePredictive, Trace_ELBO, Predictive
 from pyro import poutine
+from pyro.poutine.util import site_is_subsample
 import pyro.ops.stats as stats
 from pyro.ops.welford import WelfordCovariance
 
@@ -29,60 +30,154 @@ from torch.distributions import constraints
 from pyro.distributions import TorchDistribution, Categorical
 from pyro.distributions.transforms import Transform
 from torch.distributions.utils import lazy_property
+
+from causal import DSeparation, independence_table, minimal_adjustment_sets
+from mcmc import run_chains, run_checkpointed
+from sample_store import SampleStore
+from diagnostics import traceplot, trankplot
+from frames import frame_tensors
+
 ### Sample summarization and interval calculation
 
-def HPDI(samples, prob):
+def _hpdi_sorted(s, prob):
+    """Lower/upper HPDI bounds of samples already sorted along axis 0 (array or tensor)"""
+    N = s.shape[0]
+    W = int(round(N*prob))
+    # widths of all windows at once; argmin takes the first of equally narrow windows
+    i = (s[W:] - s[:N-W]).argmin(0)[None]
+    if isinstance(s, torch.Tensor):
+        return s.gather(0, i)[0], s.gather(0, i + W)[0]
+    return np.take_along_axis(s, i, 0)[0], np.take_along_axis(s, i + W, 0)[0]
+
+
+def HPDI(samples, prob, axis=0):
     """Calculates the Highest Posterior Density Interval (HPDI)
     
-    Sorts all the samples, then with a fixed width window (in index space), 
-    iterates through them all and caclulates the interval width, taking the 
-    maximimum as it moves along. Probably only useful/correct for continuous 
-    distributions or discrete distributions with a notion of ordering and a large 
-    number of possible values.
+    Sorts the samples along ``axis``, then takes the differences between samples a
+    fixed width window (in index space) apart and picks the narrowest window, all in
+    vectorized form. Every other axis is treated as an independent batch of samples,
+    so the intervals of all vector components (or chains) come out of one call.
+    Probably only useful/correct for continuous distributions or discrete distributions
+    with a notion of ordering and a large number of possible values.
     Arguments:
-        samples (np.array): array of samples from a 1-dim posterior distribution
+        samples (np.array or torch.Tensor): samples from the posterior distribution
         prob (float): the probability mass of the desired interval
+        axis (int): the sample axis
     Returns:
-        Tuple[float, float]: the lower/upper bounds of the interval
+        Tuple[float, float] for 1-dim samples, otherwise Tuple[array, array] of
+        lower/upper bounds with the sample axis removed
     """
-    samples = sorted(samples)
-    N = len(samples)
-    W = int(round(N*prob))
-    min_interval = float('inf')
-    bounds = [0, W]
-    for i in range(N-W):
-        interval = samples[i+W] - samples[i]
-        if interval < min_interval:
-            min_interval = interval
-            bounds = [i, i+W]
-    return samples[bounds[0]], samples[bounds[1]]
+    if isinstance(samples, torch.Tensor):
+        s = torch.sort(samples, dim=axis).values.movedim(axis, 0)
+    else:
+        s = np.moveaxis(np.sort(np.asarray(samples), axis=axis), axis, 0)
+    lower, upper = _hpdi_sorted(s, prob)
+    if s.ndim == 1:
+        return lower.item(), upper.item()
+    return lower, upper
+
+
+def HPDI_sites(samples: dict, prob, group_by_chain=False):
+    """Calculates the HPDI of every site (and every vector component) in one pass
+    
+    All sites are flattened to (draws, components) and stacked into one matrix, which
+    is sorted and scanned once by ``HPDI``.
+    Arguments:
+        samples (Dict[str, np.array]): dictionary of samples with shape
+            [[chains,] draws [,idx1, idx2, ...]]
+        prob (float): the probability mass of the desired interval
+        group_by_chain (bool): whether the leading axis indexes chains, in which
+            case the intervals are computed per chain
+    Returns:
+        Dict[str, Tuple[array, array]]: lower/upper bounds per site, of shape
+        [[chains,] idx1, idx2, ...]
+    """
+    samples = {k: np.asarray(v) for k, v in samples.items()}
+    axis = 1 if group_by_chain else 0
+    lead = list(samples.values())[0].shape[:axis+1]
+    flat = np.concatenate([v.reshape(*lead, -1) for v in samples.values()], axis=-1)
+    lower, upper = HPDI(flat, prob, axis=axis)
+    out, start = dict(), 0
+    for k, v in samples.items():
+        size = int(np.prod(v.shape[axis+1:]))
+        shape = v.shape[:axis] + v.shape[axis+1:]
+        out[k] = (lower[..., start:start+size].reshape(shape), upper[..., start:start+size].reshape(shape))
+        start += size
+    return out
 
 
-def precis(samples: dict, prob=0.89):
+def stack_sites(samples: dict, group_by_chain=False):
+    """Stacks all sample sites into a single (chains, draws, components) matrix
+    
+    Multivariate sites are flattened into one column per component, named the
+    same way ``unnest_samples`` names them (e.g. ``b[0]``, ``b[1][2]``), without
+    building an intermediate dictionary.
+    Arguments:
+        samples (Dict[str, np.array]): dictionary of samples with shape
+            [[chains,] draws [,idx1, idx2, ...]]
+        group_by_chain (bool): whether the leading axis indexes chains
+    Returns:
+        Tuple[List[str], np.array]: column names and the float64 sample matrix
+    """
+    names, columns = [], []
+    for k, v in samples.items():
+        v = np.asarray(v, dtype=np.float64)
+        if not group_by_chain:
+            v = v[None]
+        event_shape = v.shape[2:]
+        columns.append(v.reshape(*v.shape[:2], -1))
+        if event_shape:
+            names.extend(k + "".join(f"[{i}]" for i in idx) for idx in np.ndindex(*event_shape))
+        else:
+            names.append(k)
+    return names, np.concatenate(columns, axis=-1)
+
+
+def precis(samples: dict, prob=0.89, group_by_chain=False, detailed=False):
     """Computes some summary statistics of the given samples.
     
+    By default there is one row per site (pooling the components of a
+    multivariate site) with the mean, standard deviation and quantiles.
+    ``detailed=True`` stacks all sites into one matrix, so every statistic is a
+    single vectorized pass over all sites and components: multivariate sites get
+    one row per component (``b[0]``, ``b[1]``, ...), the columns add the HPDI,
+    n_eff and r_hat, and all sites must be numeric with the same number of draws.
     Arguments:
         samples (Dict[str, np.array]): dictionary of samples, where the key
             is the name of the sample site, and the value is the collection
             of sample values
         prob (float): the probability mass of the symmetric credible interval
+            and of the HPDI
+        group_by_chain (bool): whether the leading axis of every site indexes
+            chains (as in ``mcmc.get_samples(group_by_chain=True)``)
+        detailed (bool): one row per component, with the HPDI, n_eff and r_hat
     Returns:
-        pd.DataFrame: summary dataframe
+        pd.DataFrame: summary dataframe with mean, standard deviation and quantiles
+        (and with ``detailed=True`` the HPDI, effective sample size and split R-hat)
     """
     p1, p2 = (1-prob)/2, 1-(1-prob)/2
-    cols = ["mean","stddev",f"{100*p1:.1f}%",f"{100*p2:.1f}%"]
-    df = pd.DataFrame(columns=cols, index=samples.keys())
+    if isinstance(samples, SampleStore):
+        # one site in memory at a time
+        return pd.concat([precis({k: samples[k]}, prob, group_by_chain=True, detailed=detailed) for k in samples])
     if isinstance(samples, pd.DataFrame):
-        samples = {k: np.array(samples[k]) for k in samples.columns}
+        samples = {k: samples[k].to_numpy() for k in samples.columns}
     elif not isinstance(samples, dict):
         raise TypeError("<samples> must be either dict or DataFrame")
-    for k, v in samples.items():
-        df.loc[k,"mean"] = v.mean()
-        df.loc[k,"stddev"] = v.std()
-        q1, q2 = np.quantile(v, [p1, p2])
-        df.loc[k,f"{100*p1:.1f}%"] = q1
-        df.loc[k,f"{100*p2:.1f}%"] = q2
-    return df
+    if not detailed:
+        cols = ["mean","stddev",f"{100*p1:.1f}%",f"{100*p2:.1f}%"]
+        rows = {k: [np.mean(v), np.std(v), *np.quantile(v, [p1, p2])]
+                for k, v in ((k, np.asarray(v)) for k, v in samples.items())}
+        return pd.DataFrame.from_dict(rows, orient="index", columns=cols)
+    names, x = stack_sites(samples, group_by_chain)
+    flat = x.reshape(-1, x.shape[-1])
+    q = np.quantile(flat, [p1, p2], axis=0)
+    lower, upper = HPDI(flat, prob)
+    x = torch.from_numpy(x)
+    n_eff = stats.effective_sample_size(x, chain_dim=0, sample_dim=1).numpy()
+    r_hat = stats.split_gelman_rubin(x, chain_dim=0, sample_dim=1).numpy()
+    cols = ["mean","stddev",f"{100*p1:.1f}%",f"{100*p2:.1f}%",f"|{prob}",f"{prob}|","n_eff","r_hat"]
+    values = np.column_stack([flat.mean(0), flat.std(0), q[0], q[1], lower, upper, n_eff, r_hat])
+    return pd.DataFrame(values, index=names, columns=cols)
 
 ### Causal inference tools
 
@@ -99,6 +194,8 @@ def independent(G, n1, n2, n3=None):
         n3 = set(n3)
     # Construct the ancestral graph of n1, n2, and n3
     a = ancestors(G, n1) | ancestors(G, n2) | {n1, n2} | n3
+    for n in n3:
+        a |= ancestors(G, n)
     G = G.subgraph(a)
     # Moralize the graph
     M = moral_graph(G)
@@ -107,117 +204,173 @@ def independent(G, n1, n2, n3=None):
     # Check that path exists between n1 and n2
     return not has_path(M, n1, n2)
 
-def conditional_independencies(G):
+def conditional_independencies(G, num_workers=None):
     """Finds all conditional independencies in the DAG G
     
     Only works when conditioning on a single node at a time
     """
-    tuples = []
-    for i1, n1 in enumerate(G.nodes):
-        for i2, n2 in enumerate(G.nodes):
-            if i1 >= i2:
-                continue
-            for n3 in G.nodes:
-                try:
-                    if independent(G, n1, n2, n3):
-                        tuples.append((n1, n2, n3))
-                except:
-                    pass
-    return tuples
+    df = independence_table(G, conditioning_sets=[(n,) for n in G.nodes], num_workers=num_workers)
+    return [(x, y, z[0]) for x, y, z in zip(df["x"], df["y"], df["given"])]
 
 def conditional_independencies_v2(G):
     """Finds all conditional independencies in the DAG G
     Works when conditioning on multiple nodes at a time
     """
-    d = collections.defaultdict(list)
-    conditional_independence = collections.defaultdict(list)
-    for edge in itertools.combinations(sorted(G.nodes), 2):
-        remaining = sorted(set(G.nodes) - set(edge))
-        for size in range(len(remaining) + 1):
-            for subset in itertools.combinations(remaining, size):
-                if any(cond.issubset(set(subset)) for cond in conditional_independence[edge]):
-                    continue
-                if nx.d_separated(G, {edge[0]}, {edge[1]}, set(subset)):
-                    conditional_independence[edge].append(set(subset))
-                    #print(f"{edge[0]} _||_ {edge[1]}" + (f" | {' '.join(subset)}" if subset else ""))
-    return collections.defaultdict(list, {k:v for k,v in conditional_independence.items() if len(v)>0})
-
-def find_adjustment_sets(G):
+    return DSeparation(G).conditional_independencies()
+
+def find_adjustment_sets(G, treatment="W", outcome="D"):
     """
-    Returns the all adjustment set in a DAG
+    Returns the all minimal adjustment sets for the effect of treatment on outcome in a DAG
     """
-    backdoor_paths = [path for path in nx.all_simple_paths(G.to_undirected(), "W", "D")
-                  if G.has_edge(path[1], "W")]
-    remaining = sorted(set(G.nodes) - {"W", "D"} - set(nx.descendants(G, "W")))
-    adjustment_sets = []
-    for size in range(len(remaining) + 1):
-        for subset in itertools.combinations(remaining, size):
-            subset = set(subset)
-            if any(s.issubset(subset) for s in adjustment_sets):
-                continue
-            need_adjust = True
-            for path in backdoor_paths:
-                d_separated = False
-                for x, z, y in zip(path[:-2], path[1:-1], path[2:]):
-                    if G.has_edge(x, z) and G.has_edge(y, z):
-                        if set(nx.descendants(G, z)) & subset:
-                            continue
-                        d_separated = z not in subset
-                    else:
-                        d_separated = z in subset
-                    if d_separated:
-                        break
-                if not d_separated:
-                    need_adjust = False
-                    break
-            if need_adjust:
-                adjustment_sets.append(subset)
-                #print(subset)
-    return adjustment_sets
-
-def marginal_independencies(G):
+    return minimal_adjustment_sets(G, treatment, outcome)
+
+def marginal_independencies(G, num_workers=None):
     """Finds all marginal independencies in the DAG G
     """
-    tuples = []
-    for i1, n1 in enumerate(G.nodes):
-        for i2, n2 in enumerate(G.nodes):
-            if i1 >= i2:
-                continue
-            try:
-                if independent(G, n1, n2, {}):
-                    tuples.append((n1, n2, {}))
-            except:
-                pass
-    return tuples
-
-def sample_posterior(model, num_samples, sites=None, data=None):
-    p = Predictive(
-        model,
-        guide=model.guide,
-        num_samples=num_samples,
-        return_sites=sites,
+    df = independence_table(G, num_workers=num_workers)
+    return [(x, y, {}) for x, y in zip(df["x"], df["y"])]
+
+def sample_posterior(model, num_samples, sites=None, data=None, store=None, chunk_size=1000):
+    """Draws from the guide of a trained model (and the sites that depend on it)
+
+    With ``store`` (a ``SampleStore`` or a directory) the draws are made and written
+    ``chunk_size`` at a time and the store is returned instead of a dictionary.
+    """
+    args = () if data is None else (data,)
+    if store is None:
+        p = Predictive(model, guide=model.guide, num_samples=num_samples, return_sites=sites)(*args)
+        return {k: v.detach().numpy() for k, v in p.items()}
+    return _sample_to_store(
+        lambda n: Predictive(model, guide=model.guide, num_samples=n, return_sites=sites)(*args),
+        num_samples, store, chunk_size,
     )
-    if data is None:
-        p = p()
-    else:
-        p = p(data)
-    return {k: v.detach().numpy() for k, v in p.items()}
-
-def sample_prior(model, num_samples, sites=None):
-    return {
-        k: v.detach().numpy()
-        for k, v in Predictive(
-            model,
-            {},
-            return_sites=sites,
-            num_samples=num_samples
-        )().items()
+
+def sample_prior(model, num_samples, sites=None, store=None, chunk_size=1000):
+    if store is None:
+        return {
+            k: v.detach().numpy()
+            for k, v in Predictive(
+                model,
+                {},
+                return_sites=sites,
+                num_samples=num_samples
+            )().items()
+        }
+    return _sample_to_store(
+        lambda n: Predictive(model, {}, return_sites=sites, num_samples=n)(),
+        num_samples, store, chunk_size,
+    )
+
+def _sample_to_store(draw, num_samples, store, chunk_size):
+    # draw(n) returns n draws of every site; they go to the store as a single chain
+    if not isinstance(store, SampleStore):
+        store = SampleStore(store)
+    for start in range(0, num_samples, chunk_size):
+        chunk = draw(min(chunk_size, num_samples - start))
+        for k, v in chunk.items():
+            v = v.detach().numpy()
+            if start == 0:
+                store.allocate(k, 1, num_samples, v.shape[1:], v.dtype)
+            store.write(k, v, start, chain=0)
+    return store
+
+def _rows(data, start, stop, num_rows):
+    # the observations start:stop of every tensor that has one entry per observation
+    return {k: v[start:stop] if v.dim() and v.shape[0] == num_rows else v for k, v in data.items()}
+
+def _predict(model, draws, sites, args, kwargs):
+    """(draws, observations) simulations of ``sites``, all draws in one vectorized trace
+
+    Draws are laid out as in ``log_likelihood``. A model whose sites have no plate over
+    the observations (e.g. ``mu`` broadcast over the data, as in the prediction branch
+    of most course models) runs inside one at dim -1, so the draws plate sits to its left.
+    """
+    S = next(iter(draws.values())).shape[0]
+    one_draw = {k: v[0] for k, v in draws.items()}
+    with poutine.block():
+        tr = poutine.trace(poutine.condition(model, data=one_draw)).get_trace(*args, **kwargs)
+    if not all(any(f.vectorized and f.dim == -1 for f in tr.nodes[k]["cond_indep_stack"]) for k in sites):
+        num_obs = tr.nodes[sites[0]]["value"].shape[-1]
+        unplated = model
+        def model(*args, **kwargs):
+            with pyro.plate("_obs", num_obs, dim=-1):
+                return unplated(*args, **kwargs)
+    rank, event_dims, obs_shape = _vectorize_rank(model, draws, sites, args, kwargs)
+    draws = {
+        k: v.reshape((S,) + (1,) * (rank - (v.dim() - 1 - event_dims[k])) + v.shape[1:])
+        for k, v in draws.items() if k in event_dims and k not in sites
     }
+    def vectorized(*args, **kwargs):
+        with pyro.plate("_draws", S, dim=-rank-1):
+            return model(*args, **kwargs)
+    tr = poutine.trace(poutine.condition(vectorized, data=draws)).get_trace(*args, **kwargs)
+    out = dict()
+    for k in sites:
+        value = tr.nodes[k]["value"]
+        if value.shape != (S,) + (1,) * (rank - len(obs_shape)) + obs_shape:
+            raise ValueError(f"site {k} has shape {tuple(value.shape)} with {S} draws; "
+                             "the model does not vectorize over draws")
+        out[k] = value.reshape(S, -1)
+    return out
+
+def posterior_predictive(model, data, sites, posterior_samples=None, guide=None, num_samples=1000,
+                         prob=0.89, chunk_size=10000, categoricals=None, **kwargs):
+    """Summaries of the posterior predictive distribution of every observation
+
+    The posterior draws are fixed once (``posterior_samples``, e.g. ``mcmc.get_samples()``,
+    or ``num_samples`` draws of ``guide``) and the observations are processed
+    ``chunk_size`` rows at a time: for each chunk all draws are simulated at once with a
+    vectorized trace (laid out as in ``log_likelihood``) and reduced to the mean, standard deviation,
+    quantiles and HPDI of each observation before the next chunk. Memory therefore
+    holds draws x chunk_size predictions rather than draws x observations, and the
+    summaries are exact since every observation sees all of its draws together. The
+    latent sites must be global (not one per observation), so that they do not depend
+    on the chunking. Sites without a plate over the observations are predicted inside
+    one (see ``_predict``).
+    Arguments:
+        model (callable): model called as ``model(data, **kwargs)``
+        data (dict or pd.DataFrame): observations; a DataFrame goes through ``format_data``
+        sites (List[str]): observed sites to predict, one scalar per observation
+        posterior_samples (Dict[str, Tensor]): draws of the latent sites
+        guide (callable): fitted guide to draw the latent sites from instead
+        num_samples (int): number of guide draws
+        prob (float): probability mass of the quantile interval and of the HPDI
+        chunk_size (int): observations per chunk
+        categoricals (List[str]): categorical columns of a DataFrame
+    Returns:
+        Dict[str, pd.DataFrame]: per site, one row per observation with the same
+        columns as ``precis(..., detailed=True)`` (without n_eff and r_hat)
+    """
+    if isinstance(data, pd.DataFrame):
+        data = format_data(data, categoricals)
+    num_rows = max(v.shape[0] for v in data.values() if v.dim())
+    if posterior_samples is None:
+        posterior_samples = sample_guide(guide, num_samples, _rows(data, 0, chunk_size, num_rows), **kwargs)
+    p1, p2 = (1-prob)/2, 1-(1-prob)/2
+    cols = ["mean","stddev",f"{100*p1:.1f}%",f"{100*p2:.1f}%",f"|{prob}",f"{prob}|"]
+    out = {k: np.empty((num_rows, len(cols))) for k in sites}
+    posterior_samples = {k: torch.as_tensor(v) for k, v in posterior_samples.items()}
+    with torch.no_grad():
+        for start in range(0, num_rows, chunk_size):
+            stop = min(start + chunk_size, num_rows)
+            pred = _predict(model, posterior_samples, sites, (_rows(data, start, stop, num_rows),), kwargs)
+            for k in sites:
+                # (observations, draws), sorted once for the quantiles and the HPDI
+                y = np.sort(pred[k].double().numpy().T, axis=1)
+                lower, upper = _hpdi_sorted(y.T, prob)
+                # linearly interpolated quantiles, as np.quantile
+                pos = np.array([p1, p2]) * (y.shape[1] - 1)
+                lo = np.floor(pos).astype(np.int64)
+                hi = np.minimum(lo + 1, y.shape[1] - 1)
+                q = y[:, lo] * (1 - (pos - lo)) + y[:, hi] * (pos - lo)
+                out[k][start:stop] = np.column_stack([y.mean(1), y.std(1), q, lower, upper])
+    return {k: pd.DataFrame(v, columns=cols) for k, v in out.items()}
 
 def plot_intervals(samples, p, vline=0):
+    hpdis = HPDI_sites(samples, p)
     for i, (k, s) in enumerate(samples.items()):
         mean = s.mean()
-        hpdi = HPDI(s, p)
+        hpdi = hpdis[k]
         plt.scatter([mean], [i], facecolor="none", edgecolor="black")
         plt.plot(hpdi, [i, i], color="C0")
         plt.axhline(i, color="grey", alpha=0.5, linestyle="--")
@@ -226,70 +379,384 @@ def plot_intervals(samples, p, vline=0):
     #plt.show()
     
     
-def WAIC(model, x, y, out_var_nm, num_samples=100):
-    p = torch.zeros((num_samples, len(y)))
-    # Get log probability samples
-    for i in range(num_samples):
-        tr = poutine.trace(poutine.condition(model, data=model.guide())).get_trace(x)
-        dist = tr.nodes[out_var_nm]["fn"]
-        p[i] = dist.log_prob(y).detach()
-    pmax = p.max(axis=0).values
-    lppd = pmax + (p - pmax).exp().mean(axis=0).log() # numerically stable version
-    penalty = p.var(axis=0)
-    return -2*(lppd - penalty)
-
-
-def format_data(df, categoricals=None):
-    data = dict()
-    if categoricals is None:
-        categoricals = []
-    for col in set(df.columns) - set(categoricals):
-        data[col] = torch.tensor(df[col].values).double()
-    for col in categoricals:
-        data[col] = torch.tensor(df[col].values).long()
-    return data
-
-
-def train_nuts(model, data, num_warmup, num_samples, num_chains=1, **kwargs):
+### Pointwise log-likelihood and information criteria
+
+def _vectorize_rank(model, samples, obs_names, args, kwargs):
+    """Number of batch dims a single draw of the model uses (i.e. where the draws plate
+    must go), the event rank of every site and the shape of the pointwise log-likelihood"""
+    one_draw = {k: v[0] for k, v in samples.items()}
+    with poutine.block():
+        tr = poutine.trace(poutine.condition(model, data=one_draw)).get_trace(*args, **kwargs)
+    rank = 0
+    event_dims = dict()
+    for site in tr.nodes.values():
+        if site["type"] != "sample" or site_is_subsample(site):
+            continue
+        event_dims[site["name"]] = site["fn"].event_dim
+        # conditioned values may broadcast beyond the batch shape of their distribution
+        rank = max(rank, len(site["fn"].batch_shape), site["value"].dim() - site["fn"].event_dim)
+        rank = max([rank] + [-f.dim for f in site["cond_indep_stack"] if f.vectorized])
+    obs_shape = sum(tr.nodes[nm]["fn"].log_prob(tr.nodes[nm]["value"]) for nm in obs_names).shape
+    return rank, event_dims, obs_shape
+
+
+def log_likelihood(model, samples, obs, *args, parallel=True, **kwargs):
+    """Computes the pointwise log-likelihood of the observed sites for every posterior draw
+    
+    With ``parallel=True`` all S draws are evaluated in a single trace: the model runs
+    inside an outermost ``pyro.plate`` over the draws (the same vectorization as
+    ``Predictive(parallel=True)``), so each sample site sees a leading draw dimension:
+    a draw is padded to the left of its batch dims (not its event dims) up to the
+    batch rank of the model. Draws may carry batch dims the model's distribution does
+    not (e.g. the replicates of ``RegressionBase``).
+    Models that cannot be vectorized this way (e.g. indexing parameters with ``a[idx]``
+    instead of ``a[..., idx]``) fall back to one trace per draw.
+    Arguments:
+        model (callable): the model
+        samples (Dict[str, Tensor]): posterior draws of the latent sites, with a leading
+            draw dimension
+        obs (Dict[str, Tensor]): observed values of the sites to evaluate
+        *args, **kwargs: inputs of the model
+        parallel (bool): whether to vectorize over draws
+    Returns:
+        Tensor: log-likelihood (summed over the ``obs`` sites) of shape (num draws, *pointwise
+        shape), e.g. (S, N), or (S, K, N) for K replicates
+    """
+    samples = {k: torch.as_tensor(v) for k, v in samples.items()}
+    obs = {k: torch.as_tensor(v) for k, v in obs.items()}
+    S = next(iter(samples.values())).shape[0]
+    model = poutine.condition(model, data=obs)
+    if parallel:
+        try:
+            rank, event_dims, obs_shape = _vectorize_rank(model, samples, list(obs), args, kwargs)
+            draws = {
+                k: v.reshape((S,) + (1,) * (rank - (v.dim() - 1 - event_dims[k])) + v.shape[1:])
+                for k, v in samples.items() if k in event_dims
+            }
+            def vectorized(*args, **kwargs):
+                with pyro.plate("_draws", S, dim=-rank-1):
+                    return model(*args, **kwargs)
+            tr = poutine.trace(poutine.condition(vectorized, data=draws)).get_trace(*args, **kwargs)
+            log_prob = sum(tr.nodes[nm]["fn"].log_prob(tr.nodes[nm]["value"]) for nm in obs)
+            if log_prob.shape == (S,) + (1,) * (rank - len(obs_shape)) + obs_shape:
+                return log_prob.reshape((S,) + obs_shape).detach()
+            warnings.warn(f"vectorized log-likelihood has shape {tuple(log_prob.shape)}; "
+                          "falling back to one trace per draw")
+        except (RuntimeError, ValueError, IndexError) as e:
+            warnings.warn(f"vectorized log-likelihood failed ({e}); falling back to one trace per draw")
+    log_prob = []
+    for i in range(S):
+        tr = poutine.trace(poutine.condition(model, data={k: v[i] for k, v in samples.items()})).get_trace(*args, **kwargs)
+        log_prob.append(sum(tr.nodes[nm]["fn"].log_prob(tr.nodes[nm]["value"]) for nm in obs).detach())
+    return torch.stack(log_prob)
+
+
+def sample_guide(guide, num_samples, *args, parallel=True, **kwargs):
+    """Draws the latent sites from a (fitted) guide, vectorized over draws when possible
+    
+    Returns:
+        Dict[str, Tensor]: draws of every latent site, with a leading draw dimension
+    """
+    if parallel:
+        draws = Predictive(guide, num_samples=num_samples, parallel=True)(*args, **kwargs)
+        return {k: v.detach() for k, v in draws.items() if not k.startswith("_")}
+    draws = [guide(*args, **kwargs) for _ in range(num_samples)]
+    return {k: torch.stack([d[k] for d in draws]).detach() for k in draws[0]}
+
+
+def lppd_pointwise(log_prob):
+    """Log pointwise predictive density of every observation from a (draws, N) log-likelihood"""
+    return torch.logsumexp(log_prob, dim=0) - np.log(log_prob.shape[0])
+
+
+def waic_pointwise(log_prob):
+    """Pointwise WAIC (on the deviance scale) from a (draws, N) log-likelihood"""
+    return -2*(lppd_pointwise(log_prob) - log_prob.var(dim=0))
+
+
+def _gpdfit(x):
+    """Fits a generalized Pareto distribution to every column of the sorted exceedances x
+    
+    Zhang & Stephens (2009) estimator with the weakly informative prior on k used by
+    PSIS (Vehtari et al. 2017), vectorized over columns.
+    Arguments:
+        x (np.array): exceedances of shape (tail length, columns), sorted along axis 0
+    Returns:
+        Tuple[np.array, np.array]: shape k and scale sigma per column
+    """
+    n = x.shape[0]
+    m = 30 + int(n**0.5)
+    b = 1 - np.sqrt(m / (np.arange(1, m + 1) - 0.5))[:, None]
+    b = b / (3 * x[int(n/4 + 0.5) - 1]) + 1 / x[-1]                       # (m, columns)
+    k = np.log1p(-b[:, None, :] * x[None]).mean(axis=1)                     # (m, columns)
+    len_scale = n * (np.log(-b / k) - k - 1)
+    w = 1 / np.exp(len_scale[None, :, :] - len_scale[:, None, :]).sum(axis=1)
+    w = np.where(w >= 10 * np.finfo(float).eps, w, 0)
+    w /= w.sum(axis=0)
+    b_post = (b * w).sum(axis=0)
+    k_post = np.log1p(-b_post * x).mean(axis=0)
+    sigma = -k_post / b_post
+    k_post = (n * k_post + 10 * 0.5) / (n + 10)
+    return k_post, sigma
+
+
+def psis(log_ratios):
+    """Pareto smoothed importance sampling, vectorized over columns
+    
+    The largest M = ceil(min(S/5, 3*sqrt(S))) log ratios of each column are replaced
+    by the expected order statistics of a generalized Pareto fit to the tail, then
+    truncated at the largest raw ratio and normalized.
+    Arguments:
+        log_ratios (np.array): log importance ratios of shape (draws, columns)
+    Returns:
+        Tuple[np.array, np.array]: normalized log weights (same shape) and the Pareto
+        shape diagnostic k of every column
+    """
+    lw = np.array(log_ratios, dtype=np.float64)
+    S = lw.shape[0]
+    lw -= lw.max(axis=0)
+    M = int(np.ceil(min(0.2 * S, 3 * np.sqrt(S))))
+    order = np.argsort(lw, axis=0)
+    lw_sorted = np.take_along_axis(lw, order, axis=0)
+    cutoff = np.maximum(lw_sorted[-M-1], np.log(np.finfo(float).tiny))
+    k = np.full(lw.shape[1], np.inf)
+    if M > 4:
+        tail = np.exp(lw_sorted[-M:]) - np.exp(cutoff)
+        k, sigma = _gpdfit(tail)
+        ok = np.isfinite(k) & (sigma > 0)
+        p = (np.arange(0.5, M) / M)[:, None]
+        kk = np.where(np.abs(k) < np.finfo(float).eps, 1.0, k)
+        smoothed = np.where(np.abs(k) < np.finfo(float).eps, -np.log1p(-p), np.expm1(-kk * np.log1p(-p)) / kk) * sigma
+        smoothed = np.minimum(np.log(smoothed + np.exp(cutoff)), 0)
+        lw_sorted[-M:] = np.where(ok, smoothed, lw_sorted[-M:])
+        np.put_along_axis(lw, order, lw_sorted, axis=0)
+    lw -= np.logaddexp.reduce(lw, axis=0)
+    return lw, k
+
+
+def loo_pointwise(log_prob):
+    """Pointwise PSIS-LOO (on the deviance scale) and Pareto k from a (draws, N) log-likelihood"""
+    log_prob = np.asarray(log_prob, dtype=np.float64)
+    lw, k = psis(-log_prob)
+    elpd = np.logaddexp.reduce(lw + log_prob, axis=0)
+    return -2*elpd, k
+
+
+def pointwise_ic(log_prob, chunk_size=500):
+    """Pointwise lppd, WAIC penalty, PSIS-LOO and Pareto k, computed chunk by chunk
+    
+    Only ``chunk_size`` columns (observations) of the log-likelihood matrix are in
+    memory at a time, so ``log_prob`` can be a memory-mapped array larger than RAM,
+    e.g. one written with ``np.lib.format.open_memmap`` and passed by file name.
+    Arguments:
+        log_prob (np.array, Tensor or str): (draws, N) log-likelihood, or the path of
+            a .npy file holding it (opened with ``mmap_mode="r"``)
+        chunk_size (int): number of observations processed at once
+    Returns:
+        Dict[str, np.array]: "lppd", "p_waic", "waic", "loo" and "k", each of shape (N,);
+        waic and loo are on the deviance scale
+    """
+    if isinstance(log_prob, str):
+        log_prob = np.load(log_prob, mmap_mode="r")
+    elif isinstance(log_prob, torch.Tensor):
+        log_prob = log_prob.detach().numpy()
+    S, N = log_prob.shape
+    out = {k: np.empty(N) for k in ("lppd", "p_waic", "loo", "k")}
+    for j in range(0, N, chunk_size):
+        lp = np.asarray(log_prob[:, j:j+chunk_size], dtype=np.float64)
+        out["lppd"][j:j+chunk_size] = np.logaddexp.reduce(lp, axis=0) - np.log(S)
+        out["p_waic"][j:j+chunk_size] = lp.var(axis=0, ddof=1)
+        out["loo"][j:j+chunk_size], out["k"][j:j+chunk_size] = loo_pointwise(lp)
+    out["waic"] = -2*(out["lppd"] - out["p_waic"])
+    return out
+
+
+def pareto_k_table(k):
+    """Counts of the Pareto k diagnostic in the usual reliability bins"""
+    bins = [-np.inf, 0.5, 0.7, 1, np.inf]
+    labels = ["(-Inf, 0.5] good", "(0.5, 0.7] ok", "(0.7, 1] bad", "(1, Inf) very bad"]
+    counts = pd.cut(pd.Series(k), bins, labels=labels).value_counts(sort=False)
+    return pd.DataFrame({"count": counts, "pct": 100 * counts / len(k)})
+
+
+def PSIS_LOO(log_prob, chunk_size=500):
+    """Pointwise PSIS-LOO (on the deviance scale) and Pareto k of every observation
+    
+    Warns when some observations have k > 0.7, for which the importance sampling
+    estimate of their leave-one-out density is unreliable.
+    Arguments:
+        log_prob (np.array, Tensor or str): (draws, N) log-likelihood, see ``pointwise_ic``
+        chunk_size (int): number of observations processed at once
+    Returns:
+        Tuple[np.array, np.array]: pointwise loo and k
+    """
+    ic = pointwise_ic(log_prob, chunk_size)
+    n_bad = int((ic["k"] > 0.7).sum())
+    if n_bad:
+        warnings.warn(f"{n_bad} observations have Pareto k > 0.7; PSIS-LOO may be unreliable for them")
+    return ic["loo"], ic["k"]
+
+
+def compare(log_probs: dict, ic="loo", chunk_size=500):
+    """Ranks models by WAIC or PSIS-LOO, like ``precis`` but for model comparison
+    
+    Arguments:
+        log_probs (Dict[str, np.array]): (draws, N) log-likelihood of every model,
+            evaluated on the same N observations (arrays, tensors or .npy paths)
+        ic (str): "loo" or "waic"
+        chunk_size (int): number of observations processed at once
+    Returns:
+        pd.DataFrame: one row per model, sorted best first, with the criterion, its
+        standard error, the difference to the best model and the standard error of
+        that difference, the effective number of parameters, the Akaike weight and
+        (for loo) the number of observations with Pareto k > 0.7
+    """
+    if ic not in ("loo", "waic"):
+        raise ValueError("<ic> must be either 'loo' or 'waic'")
+    pointwise, rows = dict(), dict()
+    for name, log_prob in log_probs.items():
+        res = pointwise_ic(log_prob, chunk_size)
+        pointwise[name] = res[ic]
+        N = len(res[ic])
+        rows[name] = {
+            ic.upper(): res[ic].sum(),
+            "SE": np.sqrt(N * res[ic].var()),
+            # effective number of parameters: lppd - elpd, with elpd = -ic/2 for loo
+            f"p{ic.upper()}": res["p_waic"].sum() if ic == "waic" else res["lppd"].sum() + res["loo"].sum()/2,
+        }
+        if ic == "loo":
+            rows[name]["k>0.7"] = int((res["k"] > 0.7).sum())
+    df = pd.DataFrame.from_dict(rows, orient="index").sort_values(ic.upper())
+    best = pointwise[df.index[0]]
+    N = len(best)
+    df.insert(2, f"d{ic.upper()}", df[ic.upper()] - df[ic.upper()].iloc[0])
+    df.insert(3, "dSE", [np.sqrt(N * (pointwise[name] - best).var()) for name in df.index])
+    w = np.exp(-0.5 * df[f"d{ic.upper()}"])
+    df.insert(5, "weight", w / w.sum())
+    return df
+
+
+class RunningWAIC:
+    """Pointwise WAIC accumulated over chunks of draws, in O(N) memory
+
+    Keeps, for every observation, the log-sum-exp of its log-likelihood over the draws
+    seen so far (for lppd) and their Welford mean and sum of squared deviations (for the
+    penalty); chunks are merged with Chan et al.'s update, so the result does not depend
+    on the chunking and matches ``waic_pointwise`` on the full (draws, N) matrix.
+
+    usage:
+        acc = RunningWAIC()
+        for lp in chunks:  # (draws in chunk, N) log-likelihoods
+            acc.update(lp)
+        waic, se = acc.waic(), acc.se()
+    """
+    def __init__(self):
+        self.n = 0
+        self.lse = self.mean = self.m2 = None
+
+    def update(self, log_prob):
+        log_prob = torch.as_tensor(log_prob).detach()
+        self.dtype = log_prob.dtype
+        # accumulated in double precision, returned in the dtype of the log-likelihood
+        log_prob = log_prob.double()
+        if log_prob.dim() == 1:
+            log_prob = log_prob[None]
+        n = log_prob.shape[0]
+        lse = torch.logsumexp(log_prob, dim=0)
+        mean = log_prob.mean(dim=0)
+        m2 = ((log_prob - mean)**2).sum(dim=0)
+        if self.n == 0:
+            self.n, self.lse, self.mean, self.m2 = n, lse, mean, m2
+            return self
+        total = self.n + n
+        delta = mean - self.mean
+        self.lse = torch.logaddexp(self.lse, lse)
+        self.mean = self.mean + delta * n / total
+        self.m2 = self.m2 + m2 + delta**2 * self.n * n / total
+        self.n = total
+        return self
+
+    def lppd(self):
+        return self.lse - np.log(self.n)
+
+    def p_waic(self):
+        if self.n < 2:
+            raise ValueError("the WAIC penalty needs at least 2 draws")
+        return self.m2 / (self.n - 1)
+
+    def waic(self):
+        """Pointwise WAIC on the deviance scale, as ``waic_pointwise``"""
+        return (-2*(self.lppd() - self.p_waic())).to(self.dtype)
+
+    def se(self):
+        """Standard error of the total WAIC"""
+        waic = self.waic()
+        return float(torch.sqrt(len(waic) * waic.var()))
+
+
+def WAIC(model, x, y, out_var_nm, num_samples=100, parallel=True, chunk_size=100, se=False):
+    """Pointwise WAIC of a model fitted with SVI, using draws from ``model.guide``
+
+    Draws are taken and evaluated ``chunk_size`` at a time and folded into a
+    ``RunningWAIC``, so only a (chunk_size, N) log-likelihood is ever in memory.
+    Arguments:
+        num_samples (int): number of guide draws
+        chunk_size (int): draws evaluated at once
+        se (bool): also return the standard error of the total WAIC
+    Returns:
+        Tensor (and float): pointwise WAIC of shape (N,) on the deviance scale
+    """
+    if num_samples < 2:
+        raise ValueError("<num_samples> must be at least 2")
+    acc = RunningWAIC()
+    for start in range(0, num_samples, chunk_size):
+        samples = sample_guide(model.guide, min(chunk_size, num_samples - start), parallel=parallel)
+        acc.update(log_likelihood(model, samples, {out_var_nm: y}, x, parallel=parallel))
+    waic = acc.waic()
+    return (waic, acc.se()) if se else waic
+
+
+def format_data(df, categoricals=None, dtype=torch.float64, design=None):
+    """Dictionary of column tensors, see ``frames.frame_tensors``"""
+    return frame_tensors(df, categoricals, dtype, design)
+
+
+def train_nuts(model, data, num_warmup, num_samples, num_chains=1, chain_method=None, checkpoint=None,
+               warm_start=None, checkpoint_every=100, **kwargs):
+    """Runs NUTS on ``model(data, training=True)``
+
+    Arguments:
+        chain_method (str): None runs ``MCMC``, which starts a process per chain and
+            compiles the model on every call; "vectorized" batches all chains in this
+            process, reusing the compiled potential of an earlier fit on data of the same
+            shape (see ``mcmc.VectorizedNUTS``), and "pool" reuses persistent worker
+            processes (see ``mcmc.run_chains``). "vectorized" falls back to the pool for
+            models that do not vectorize; pool workers import the model by name, so it
+            must be defined at module level of a file (not in a notebook)
+        checkpoint (str): save the run there as it goes and resume (or extend) it on
+            the next call with the same path; vectorized chains only (see
+            ``mcmc.run_checkpointed``)
+        warm_start (str): checkpoint of an earlier fit of the model to start from, e.g.
+            on previous data, with a shorter ``num_warmup``
+        **kwargs: arguments of NUTS
+    Returns:
+        MCMC or ChainResult: the fitted sampler
+    """
     _kwargs = dict(adapt_step_size=True, adapt_mass_matrix=True, jit_compile=True)
     _kwargs.update(kwargs)
     print(_kwargs)
+    if checkpoint is not None or warm_start is not None:
+        return run_checkpointed(model, (data,), {"training": True}, num_warmup, num_samples, num_chains,
+                                checkpoint, checkpoint_every, warm_start, **_kwargs)
+    if chain_method is not None:
+        return run_chains(model, (data,), {"training": True}, num_warmup, num_samples, num_chains,
+                          chain_method, **_kwargs)
     kernel = NUTS(model, **_kwargs)
     engine = MCMC(kernel, num_samples, num_warmup, num_chains=num_chains)
     engine.run(data, training=True)
     return engine
 
 
-def traceplot(s, num_chains=1):
-    fig, axes = plt.subplots(nrows=len(s), figsize=(12, len(s)*5))
-    for (k, v), ax in zip(s.items(), axes):
-        plt.sca(ax)
-        if num_chains > 1:
-            for c in range(num_chains):
-                plt.plot(v[c], linewidth=0.5)
-        else:
-            plt.plot(v, linewidth=0.5)
-        plt.ylabel(k)
-    plt.xlabel("Sample index")
-    return fig
-
-def trankplot(s, num_chains):
-    fig, axes = plt.subplots(nrows=len(s), figsize=(12, len(s)*num_chains))
-    ranks = {k: np.argsort(v, axis=None).reshape(v.shape) for k, v in s.items()}
-    num_samples = 1
-    for p in list(s.values())[0].shape:
-        num_samples *= p
-    bins = np.linspace(0, num_samples, 30)
-    for i, (ax, (k, v)) in enumerate(zip(axes, ranks.items())):
-        for c in range(num_chains):
-            ax.hist(v[c], bins=bins, histtype="step", linewidth=2, alpha=0.5)
-        ax.set_xlim(left=0, right=num_samples)
-        ax.set_yticks([])
-        ax.set_ylabel(k)
-    plt.xlabel("sample rank")
-    return fig
-
-
 def unnest_samples2(s, max_depth=1):
     """Unnests samples from multivariate distributions
     
@@ -339,37 +806,21 @@ def unnest_samples(samples: dict, group_by_chain=False, depth=1):
     return _samples
 
 
-def get_log_prob(mcmc, data, site_names):
+def get_log_prob(mcmc, data, site_names, parallel=True):
     """Gets the pointwise log probability of the posterior density conditioned on the data
     
     Arguments:
         mcmc (pyro.infer.mcmc.MCMC): the fitted MC model
         data (dict): dictionary containing all the input data (including return sites)
         site_names (str or List[str]): names of return sites to measure log likelihood at
+        parallel (bool): evaluate all posterior samples in one vectorized trace
     Returns:
         Tensor: pointwise log-likelihood of shape (num posterior samples, num data points)
     """
-    samples = mcmc.get_samples()
-    model = mcmc.kernel.model
-    # get number of samples
-    N = [v.shape[0] for v in samples.values()]
-    assert [n == N[0] for n in N]
-    N = N[0]
     if isinstance(site_names, str):
         site_names = [site_names]
-    # iterate over samples
-    log_prob = torch.zeros(N, len(data[site_names[0]]))
-    for i in range(N):
-        # condition on samples and get trace
-        s = {k: v[i] for k, v in samples.items()}
-        for nm in site_names:
-            s[nm] = data[nm]
-        tr = poutine.trace(poutine.condition(model, data=s)).get_trace(data)
-        # get pointwise log probability
-        for nm in site_names:
-            node = tr.nodes[nm]
-            log_prob[i] += node["fn"].log_prob(node["value"])
-    return log_prob
+    obs = {nm: data[nm] for nm in site_names}
+    return log_likelihood(mcmc.kernel.model, mcmc.get_samples(), obs, data, parallel=parallel)
 
 def draw_PGM(G, coordinates, node_unit=1.0):
     pgm = daft.PGM(node_unit=node_unit)    
@@ -400,40 +851,66 @@ class OrderedCategorical(TorchDistribution):
     These cumulative log-odds are then transformed into a discrete cumulative
     probability distribution, that is finally differenced to return the probability
     mass function ``p`` that specifies the categorical distribution.
+
+    ``phi`` (shape ``batch``) and ``cutpoints`` (shape ``batch + (K - 1,)``) broadcast
+    against each other, so the distribution works under vectorized particles and
+    batched chains, and it keeps their dtype and device. ``log_prob`` is computed in
+    log space from the cumulative log-odds, which stays finite where the difference
+    of two cumulative probabilities would round to zero.
     """
     support = constraints.nonnegative_integer
-    arg_constraints = {"phi": constraints.real, "cutpoints": constraints.real}
+    arg_constraints = {"phi": constraints.real, "cutpoints": constraints.real_vector}
     has_rsample = False
-    
-    def __init__(self, phi, cutpoints):
-        assert len(cutpoints.shape) == 1 # cutpoints must be 1d vector
-        assert len(phi.shape) == 1 # model terms must be 1d vector of samples
-        N, K = phi.shape[0], cutpoints.shape[0] + 1
-        #cutpoints = torch.sort(cutpoints).values.reshape(1, -1)  # sort and reshape for broadcasting
-        cutpoints = cutpoints.exp().cumsum(dim=-1).log() # my addition. from pyro forum.
-        cutpoints = cutpoints.reshape(1, -1)
-        q = torch.sigmoid(cutpoints - phi.reshape(-1, 1))  # cumulative probabilities
-        # turn cumulative probabilities into probability mass of categories
-        p = torch.zeros((N, K)) # (batch/sample dim, categories)
-        p[:,0] = q[:,0]
-        p[:,1:-1] = (q - torch.roll(q, 1, dims=1))[:,1:]
-        p[:,-1] = 1 - q[:,-1]
-        self.cum_prob = q
-        self.dist = Categorical(p)
-        
-    def sample(self, *args, **kwargs):
-        return self.dist.sample(*args, **kwargs)
-    
-    def log_prob(self, *args, **kwargs):
-        return self.dist.log_prob(*args, **kwargs)
-    
-    @property
-    def _event_shape(self):
-        return self.dist._event_shape
-    
+
+    def __init__(self, phi, cutpoints, validate_args=None):
+        phi = torch.as_tensor(phi, dtype=cutpoints.dtype, device=cutpoints.device)
+        batch_shape = torch.broadcast_shapes(phi.shape, cutpoints.shape[:-1])
+        self.phi = phi.expand(batch_shape)
+        self.cutpoints = cutpoints.expand(batch_shape + cutpoints.shape[-1:])
+        # ordered cutpoints, log(cumsum(exp(c))) (from the pyro forum)
+        self._ordered = torch.logcumsumexp(self.cutpoints, dim=-1)
+        super().__init__(batch_shape, validate_args=validate_args)
+
+    @lazy_property
+    def cum_prob(self):
+        return torch.sigmoid(self._ordered - self.phi.unsqueeze(-1))
+
+    @lazy_property
+    def probs(self):
+        # probability mass of the categories: one diff over [0, cumulative probabilities, 1]
+        q = self.cum_prob
+        zeros, ones = q.new_zeros(q.shape[:-1] + (1,)), q.new_ones(q.shape[:-1] + (1,))
+        return torch.diff(torch.cat([zeros, q, ones], dim=-1), dim=-1)
+
+    @lazy_property
+    def logits(self):
+        # log(sigmoid(b) - sigmoid(a)) = logsigmoid(b) + logsigmoid(-a) + log(1 - exp(a - b))
+        # for consecutive log-odds a < b, padded with -inf and +inf
+        x = self._ordered - self.phi.unsqueeze(-1)
+        inf = x.new_full(x.shape[:-1] + (1,), float("inf"))
+        a, b = torch.cat([-inf, x], dim=-1), torch.cat([x, inf], dim=-1)
+        return (torch.nn.functional.logsigmoid(b) + torch.nn.functional.logsigmoid(-a)
+                + torch.log(-torch.expm1(a - b)))
+
     @property
-    def _batch_shape(self):
-        return self.dist._batch_shape
+    def num_categories(self):
+        return self.cutpoints.shape[-1] + 1
+
+    def expand(self, batch_shape, _instance=None):
+        batch_shape = torch.Size(batch_shape)
+        return OrderedCategorical(self.phi.expand(batch_shape),
+                                  self.cutpoints.expand(batch_shape + self.cutpoints.shape[-1:]),
+                                  validate_args=self.__dict__.get("_validate_args"))
+
+    def sample(self, sample_shape=torch.Size()):
+        return Categorical(logits=self.logits).sample(sample_shape)
+
+    def log_prob(self, value):
+        if self._validate_args:
+            self._validate_sample(value)
+        value = value.long().unsqueeze(-1)
+        logits, value = torch.broadcast_tensors(self.logits, value)
+        return logits.gather(-1, value[..., :1]).squeeze(-1)
 
 class OrderedTransform(Transform):
     codomain = constraints.real_vector
@@ -0,0 +1,35 @@
+import torch
+
+
+class Tensor:
+    """A tensor sent to a worker process as a numpy array, so no shared memory handle is opened"""
+    def __init__(self, t):
+        self.array = t.detach().cpu().numpy()
+
+
+def pack(obj):
+    """Replaces the tensors of a (nested) dict, list or tuple by picklable ``Tensor`` wrappers"""
+    if isinstance(obj, torch.Tensor):
+        return Tensor(obj)
+    if isinstance(obj, dict):
+        return {k: pack(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(pack(v) for v in obj)
+    return obj
+
+
+def unpack(obj):
+    """Inverse of ``pack``; the tensors share memory with the received arrays"""
+    if isinstance(obj, Tensor):
+        return torch.from_numpy(obj.array)
+    if isinstance(obj, dict):
+        return {k: unpack(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(unpack(v) for v in obj)
+    return obj
+
+
+def init_worker():
+    """Process pool initializer: one thread per worker, since several intra-op threads
+    per worker would oversubscribe the cpus"""
+    torch.set_num_threads(1)